@@ -16,6 +16,8 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from supabase_client import get_db
 from models import User, Store, Coupon, UserCoupon, Admin
 from auth import get_password_hash, verify_password, create_access_token, verify_token, get_current_admin
+from spatial_index import coupon_index
+from foot_traffic import foot_traffic
 
 router = APIRouter()
 security = HTTPBearer()
@@ -106,6 +108,27 @@ class UserCouponDetail(BaseModel):
 # Use the get_current_admin function from auth.py
 
 # Admin authentication endpoints
+class HeatmapCell(BaseModel):
+    x: int
+    y: int
+    min_lat: float
+    min_lng: float
+    max_lat: float
+    max_lng: float
+    count: int  # Visitor-hours
+
+class StoreHeatmapResponse(BaseModel):
+    store_id: str
+    latitude: float
+    longitude: float
+    zoom: int  # Web Mercator zoom of the cells (tiles) below
+    since: datetime
+    min_visitors: int  # Cell-hours with fewer visitors are left out of every count
+    cells: List[HeatmapCell]
+    max_count: int
+    total: int
+    by_hour_of_day: List[int]  # Visitor-hours per hour of the day (0-23) over the whole area
+
 @router.post("/auth/register", response_model=AdminTokenResponse)
 async def register_admin(admin_data: AdminRegister, db: Session = Depends(get_db)):
     """Admin registration endpoint"""
@@ -461,6 +484,7 @@ async def create_coupon(
         db.add(new_coupon)
         db.commit()
         db.refresh(new_coupon)
+        coupon_index.refresh_coupon(db, str(new_coupon.id))
         
         return CouponResponse(
             id=str(new_coupon.id),
@@ -517,12 +541,14 @@ async def delete_coupon(
             # Then delete the coupon itself
             db.delete(coupon)
             db.commit()
+            coupon_index.remove(coupon_id)
             
             return {"message": "クーポンを完全削除しました", "coupon_id": coupon_id, "hard_delete": True}
         else:
             # Soft delete by setting status to expired
             coupon.active_status = "expired"
             db.commit()
+            coupon_index.remove(coupon_id)
             
             return {"message": "クーポンを削除しました", "coupon_id": coupon_id, "hard_delete": False}
         
@@ -582,6 +608,7 @@ async def delete_store(
             store.is_active = False
             store.updated_at = datetime.now()
             db.commit()
+            coupon_index.refresh_store(db, store_id)
             
             message = "店舗を削除しました"
             if coupon_count > 0:
@@ -678,4 +705,31 @@ async def get_coupon_users(
         obtained_at=user_coupon.obtained_at,
         status=user_coupon.status,
         used_at=user_coupon.used_at
-    ) for user_coupon, user, coupon, store in user_coupons]
\ No newline at end of file
+    ) for user_coupon, user, coupon, store in user_coupons]
+
+@router.get("/stores/{store_id}/heatmap", response_model=StoreHeatmapResponse)
+async def get_store_heatmap(
+    store_id: str,
+    radius: int = Query(500, ge=100, le=3000),
+    hours: int = Query(168, ge=1, le=24 * 90),
+    admin: Admin = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """Foot-traffic heatmap around a store (precomputed hourly rollups of user locations)"""
+    store = db.query(Store).filter(Store.id == store_id).first()
+    if not store:
+        raise HTTPException(status_code=404, detail="店舗が見つかりません")
+    
+    if admin.role == "store_owner" and store_id != admin.linked_store_id:
+        raise HTTPException(
+            status_code=403,
+            detail="自分の店舗の情報のみ取得できます"
+        )
+    
+    heatmap = foot_traffic.heatmap(db, store.latitude, store.longitude, radius, hours, datetime.now())
+    return StoreHeatmapResponse(
+        store_id=str(store.id),
+        latitude=store.latitude,
+        longitude=store.longitude,
+        **heatmap
+    )
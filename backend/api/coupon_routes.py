@@ -1,25 +1,40 @@
 """
 Coupon-related API routes
 """
-from fastapi import APIRouter, HTTPException, Depends, Query
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
 from typing import List, Optional
+import asyncio
+import hashlib
+import heapq
 from datetime import datetime, timezone, timedelta
 import math
 import sys
 import os
+import json
 import logging
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from supabase_client import get_db
+from supabase_client import SessionLocal, get_db
 from models import User, Store, Coupon, UserCoupon
-from auth import get_current_user
+from auth import get_current_user, get_current_user_optional
+from repositories import discount_for_time_remaining
 # Add parent directory to path to import external_coupons
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from external_coupons import ExternalCouponService, get_mock_external_coupons
+from coupon_providers import get_provider
+from nearby_pipeline import NearbyPipeline
+from spatial_index import coupon_index
+from coupon_clusters import coupon_clusters
+from change_log import coupon_change_log
+from pubsub import coupon_events
+from geofence import OBTAIN_RADIUS_METERS
+from geo_utils import bounding_box, decode_polyline
 
 # Initialize logger
 logger = logging.getLogger(__name__)
@@ -29,6 +44,18 @@ JST = timezone(timedelta(hours=9))
 
 router = APIRouter()
 
+# Nearby endpoint configurations (see nearby_pipeline.py)
+nearby_pipeline = NearbyPipeline()
+internal_nearby_pipeline = NearbyPipeline(include_external=False, dedupe=False)
+external_nearby_pipeline = NearbyPipeline(include_internal=False)
+public_nearby_pipeline = NearbyPipeline(exclude_obtained=False)
+public_internal_nearby_pipeline = NearbyPipeline(include_external=False, exclude_obtained=False, dedupe=False)
+
+# Upper bounds for one /batch lookup
+MAX_BATCH_POINTS = 1000
+MAX_BATCH_ROUTE_METERS = 50000  # Total length of a connected route
+MAX_BATCH_RESULTS = 1000
+
 # Pydantic models
 class Location(BaseModel):
     lat: float
@@ -48,6 +75,47 @@ class CouponResponse(BaseModel):
     store_name: Optional[str] = None  # For compatibility with external APIs
     external_url: Optional[str] = None  # External coupon URL
 
+class ClusterResponse(BaseModel):
+    id: str  # "<zoom>/<cell x>/<cell y>"
+    location: Location  # Centroid of the member coupons
+    count: int
+    max_discount: int
+    soonest_expires_at: datetime
+    coupon_id: Optional[str] = None  # Set when the cluster is a single coupon
+
+class ViewportResponse(BaseModel):
+    coupons: List[CouponResponse]
+    clusters: List[ClusterResponse] = []  # Filled instead of coupons when cluster=true
+    total: int  # Coupons in the box before the zoom cap
+    truncated: bool
+    content_hash: str  # Also sent as the ETag; unchanged hash means the visible set is unchanged
+
+class CouponRemoval(BaseModel):
+    id: str
+    reason: str  # "removed", "expired" or "obtained"
+
+class CouponChangesResponse(BaseModel):
+    token: str  # Pass as `since` on the next sync
+    reset: bool  # True: `added` is the full set, drop everything held locally
+    added: List[CouponResponse]
+    changed: List[CouponResponse]  # Full coupon; upsert like `added`
+    removed: List[CouponRemoval]
+
+class BatchLookupRequest(BaseModel):
+    points: Optional[List[Location]] = None  # Route vertices, or separate spots with connected=false
+    polyline: Optional[str] = None  # Google encoded polyline (precision 5), instead of points
+    connected: bool = True  # Treat points as a path (corridor) rather than separate circles
+    radius: int = Field(300, ge=1, le=5000)  # Meters from the route
+    limit: Optional[int] = Field(None, ge=1, le=MAX_BATCH_RESULTS)
+
+class BatchCouponResponse(CouponResponse):
+    route_offset_meters: float  # Distance along the route to the point nearest the coupon
+
+class BatchLookupResponse(BaseModel):
+    coupons: List[BatchCouponResponse]  # In route order; distance_meters is the distance from the route
+    total: int
+    truncated: bool
+
 class GetCouponRequest(BaseModel):
     coupon_id: str
     user_location: Location
@@ -58,6 +126,29 @@ class CouponStats(BaseModel):
     near_user: int
     user_obtained: int
 
+# Comment line sent on idle /stream connections so proxies don't time them out
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Maximum coupons returned by /viewport per zoom level: (max zoom, cap)
+VIEWPORT_ZOOM_CAPS = ((10, 100), (12, 200), (14, 400), (16, 800), (22, 1500))
+
+def viewport_cap(zoom: int) -> int:
+    """Result cap for a map zoom level"""
+    for max_zoom, cap in VIEWPORT_ZOOM_CAPS:
+        if zoom <= max_zoom:
+            return cap
+    return VIEWPORT_ZOOM_CAPS[-1][1]
+
+def active_obtained_ids(db: Session, user_id: str, now: datetime) -> frozenset:
+    """Ids of the user's obtained coupons that are still active (the only ones the spatial index can hold)"""
+    return frozenset(str(row[0]) for row in db.query(UserCoupon.coupon_id).join(
+        Coupon, UserCoupon.coupon_id == Coupon.id
+    ).filter(
+        UserCoupon.user_id == user_id,
+        Coupon.active_status == "active",
+        Coupon.end_time > now
+    ))
+
 def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     """Calculate distance between two points using Haversine formula"""
     R = 6371000  # Earth's radius in meters
@@ -94,15 +185,9 @@ def update_coupon_discounts(db: Session):
             time_remaining = coupon_end_time - now
         minutes_remaining = time_remaining.total_seconds() / 60
         
-        # Simple discount escalation logic
-        if minutes_remaining <= 10:
-            new_discount = min(50, coupon.discount_rate_initial + 30)
-        elif minutes_remaining <= 30:
-            new_discount = min(40, coupon.discount_rate_initial + 20)
-        elif minutes_remaining <= 60:
-            new_discount = min(30, coupon.discount_rate_initial + 10)
-        else:
-            new_discount = coupon.discount_rate_initial
+        new_discount = discount_for_time_remaining(
+            coupon.discount_rate_initial, coupon.discount_rate_schedule, minutes_remaining
+        )
         
         if coupon.current_discount != new_discount:
             coupon.current_discount = new_discount
@@ -111,109 +196,253 @@ def update_coupon_discounts(db: Session):
 
 @router.get("/", response_model=List[CouponResponse])
 async def get_nearby_coupons(
+    response: Response,
     lat: float = Query(..., description="User latitude"),
     lng: float = Query(..., description="User longitude"),
     radius: int = Query(5000, description="Search radius in meters"),
     include_external: bool = Query(True, description="Include external coupons"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Maximum number of coupons (nearest first)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get coupons near the user's location (internal + external), excluding already obtained ones"""
+    pipeline = nearby_pipeline if include_external else internal_nearby_pipeline
+    result = await pipeline.run(db, lat, lng, radius, user_id=current_user.id, limit=limit, cursor=cursor)
+    result.apply_headers(response)
+    return result.coupons
+
+@router.get("/viewport", response_model=ViewportResponse)
+async def get_viewport_coupons(
+    request: Request,
+    response: Response,
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lng: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lng: float = Query(..., ge=-180, le=180),
+    zoom: int = Query(14, ge=0, le=22, description="Map zoom level (caps the number of results)"),
+    cluster: bool = Query(False, description="Return grid clusters instead of individual coupons"),
+    current_user: Optional[User] = Depends(get_current_user_optional),
+    db: Session = Depends(get_db)
+):
+    """Get internal and ingested external coupons (or their grid clusters) inside the map viewport, capped per zoom level"""
+    if min_lat > max_lat or min_lng > max_lng:
+        raise HTTPException(status_code=400, detail="Invalid viewport: min must not exceed max")
     
-    # Update discount rates
-    update_coupon_discounts(db)
-    
-    # Get user's already obtained coupon IDs
-    user_obtained_coupon_ids = db.query(UserCoupon.coupon_id).filter(
-        UserCoupon.user_id == current_user.id
-    ).all()
-    obtained_ids = {coupon_id[0] for coupon_id in user_obtained_coupon_ids}
+    now = datetime.now(JST)
+    coupon_index.ensure_loaded(db)
+    
+    if cluster:
+        # Clusters are shared by all users, so obtained coupons are not excluded here
+        clusters = coupon_clusters.query_box(min_lat, min_lng, max_lat, max_lng, zoom, now)
+        body = {
+            "coupons": [],
+            "clusters": clusters,
+            "total": sum(item["count"] for item in clusters),
+            "truncated": False
+        }
+        digest = hashlib.sha1(b"clusters")
+        for item in sorted(clusters, key=lambda c: c["id"]):
+            digest.update(f"|{item['id']}:{item['count']}:{item['max_discount']}:{item['soonest_expires_at'].isoformat()}"
+                          f":{item['location']['lat']:.6f},{item['location']['lng']:.6f}".encode("utf-8"))
+    else:
+        visible = coupon_index.query_box(min_lat, min_lng, max_lat, max_lng, now)
+        
+        if current_user is not None and visible:
+            obtained_ids = active_obtained_ids(db, current_user.id, now)
+            visible = [entry for entry in visible if entry.id not in obtained_ids]
+        
+        # Best offers first when the zoom level can't show everything
+        cap = viewport_cap(zoom)
+        selected = heapq.nsmallest(cap, visible, key=lambda entry: (-entry.current_discount(now), entry.expires_at, entry.id))
+        coupons = [entry.to_response(now) for entry in selected]
+        body = {
+            "coupons": coupons,
+            "total": len(visible),
+            "truncated": len(visible) > len(coupons)
+        }
+        digest = hashlib.sha1(f"{len(visible)}|{cap}".encode("utf-8"))
+        for coupon in sorted(coupons, key=lambda c: c["id"]):
+            digest.update(f"|{coupon['id']}:{coupon['current_discount']}:{coupon['expires_at'].isoformat()}".encode("utf-8"))
+    
+    content_hash = digest.hexdigest()
+    etag = f'"{content_hash}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    
+    body["content_hash"] = content_hash
+    return body
+
+@router.get("/changes", response_model=CouponChangesResponse)
+async def get_coupon_changes(
+    lat: float = Query(..., description="User latitude"),
+    lng: float = Query(..., description="User longitude"),
+    radius: int = Query(5000, description="Search radius in meters"),
+    since: Optional[str] = Query(None, description="Token from the previous sync (omit for a full snapshot)"),
+    current_user: Optional[User] = Depends(get_current_user_optional),
+    db: Session = Depends(get_db)
+):
+    """Get coupons added, changed or removed around the user since a sync token"""
+    now = datetime.now(JST)
+    coupon_index.ensure_loaded(db)
+    coupon_change_log.advance(now)
+    token = coupon_change_log.token()
+    user_id = str(current_user.id) if current_user is not None else None
     
-    # Get active coupons with their stores (internal), excluding obtained ones
-    active_coupons = db.query(Coupon, Store).join(
-        Store, Coupon.store_id == Store.id
-    ).filter(
-        Coupon.active_status == "active",
-        Coupon.end_time > datetime.now(JST),
-        Store.is_active == True,
-        ~Coupon.id.in_(obtained_ids)  # Exclude already obtained coupons
-    ).all()
+    def in_area(point_lat: float, point_lng: float) -> bool:
+        return calculate_distance(lat, lng, point_lat, point_lng) <= radius
     
-    nearby_coupons = []
+    def serialize(entry) -> dict:
+        coupon = entry.to_response(now)
+        coupon["distance_meters"] = calculate_distance(lat, lng, entry.lat, entry.lng)
+        return coupon
     
-    # Process internal coupons
-    for coupon, store in active_coupons:
-        distance = calculate_distance(lat, lng, store.latitude, store.longitude)
-        
-        if distance <= radius:
-            time_remaining = coupon.end_time - datetime.now(JST)
-            minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-            
-            nearby_coupons.append(CouponResponse(
-                id=str(coupon.id),
-                shop_name=store.name,
-                title=coupon.title,
-                current_discount=coupon.current_discount,
-                location=Location(lat=store.latitude, lng=store.longitude),
-                expires_at=coupon.end_time,
-                time_remaining_minutes=minutes_remaining,
-                distance_meters=round(distance, 1),
-                description=coupon.description,
-                source="internal",
-                store_name=store.name
-            ))
+    touched = None
+    if since:
+        try:
+            touched = coupon_change_log.changes_since(since, user_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid sync token")
+    
+    if touched is None:
+        # No token, or one the log can no longer serve: full snapshot
+        visible = [
+            entry for entry in coupon_index.query_box(*bounding_box(lat, lng, radius), now)
+            if in_area(entry.lat, entry.lng)
+        ]
+        if user_id is not None and visible:
+            obtained_ids = active_obtained_ids(db, user_id, now)
+            visible = [entry for entry in visible if entry.id not in obtained_ids]
+        return {"token": token, "reset": True, "added": [serialize(entry) for entry in visible], "changed": [], "removed": []}
+    
+    obtained_ids = frozenset()
+    if user_id is not None and touched:
+        # Only this delta's coupons, so the lookup scales with churn
+        obtained_ids = frozenset(str(row[0]) for row in db.query(UserCoupon.coupon_id).filter(
+            UserCoupon.user_id == user_id,
+            UserCoupon.coupon_id.in_(list(touched))
+        ))
+    
+    added, changed, removed = [], [], []
+    for coupon_id, (first_kind, last_kind, positions) in touched.items():
+        entry = coupon_index.get(coupon_id)
+        if entry is not None and entry.minutes_remaining(now) > 0 and coupon_id not in obtained_ids \
+                and in_area(entry.lat, entry.lng):
+            (added if first_kind == "added" else changed).append(serialize(entry))
+        elif any(in_area(point_lat, point_lng) for point_lat, point_lng in positions):
+            if coupon_id in obtained_ids:
+                reason = "obtained"
+            elif entry is not None and entry.minutes_remaining(now) <= 0:
+                reason = "expired"
+            else:
+                reason = last_kind if last_kind in ("expired", "obtained") else "removed"
+            removed.append({"id": coupon_id, "reason": reason})
+    
+    return {"token": token, "reset": False, "added": added, "changed": changed, "removed": removed}
+
+def _stream_subscriber_state(credentials: Optional[HTTPAuthorizationCredentials], now: datetime):
+    """Resolve the stream's user id and obtained coupon ids on a short-lived session"""
+    # Not Depends(get_db): yield-dependency teardown only runs after the StreamingResponse ends,
+    # so every connected client would hold a pool connection for as long as it stays connected
+    db = SessionLocal()
+    try:
+        coupon_index.ensure_loaded(db)
+        current_user = get_current_user_optional(credentials, db)
+        user_id = str(current_user.id) if current_user is not None else None
+        # The only per-client query; after this the stream is fed purely from the in-process pub/sub
+        obtained_ids = active_obtained_ids(db, user_id, now) if user_id is not None else frozenset()
+        return user_id, obtained_ids
+    finally:
+        db.close()
+
+@router.get("/stream")
+async def stream_coupon_events(
+    request: Request,
+    lat: float = Query(..., description="User latitude"),
+    lng: float = Query(..., description="User longitude"),
+    radius: int = Query(5000, le=50000, description="Search radius in meters"),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))
+):
+    """Server-Sent Events stream of coupon changes around the user (added / changed / removed / exploded / obtained)"""
+    now = datetime.now(JST)
+    user_id, obtained_ids = await asyncio.to_thread(_stream_subscriber_state, credentials, now)
+    subscription = coupon_events.subscribe(lat, lng, radius, user_id, obtained_ids)
     
-    # Get external coupons if requested
-    if include_external:
+    async def events():
         try:
-            # First try real Kumapon API, fallback to mock data
-            external_service = ExternalCouponService()
-            external_coupons = await external_service.get_external_coupons_near_location(lat, lng, radius)
-            
-            # If no real external coupons found, add some mock data for testing
-            if not external_coupons:
-                external_coupons = await get_mock_external_coupons(lat, lng, radius)
-            
-            for ext_coupon in external_coupons:
-                # Skip if user has already obtained this external coupon
-                if ext_coupon['id'] in obtained_ids:
-                    continue
-                    
-                # Convert external coupon format to CouponResponse
+            # Events after this token arrive on the stream; /changes?since=<token> covers a reconnect gap
+            yield f"event: ready\ndata: {json.dumps({'token': coupon_change_log.token()})}\n\n"
+            while not await request.is_disconnected():
                 try:
-                    expires_at = datetime.fromisoformat(ext_coupon['expires_at'].replace('Z', '+00:00'))
-                except:
-                    expires_at = ext_coupon['end_time']
-                
-                time_remaining = expires_at - datetime.now(JST)
-                minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-                
-                nearby_coupons.append(CouponResponse(
-                    id=ext_coupon['id'],
-                    shop_name=ext_coupon.get('shop_name', ext_coupon.get('store_name', '店舗名不明')),
-                    title=ext_coupon['title'],
-                    current_discount=ext_coupon['current_discount'],
-                    location=Location(
-                        lat=ext_coupon['location']['lat'],
-                        lng=ext_coupon['location']['lng']
-                    ),
-                    expires_at=expires_at,
-                    time_remaining_minutes=minutes_remaining,
-                    distance_meters=round(ext_coupon['distance_meters'], 1),
-                    description=ext_coupon.get('description', ''),
-                    source="external",
-                    store_name=ext_coupon.get('store_name', ext_coupon.get('shop_name', '')),
-                    external_url=ext_coupon.get('external_url')
-                ))
-                
-        except Exception as e:
-            # Log error but don't fail the entire request
-            print(f"Failed to fetch external coupons: {e}")
-    
-    # Sort by distance
-    nearby_coupons.sort(key=lambda x: x.distance_meters or 0)
+                    event = await asyncio.wait_for(subscription.queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if subscription.lagged:
+                    # Too far behind to catch up on the stream; the client resyncs and reconnects
+                    yield "event: reset\ndata: {}\n\n"
+                    break
+                if event.kind == "obtained":
+                    subscription.obtained_ids.add(event.coupon_id)
+                elif event.coupon_id in subscription.obtained_ids:
+                    continue
+                frame = coupon_events.render(event)
+                if frame is not None:
+                    yield frame
+        finally:
+            coupon_events.unsubscribe(subscription)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # Disable proxy buffering (nginx)
+    })
+
+@router.post("/batch", response_model=BatchLookupResponse)
+async def batch_lookup_coupons(
+    request: BatchLookupRequest,
+    current_user: Optional[User] = Depends(get_current_user_optional),
+    db: Session = Depends(get_db)
+):
+    """Get the coupons along a route (polyline or points) in one lookup, for prefetching"""
+    if (request.points is None) == (request.polyline is None):
+        raise HTTPException(status_code=400, detail="Specify either points or polyline")
+    if request.polyline is not None:
+        try:
+            points = decode_polyline(request.polyline)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid polyline")
+    else:
+        points = [(point.lat, point.lng) for point in request.points]
+    if not points:
+        raise HTTPException(status_code=400, detail="No points given")
+    if len(points) > MAX_BATCH_POINTS:
+        raise HTTPException(status_code=400, detail=f"Too many points (max {MAX_BATCH_POINTS})")
+    if request.connected:
+        route_meters = sum(calculate_distance(a[0], a[1], b[0], b[1]) for a, b in zip(points, points[1:]))
+        if route_meters > MAX_BATCH_ROUTE_METERS:
+            raise HTTPException(status_code=400, detail=f"Route too long (max {MAX_BATCH_ROUTE_METERS // 1000}km)")
     
-    return nearby_coupons
+    now = datetime.now(JST)
+    coupon_index.ensure_loaded(db)
+    try:
+        matches = coupon_index.query_corridor(points, request.radius, now, connected=request.connected)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Route covers too large an area")
+    
+    if current_user is not None and matches:
+        obtained_ids = active_obtained_ids(db, current_user.id, now)
+        matches = [match for match in matches if match[0].id not in obtained_ids]
+    
+    limit = request.limit or MAX_BATCH_RESULTS
+    coupons = []
+    for entry, distance, offset in matches[:limit]:
+        coupon = entry.to_response(now)
+        coupon["distance_meters"] = distance
+        coupon["route_offset_meters"] = offset
+        coupons.append(coupon)
+    
+    return {"coupons": coupons, "total": len(matches), "truncated": len(matches) > len(coupons)}
 
 @router.post("/get")
 async def obtain_coupon(
@@ -268,7 +497,7 @@ async def obtain_coupon(
         if existing_user_coupon:
             raise HTTPException(status_code=400, detail="このクーポンは既に取得済みです")
         
-        # Check distance (20m radius for obtaining)
+        # Check distance (must be within the store's obtain radius)
         distance = calculate_distance(
             request.user_location.lat, 
             request.user_location.lng,
@@ -277,10 +506,10 @@ async def obtain_coupon(
         )
         
         print(f"DEBUG: Distance to store: {distance}m")
-        if distance > 200:  # 20 meters
+        if distance > OBTAIN_RADIUS_METERS:
             raise HTTPException(
                 status_code=400, 
-                detail=f"店舗から200m以内である必要があります（現在{distance:.1f}m）"
+                detail=f"店舗から{OBTAIN_RADIUS_METERS}m以内である必要があります（現在{distance:.1f}m）"
             )
         
         # Create user coupon
@@ -294,6 +523,7 @@ async def obtain_coupon(
         db.add(user_coupon)
         db.commit()
         db.refresh(user_coupon)
+        coupon_change_log.record_obtained(str(current_user.id), str(coupon.id), store.latitude, store.longitude)
         
         print(f"DEBUG: Successfully created user coupon")
         return {
@@ -416,7 +646,7 @@ async def test_hotpepper_coupons(
     try:
         # Test Hot Pepper coupons service directly
         external_service = ExternalCouponService()
-        hotpepper_coupons = await external_service.fetch_hotpepper_coupons_near_location(lat, lng, radius)
+        hotpepper_coupons = await get_provider("hotpepper").coupons_near(external_service, lat, lng, radius)
         
         result = []
         for ext_coupon in hotpepper_coupons:
@@ -457,220 +687,49 @@ async def test_hotpepper_coupons(
 
 @router.get("/public", response_model=List[CouponResponse])
 async def get_nearby_coupons_public(
+    response: Response,
     lat: float = Query(..., description="User latitude"),
     lng: float = Query(..., description="User longitude"),
     radius: int = Query(5000, description="Search radius in meters"),
     include_external: bool = Query(True, description="Include external coupons"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Maximum number of coupons (nearest first)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
     db: Session = Depends(get_db)
 ):
     """Get coupons near the user's location (public endpoint - no authentication required)"""
-    
-    # Update discount rates
-    update_coupon_discounts(db)
-    
-    # Get active coupons with their stores (internal)
-    active_coupons = db.query(Coupon, Store).join(
-        Store, Coupon.store_id == Store.id
-    ).filter(
-        Coupon.active_status == "active",
-        Coupon.end_time > datetime.now(JST),
-        Store.is_active == True
-    ).all()
-    
-    nearby_coupons = []
-    
-    # Process internal coupons
-    for coupon, store in active_coupons:
-        distance = calculate_distance(lat, lng, store.latitude, store.longitude)
-        
-        if distance <= radius:
-            time_remaining = coupon.end_time - datetime.now(JST)
-            minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-            
-            nearby_coupons.append(CouponResponse(
-                id=str(coupon.id),
-                shop_name=store.name,
-                title=coupon.title,
-                current_discount=coupon.current_discount,
-                location=Location(lat=store.latitude, lng=store.longitude),
-                expires_at=coupon.end_time,
-                time_remaining_minutes=minutes_remaining,
-                distance_meters=round(distance, 1),
-                description=coupon.description,
-                source="internal",
-                store_name=store.name
-            ))
-    
-    # Get external coupons if requested
-    if include_external:
-        try:
-            # First try real Kumapon API, fallback to mock data
-            external_service = ExternalCouponService()
-            external_coupons = await external_service.get_external_coupons_near_location(lat, lng, radius)
-            
-            # If no real external coupons found, add some mock data for testing
-            if not external_coupons:
-                external_coupons = await get_mock_external_coupons(lat, lng, radius)
-            
-            for ext_coupon in external_coupons:
-                # Convert external coupon format to CouponResponse
-                try:
-                    expires_at = datetime.fromisoformat(ext_coupon['expires_at'].replace('Z', '+00:00'))
-                except:
-                    expires_at = ext_coupon['end_time']
-                
-                time_remaining = expires_at - datetime.now(JST)
-                minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-                
-                nearby_coupons.append(CouponResponse(
-                    id=ext_coupon['id'],
-                    shop_name=ext_coupon.get('shop_name', ext_coupon.get('store_name', '店舗名不明')),
-                    title=ext_coupon['title'],
-                    current_discount=ext_coupon['current_discount'],
-                    location=Location(
-                        lat=ext_coupon['location']['lat'],
-                        lng=ext_coupon['location']['lng']
-                    ),
-                    expires_at=expires_at,
-                    time_remaining_minutes=minutes_remaining,
-                    distance_meters=round(ext_coupon['distance_meters'], 1),
-                    description=ext_coupon.get('description', ''),
-                    source="external",
-                    store_name=ext_coupon.get('store_name', ext_coupon.get('shop_name', '')),
-                    external_url=ext_coupon.get('external_url')
-                ))
-                
-        except Exception as e:
-            # Log error but don't fail the entire request
-            print(f"Failed to fetch external coupons: {e}")
-    
-    # Sort by distance
-    nearby_coupons.sort(key=lambda x: x.distance_meters or 0)
-    
-    return nearby_coupons
+    pipeline = public_nearby_pipeline if include_external else public_internal_nearby_pipeline
+    result = await pipeline.run(db, lat, lng, radius, limit=limit, cursor=cursor)
+    result.apply_headers(response)
+    return result.coupons
 
 @router.get("/internal", response_model=List[CouponResponse])
 async def get_nearby_internal_coupons(
+    response: Response,
     lat: float = Query(..., description="User latitude"),
     lng: float = Query(..., description="User longitude"),
     radius: int = Query(5000, description="Search radius in meters"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Maximum number of coupons (nearest first)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get internal coupons near the user's location only"""
-    
-    # Update discount rates
-    update_coupon_discounts(db)
-    
-    # Get user's already obtained coupon IDs
-    user_obtained_coupon_ids = db.query(UserCoupon.coupon_id).filter(
-        UserCoupon.user_id == current_user.id
-    ).all()
-    obtained_ids = {coupon_id[0] for coupon_id in user_obtained_coupon_ids}
-    
-    # Get active coupons with their stores (internal only), excluding obtained ones
-    active_coupons = db.query(Coupon, Store).join(
-        Store, Coupon.store_id == Store.id
-    ).filter(
-        Coupon.active_status == "active",
-        Coupon.end_time > datetime.now(JST),
-        Store.is_active == True,
-        ~Coupon.id.in_(obtained_ids)  # Exclude already obtained coupons
-    ).all()
-    
-    nearby_coupons = []
-    
-    # Process internal coupons
-    for coupon, store in active_coupons:
-        distance = calculate_distance(lat, lng, store.latitude, store.longitude)
-        
-        if distance <= radius:
-            time_remaining = coupon.end_time - datetime.now(JST)
-            minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-            
-            nearby_coupons.append(CouponResponse(
-                id=str(coupon.id),
-                shop_name=store.name,
-                title=coupon.title,
-                current_discount=coupon.current_discount,
-                location=Location(lat=store.latitude, lng=store.longitude),
-                expires_at=coupon.end_time,
-                time_remaining_minutes=minutes_remaining,
-                distance_meters=round(distance, 1),
-                description=coupon.description,
-                source="internal",
-                store_name=store.name
-            ))
-    
-    # Sort by distance
-    nearby_coupons.sort(key=lambda x: x.distance_meters or 0)
-    
-    return nearby_coupons
+    result = await internal_nearby_pipeline.run(db, lat, lng, radius, user_id=current_user.id, limit=limit, cursor=cursor)
+    result.apply_headers(response)
+    return result.coupons
 
 @router.get("/external", response_model=List[CouponResponse])
 async def get_nearby_external_coupons(
+    response: Response,
     lat: float = Query(..., description="User latitude"),
     lng: float = Query(..., description="User longitude"),  
     radius: int = Query(5000, description="Search radius in meters"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Maximum number of coupons (nearest first)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get external coupons near the user's location only"""
-    
-    # Get user's already obtained coupon IDs
-    user_obtained_coupon_ids = db.query(UserCoupon.coupon_id).filter(
-        UserCoupon.user_id == current_user.id
-    ).all()
-    obtained_ids = {coupon_id[0] for coupon_id in user_obtained_coupon_ids}
-    
-    nearby_coupons = []
-    
-    # Get external coupons
-    try:
-        external_service = ExternalCouponService()
-        external_coupons = await external_service.get_external_coupons_near_location(lat, lng, radius)
-        
-        # If no real external coupons found, add some mock data for testing
-        if not external_coupons:
-            external_coupons = await get_mock_external_coupons(lat, lng, radius)
-        
-        for ext_coupon in external_coupons:
-            # Skip if user has already obtained this external coupon
-            if ext_coupon['id'] in obtained_ids:
-                continue
-                
-            # Convert external coupon format to CouponResponse
-            try:
-                expires_at = datetime.fromisoformat(ext_coupon['expires_at'].replace('Z', '+00:00'))
-            except:
-                expires_at = ext_coupon['end_time']
-            
-            time_remaining = expires_at - datetime.now(JST)
-            minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-            
-            nearby_coupons.append(CouponResponse(
-                id=ext_coupon['id'],
-                shop_name=ext_coupon.get('shop_name', ext_coupon.get('store_name', '店舗名不明')),
-                title=ext_coupon['title'],
-                current_discount=ext_coupon['current_discount'],
-                location=Location(
-                    lat=ext_coupon['location']['lat'],
-                    lng=ext_coupon['location']['lng']
-                ),
-                expires_at=expires_at,
-                time_remaining_minutes=minutes_remaining,
-                distance_meters=round(ext_coupon['distance_meters'], 1),
-                description=ext_coupon.get('description', ''),
-                source="external",
-                store_name=ext_coupon.get('store_name', ext_coupon.get('shop_name', '')),
-                external_url=ext_coupon.get('external_url')
-            ))
-            
-    except Exception as e:
-        # Log error but don't fail the entire request
-        print(f"Failed to fetch external coupons: {e}")
-    
-    # Sort by distance
-    nearby_coupons.sort(key=lambda x: x.distance_meters or 0)
-    
-    return nearby_coupons
\ No newline at end of file
+    result = await external_nearby_pipeline.run(db, lat, lng, radius, user_id=current_user.id, limit=limit, cursor=cursor)
+    result.apply_headers(response)
+    return result.coupons
\ No newline at end of file
@@ -15,8 +15,15 @@ from auth_routes import router as auth_router
 from coupon_routes import router as coupon_router
 from admin_routes import router as admin_router
 from user_routes import router as user_router
+from tile_routes import router as tile_router
 from supabase_client import init_database, check_database_connection
 from models import get_db, Store
+from external_coupons import get_external_health
+from spatial_index import coupon_index
+from coupon_clusters import coupon_clusters
+from vector_tiles import coupon_tiles
+from change_log import coupon_change_log
+from pubsub import coupon_events
 from sqlalchemy.orm import Session
 from typing import List
 from pydantic import BaseModel
@@ -38,6 +45,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "ETag"],  # Nearby paging / timing, viewport hash
 )
 
 # Add routers
@@ -45,6 +53,7 @@ app.include_router(auth_router, prefix="/api/auth", tags=["authentication"])
 app.include_router(coupon_router, prefix="/api/coupons", tags=["coupons"])
 app.include_router(user_router, prefix="/api/user", tags=["users"])
 app.include_router(admin_router, prefix="/api/admin", tags=["admin"])
+app.include_router(tile_router, prefix="/api/tiles", tags=["tiles"])
 
 @app.on_event("startup")
 async def startup_event():
@@ -63,7 +72,11 @@ async def health_check():
     return {
         "status": "healthy" if db_status else "unhealthy",
         "database": "connected" if db_status else "disconnected",
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "spatial_index": {**coupon_index.stats(), "clusters": coupon_clusters.stats(), "tiles": coupon_tiles.stats()},
+        "change_log": coupon_change_log.stats(),
+        "realtime": coupon_events.stats(),
+        **get_external_health()
     }
 
 @app.get("/api")
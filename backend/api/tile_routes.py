@@ -0,0 +1,43 @@
+"""
+Map tile API routes
+"""
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from sqlalchemy.orm import Session
+from datetime import datetime
+import sys
+import os
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from supabase_client import get_db
+from external_coupons import JST
+from spatial_index import coupon_index
+from vector_tiles import coupon_tiles
+
+router = APIRouter()
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+MAX_TILE_ZOOM = 22
+# Tiles carry current discounts and time remaining, which move every minute
+TILE_CACHE_CONTROL = "public, max-age=60"
+
+@router.get("/{z}/{x}/{y}.mvt")
+async def get_coupon_tile(
+    z: int,
+    x: int,
+    y: int,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Get a Mapbox Vector Tile of the coupons (points) or clusters (low zoom) in tile z/x/y"""
+    if not 0 <= z <= MAX_TILE_ZOOM or not 0 <= x < (1 << z) or not 0 <= y < (1 << z):
+        raise HTTPException(status_code=404, detail="Tile not found")
+
+    coupon_index.ensure_loaded(db)
+    tile, etag = coupon_tiles.render(z, x, y, datetime.now(JST))
+
+    headers = {"ETag": etag, "Cache-Control": TILE_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=tile, media_type=MVT_MEDIA_TYPE, headers=headers)
@@ -1,11 +1,13 @@
 """
 User-related API routes
 """
-from fastapi import APIRouter, HTTPException, Depends, Path
+from fastapi import APIRouter, HTTPException, Depends, Path, Query, Response
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from datetime import datetime
+import base64
+import json
 import sys
 import os
 
@@ -15,9 +17,27 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from supabase_client import get_db
 from models import User, UserCoupon, Coupon, Store
 from auth import get_current_user
+from repositories import EnhancedUserCouponRepository
 
 router = APIRouter()
 
+WALLET_STATUS_FILTERS = ("used", "unused", "expired")
+
+def encode_wallet_cursor(key: Tuple[datetime, str]) -> str:
+    """Opaque, URL-safe cursor for the (obtained_at, id) of the last coupon on a wallet page"""
+    obtained_at, user_coupon_id = key
+    payload = json.dumps([obtained_at.isoformat(), user_coupon_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_wallet_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Parse a cursor from encode_wallet_cursor (400 if it was tampered with)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        obtained_at, user_coupon_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return datetime.fromisoformat(obtained_at), str(user_coupon_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 # Pydantic models
 class UserCouponResponse(BaseModel):
     id: str
@@ -46,30 +66,39 @@ class UserProfile(BaseModel):
 
 @router.get("/me/coupons", response_model=List[UserCouponResponse])
 async def get_user_coupons(
+    response: Response,
+    status: Optional[str] = Query(None, description="Filter: used / unused / expired"),
+    limit: Optional[int] = Query(None, ge=1, le=200, description="Maximum number of coupons (all when omitted)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Get current user's coupons"""
-    
-    # Get user coupons with related coupon and store data
-    user_coupons = db.query(UserCoupon, Coupon, Store).join(
-        Coupon, UserCoupon.coupon_id == Coupon.id
-    ).join(
-        Store, Coupon.store_id == Store.id
-    ).filter(
-        UserCoupon.user_id == current_user.id
-    ).order_by(UserCoupon.obtained_at.desc()).all()
+    """Get current user's coupons, newest first; with limit, one page at a time (the next page's cursor
+    is in X-Next-Cursor). Without limit every coupon (after cursor, if given) is returned, as before paging"""
+    if status is not None and status not in WALLET_STATUS_FILTERS:
+        raise HTTPException(
+            status_code=400,
+            detail="statusはused・unused・expiredのいずれかを指定してください"
+        )
+    
+    now = datetime.now()
+    after = decode_wallet_cursor(cursor) if cursor else None
+    user_coupon_repo = EnhancedUserCouponRepository(db)
+    # One extra row tells whether there is a next page
+    rows = user_coupon_repo.get_wallet_page(current_user.id, now, status=status,
+                                            limit=limit + 1 if limit is not None else None, after=after)
+    page = rows[:limit]
+    if limit is not None and len(rows) > limit:
+        last = page[-1][0]
+        response.headers["X-Next-Cursor"] = encode_wallet_cursor((last.obtained_at, last.id))
     
     result = []
-    for user_coupon, coupon, store in user_coupons:
-        # Check if coupon is expired
-        now = datetime.now()
-        is_expired = coupon.end_time <= now and user_coupon.status != "used"
-        
-        # Update status if expired
-        if is_expired and user_coupon.status == "obtained":
-            user_coupon.status = "expired"
-            db.commit()
+    expired_ids = []
+    for user_coupon, coupon, store in page:
+        coupon_status = user_coupon.status
+        if coupon_status == "obtained" and coupon.end_time <= now:
+            coupon_status = "expired"
+            expired_ids.append(user_coupon.id)
         
         result.append(UserCouponResponse(
             id=user_coupon.id,
@@ -80,10 +109,13 @@ async def get_user_coupons(
             obtained_at=user_coupon.obtained_at,
             is_used=user_coupon.status == "used",
             used_at=user_coupon.used_at,
-            status=user_coupon.status,
+            status=coupon_status,
             description=coupon.description
         ))
     
+    # Coupons that ran out since they were obtained are marked expired in one UPDATE
+    user_coupon_repo.expire_user_coupons(expired_ids)
+    
     return result
 
 @router.post("/me/coupons/{coupon_id}/use", response_model=UseCouponResponse)
@@ -171,7 +203,11 @@ async def get_user_profile(
 # Legacy routes for backward compatibility
 @router.get("/{user_id}/coupons", response_model=List[UserCouponResponse])
 async def get_user_coupons_by_id(
+    response: Response,
     user_id: str = Path(..., description="User ID"),
+    status: Optional[str] = Query(None, description="Filter: used / unused / expired"),
+    limit: Optional[int] = Query(None, ge=1, le=200, description="Maximum number of coupons (all when omitted)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -186,7 +222,7 @@ async def get_user_coupons_by_id(
             detail="他のユーザーのクーポンは閲覧できません"
         )
     
-    return await get_user_coupons(current_user, db)
+    return await get_user_coupons(response, status, limit, cursor, current_user, db)
 
 @router.post("/{user_id}/coupons/{coupon_id}/use", response_model=UseCouponResponse)
 async def use_coupon_by_id(
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for the coupon backend
+
+Usage:
+    python benchmark.py rakuten-projection [--items 30] [--requests 2000] [--concurrency 200]
+    python benchmark.py nearby-replay [--requests 500] [--concurrency 50] [--profile typical] [--cold]
+    python benchmark.py obtained-exclusion [--obtained 10000] [--nearby 500] [--requests 200]
+    python benchmark.py geo-sampling [--users 200] [--hours 12]
+    python benchmark.py geo-aging [--days 60] [--points-per-day 20000]
+    python benchmark.py geofence [--stores 5000] [--users 20000] [--events 200000]
+    python benchmark.py notification-outbox [--notifications 100000] [--users 20000] [--profile typical]
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import statistics
+import sys
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Add the backend directory to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def print_latency(label, samples_ms):
+    print(f"   {label}: p50={percentile(samples_ms, 50):.3f}ms "
+          f"p95={percentile(samples_ms, 95):.3f}ms p99={percentile(samples_ms, 99):.3f}ms "
+          f"mean={statistics.mean(samples_ms):.3f}ms")
+
+
+def make_rakuten_items(count):
+    """Synthetic Rakuten Market items shaped like the Item Search API (formatVersion=2)"""
+    rng = random.Random(42)
+    return [
+        {
+            'itemName': f"【{rng.choice(['タイムセール', '限定', '特価'])}】テスト商品{i} {rng.choice([10, 20, 30, 50])}%OFF",
+            'itemCode': f"benchshop:{i:05d}",
+            'itemPrice': rng.randint(500, 20000),
+            'itemCaption': "ベンチマーク用の商品説明です。" * 5,
+            'itemUrl': f"https://item.rakuten.co.jp/benchshop/{i}/",
+            'mediumImageUrls': [f"https://thumbnail.image.rakuten.co.jp/bench/{i}.jpg"],
+            'shopName': f"ベンチショップ{i % 7}",
+            'shopCode': "benchshop",
+            'reviewCount': rng.randint(0, 500),
+            'reviewAverage': round(rng.uniform(3.0, 5.0), 2),
+            'genreId': str(100000 + i % 13)
+        }
+        for i in range(count)
+    ]
+
+
+async def bench_rakuten_projection(args):
+    """Measure the per-request cost of projecting the cached Rakuten Market catalog"""
+    import coupon_providers
+    from coupon_providers import RakutenProvider, rakuten_market_cache, RAKUTEN_MARKET_DEFAULT_KEYWORD
+    from external_coupons import ExternalCouponService
+
+    service = ExternalCouponService()
+    provider = RakutenProvider()
+    provider.app_id = provider.app_id or "benchmark"
+    coupon_providers.logger.disabled = True
+
+    items = make_rakuten_items(args.items)
+
+    # Old path: every request converted every raw item for its user
+    rng = random.Random(7)
+    convert_ms = []
+    for _ in range(min(args.requests, 500)):
+        lat, lng = 35.6 + rng.random() * 0.2, 139.6 + rng.random() * 0.2
+        started = time.perf_counter()
+        [provider.convert_market_item(item, lat, lng) for item in items]
+        convert_ms.append((time.perf_counter() - started) * 1000)
+
+    # New path: prepare once into the global cache, project per request
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    async def load_catalog():
+        return [provider.prepare_market_item(item) for item in items]
+
+    rakuten_market_cache.clear()
+    await rakuten_market_cache.get_or_fetch(RAKUTEN_MARKET_DEFAULT_KEYWORD, "global", load_catalog)
+    after = tracemalloc.take_snapshot()
+    catalog_bytes = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    projection_ms = []
+    projected_bytes = []
+
+    async def one_request(lat, lng):
+        async with semaphore:
+            started = time.perf_counter()
+            catalog = await provider.get_market_catalog(service)
+            coupons = [provider.project_market_coupon(prepared, lat, lng) for prepared in catalog]
+            projection_ms.append((time.perf_counter() - started) * 1000)
+            return coupons
+
+    rng = random.Random(11)
+    points = [(35.6 + rng.random() * 0.2, 139.6 + rng.random() * 0.2) for _ in range(args.requests)]
+
+    # Memory held by one request's projected result
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    sample = await one_request(*points[0])
+    _, peak = tracemalloc.get_traced_memory()
+    projected_bytes.append(peak - baseline)
+    del sample
+    projection_ms.clear()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_request(lat, lng) for lat, lng in points))
+    elapsed = time.perf_counter() - started
+
+    print(f"Rakuten Market projection ({args.items} items, {args.requests} requests, concurrency {args.concurrency})")
+    print_latency("convert per request (old)", convert_ms)
+    print_latency("cached projection (new) ", projection_ms)
+    print(f"   throughput: {args.requests / elapsed:,.0f} requests/s")
+    print(f"   global catalog memory: {catalog_bytes / 1024:.1f} KiB (held once)")
+    print(f"   per-request projection peak memory: {projected_bytes[0] / 1024:.1f} KiB")
+    print(f"   cache: {rakuten_market_cache.stats()['levels']}")
+
+
+async def bench_nearby_replay(args):
+    """Load-test the full external nearby pipeline against the local replay server"""
+    from replay_server import build_profiles, replay_base_urls, start_replay_server
+
+    replay = start_replay_server(profiles=build_profiles(args.profile, args.provider_profile), seed=args.seed)
+    os.environ.update(replay_base_urls(replay))
+    # The replay server ignores credentials, but the service skips providers without them
+    for name in ("HOTPEPPER_API_KEY", "RAKUTEN_APP_ID"):
+        if not os.getenv(name):
+            os.environ[name] = "replay"
+    logging.disable(logging.ERROR)
+
+    from coupon_providers import hotpepper_tile_cache, rakuten_market_cache
+    from external_coupons import ExternalCouponService, get_external_health
+    from coupon_dedupe import dedupe_coupons
+
+    if args.cold:
+        hotpepper_tile_cache.clear()
+        rakuten_market_cache.clear()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies_ms = []
+    result_sizes = []
+
+    async def one_request(lat, lng):
+        async with semaphore:
+            started = time.perf_counter()
+            service = ExternalCouponService()
+            coupons = dedupe_coupons(await service.get_external_coupons_near_location(lat, lng, 3000))
+            latencies_ms.append((time.perf_counter() - started) * 1000)
+            result_sizes.append(len(coupons))
+
+    rng = random.Random(args.seed)
+    points = [(35.6627 + rng.uniform(-0.02, 0.02), 139.7307 + rng.uniform(-0.02, 0.02)) for _ in range(args.requests)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_request(lat, lng) for lat, lng in points))
+    elapsed = time.perf_counter() - started
+    replay.shutdown()
+
+    health = get_external_health()
+    print(f"Nearby pipeline on replay ({args.requests} requests, concurrency {args.concurrency}, profile {args.profile})")
+    print_latency("end-to-end", latencies_ms)
+    print(f"   throughput: {args.requests / elapsed:,.0f} requests/s")
+    print(f"   coupons per response: mean={statistics.mean(result_sizes):.1f} min={min(result_sizes)}")
+    print(f"   upstream calls served by replay: {replay.replay_state.stats()['counters']}")
+    print(f"   singleflight: {health['singleflight']}")
+    print(f"   breakers: { {name: b['state'] for name, b in health['circuit_breakers'].items()} }")
+
+
+def bench_obtained_exclusion(args):
+    """Compare the old obtained-id NOT IN list with the NOT EXISTS anti-join for heavy users"""
+    # Always a throwaway SQLite database: the benchmark inserts tens of thousands of rows
+    db_path = os.path.join(tempfile.mkdtemp(prefix="coupon_bench_"), "bench.db")
+    os.environ.pop("SUPABASE_DATABASE_URL", None)
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    logging.disable(logging.ERROR)
+
+    from models import Base, Coupon, Store, User, UserCoupon
+    from supabase_client import SessionLocal, engine
+    from external_coupons import JST
+    from nearby_pipeline import NearbyPipeline
+
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    rng = random.Random(5)
+    now = datetime.now(JST).replace(tzinfo=None)
+    center_lat, center_lng = 35.6627, 139.7307
+
+    db.add(User(id="heavy-user", name="heavy", email="heavy@example.com", password_hash="x"))
+    stores, coupons, user_coupons = [], [], []
+    for i in range(100):
+        # Half the stores around the user, half spread over Japan
+        near = i < 50
+        stores.append({
+            "id": f"store-{i}", "name": f"ベンチ店舗{i}", "owner_email": "bench@example.com", "is_active": True,
+            "latitude": center_lat + rng.uniform(-0.02, 0.02) if near else rng.uniform(31.0, 43.0),
+            "longitude": center_lng + rng.uniform(-0.02, 0.02) if near else rng.uniform(130.0, 145.0),
+            "created_at": now, "updated_at": now
+        })
+    for i in range(args.obtained + args.nearby):
+        nearby = i >= args.obtained
+        coupons.append({
+            "id": f"coupon-{i}", "store_id": f"store-{rng.randrange(50) if nearby else 50 + rng.randrange(50)}",
+            "title": f"ベンチクーポン{i}", "discount_rate_initial": 10, "current_discount": 10,
+            "start_time": now - timedelta(days=1),
+            "end_time": now + timedelta(hours=rng.randint(2, 48)),
+            "active_status": "active", "created_at": now, "updated_at": now
+        })
+        # Every historical coupon plus a tenth of the nearby ones are already obtained
+        if not nearby or i % 10 == 0:
+            user_coupons.append({
+                "id": f"user-coupon-{i}", "user_id": "heavy-user", "coupon_id": f"coupon-{i}",
+                "obtained_at": now, "status": "obtained", "discount_at_obtain": 10
+            })
+    db.bulk_insert_mappings(Store, stores)
+    db.bulk_insert_mappings(Coupon, coupons)
+    db.bulk_insert_mappings(UserCoupon, user_coupons)
+    db.commit()
+
+    pipeline = NearbyPipeline(include_external=False)
+
+    def old_path():
+        # Previous exclusion: load every obtained id, pass them back as NOT IN (...)
+        obtained_ids = {row[0] for row in db.query(UserCoupon.coupon_id).filter(UserCoupon.user_id == "heavy-user")}
+        return pipeline.internal_query(db, center_lat, center_lng, 5000, now).filter(
+            ~Coupon.id.in_(obtained_ids)
+        ).all()
+
+    def new_path():
+        return pipeline._fetch_internal(db, center_lat, center_lng, 5000, now, exclude_user_id="heavy-user")
+
+    results = {}
+    for label, fn in (("NOT IN obtained-id list (old)", old_path), ("NOT EXISTS anti-join (new)", new_path)):
+        fn()  # warm up
+        samples = []
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            rows = fn()
+            samples.append((time.perf_counter() - started) * 1000)
+        results[label] = (samples, len(rows))
+
+    print(f"Obtained-coupon exclusion ({len(user_coupons)} obtained, {args.nearby} active nearby, {args.requests} requests)")
+    for label, (samples, count) in results.items():
+        print_latency(label, samples)
+        print(f"      rows returned: {count}")
+    db.close()
+
+
+def make_movement_trace(users, hours, seed):
+    """
+    Polls (user_id, lat, lng, timestamp) for users going about a day in Tokyo: staying somewhere
+    (with GPS jitter), walking, or riding a train, with the map refreshed every 10-30 seconds
+    """
+    from geo_utils import destination_point
+
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1, 8, 0)
+    end = start + timedelta(hours=hours)
+    polls = []
+    for user in range(users):
+        user_id = f"bench-user-{user}"
+        lat, lng = 35.6627 + rng.uniform(-0.05, 0.05), 139.7307 + rng.uniform(-0.05, 0.05)
+        now = start + timedelta(seconds=rng.uniform(0, 600))
+        while now < end:
+            mode = rng.choices(["stay", "walk", "train"], weights=[6, 3, 1])[0]
+            if mode == "stay":
+                speed, until = 0.0, now + timedelta(minutes=rng.uniform(5, 60))
+            elif mode == "walk":
+                speed, until = rng.uniform(1.1, 1.6), now + timedelta(minutes=rng.uniform(3, 15))
+            else:
+                speed, until = rng.uniform(8, 14), now + timedelta(minutes=rng.uniform(5, 20))
+            bearing = rng.uniform(0, 2 * math.pi)
+            while now < min(until, end):
+                step = rng.uniform(10, 30)
+                lat, lng = destination_point(lat, lng, speed * step, bearing)
+                # GPS noise around the true position
+                noisy = destination_point(lat, lng, abs(rng.gauss(0, 8)), rng.uniform(0, 2 * math.pi))
+                polls.append((user_id, noisy[0], noisy[1], now))
+                now += timedelta(seconds=step)
+    polls.sort(key=lambda poll: poll[3])
+    return polls
+
+
+async def bench_geo_sampling(args):
+    """Write volume and table growth of GeoPoint tracking with and without movement sampling"""
+    logging.disable(logging.ERROR)
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.orm import sessionmaker
+    from models import Base, GeoPoint
+    from geo_writer import GEO_SAMPLE_MIN_DISTANCE_M, GeoPointWriter, LocationSampler
+
+    polls = make_movement_trace(args.users, args.hours, args.seed)
+    runs = (("every poll (old)", 0.0), (f"sampled, {GEO_SAMPLE_MIN_DISTANCE_M:g} m (new)", GEO_SAMPLE_MIN_DISTANCE_M))
+    print(f"GeoPoint sampling ({args.users} users, {args.hours} h, {len(polls):,} polls)")
+    for label, min_distance in runs:
+        # Throwaway SQLite database per run, so the file size is the table's growth
+        db_path = os.path.join(tempfile.mkdtemp(prefix="coupon_bench_"), "geo.db")
+        engine = create_engine(f"sqlite:///{db_path}")
+        Base.metadata.create_all(engine)
+        session_factory = sessionmaker(bind=engine)
+        empty_bytes = os.path.getsize(db_path)
+
+        writer = GeoPointWriter(session_factory, max_queue=len(polls) + 1,
+                                sampler=LocationSampler(min_distance_m=min_distance))
+        started = time.perf_counter()
+        for user_id, lat, lng, timestamp in polls:
+            writer.record(user_id, lat, lng, timestamp)
+        await writer.close()
+        elapsed = time.perf_counter() - started
+
+        db = session_factory()
+        rows = db.query(func.count(GeoPoint.id)).scalar()
+        dwell_total = db.query(func.sum(GeoPoint.dwell_seconds)).scalar() or 0
+        db.close()
+        engine.dispose()
+        stats = writer.stats()
+        growth = os.path.getsize(db_path) - empty_bytes
+        print(f"   {label}:")
+        print(f"      rows: {rows:,} ({rows / len(polls):.1%} of polls), dwell updates: {stats['dwell_updates']:,}, "
+              f"dwell recorded: {dwell_total / 3600:.1f} h")
+        print(f"      table growth: {growth / 1024:,.0f} KiB ({growth / args.users / args.hours:,.0f} B per user-hour)")
+        print(f"      write time: {elapsed:.2f}s in {stats['batches']} batches")
+
+
+def bench_geo_aging(args):
+    """Insert and history-query cost as geo_points ages, with and without day partitions"""
+    logging.disable(logging.ERROR)
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import sessionmaker
+    from models import Base, GeoPoint
+    from repositories import GeoPointRepository
+    from geo_retention import GeoPointMaintenance
+
+    rng = random.Random(args.seed)
+    start = datetime(2025, 1, 1)
+    users = [f"bench-user-{i}" for i in range(args.users)]
+    print(f"GeoPoint table aging ({args.days} days, {args.points_per_day:,} points per day, {args.users} users)")
+    for label, maintained in (("single table (old)", False), ("day partitions (new)", True)):
+        db_path = os.path.join(tempfile.mkdtemp(prefix="coupon_bench_"), "geo.db")
+        engine = create_engine(f"sqlite:///{db_path}")
+        Base.metadata.create_all(engine)
+        # The composite index the history query uses, as in supabase_schema.sql
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE INDEX idx_geo_points_user_timestamp ON geo_points(user_id, timestamp DESC)")
+        session_factory = sessionmaker(bind=engine)
+        maintenance = GeoPointMaintenance(engine)
+        insert_ms, query_ms = [], []
+        for day in range(args.days):
+            day_start = start + timedelta(days=day)
+            rows = [{
+                "id": f"{day}-{i}", "user_id": rng.choice(users),
+                "latitude": 35.6627 + rng.uniform(-0.05, 0.05), "longitude": 139.7307 + rng.uniform(-0.05, 0.05),
+                "timestamp": day_start + timedelta(seconds=86400 * i / args.points_per_day), "dwell_seconds": 0
+            } for i in range(args.points_per_day)]
+            if maintained:
+                maintenance.run(day_start)
+            db = session_factory()
+            started = time.perf_counter()
+            for offset in range(0, len(rows), 500):
+                db.execute(insert(GeoPoint), rows[offset:offset + 500])
+                db.commit()
+            insert_ms.append((time.perf_counter() - started) * 1000 / (len(rows) / 500))
+            started = time.perf_counter()
+            for user_id in users[:50]:
+                GeoPointRepository(db).get_user_location_history(user_id, limit=8)
+            query_ms.append((time.perf_counter() - started) * 1000 / 50)
+            db.close()
+        engine.dispose()
+        print(f"   {label}:")
+        for marker in sorted({0, args.days // 2, args.days - 1}):
+            print(f"      day {marker + 1:>3}: insert {insert_ms[marker]:.2f}ms per 500-row batch, "
+                  f"history query {query_ms[marker]:.3f}ms")
+        print(f"      database file: {os.path.getsize(db_path) / 1024 / 1024:.1f} MiB")
+
+
+def bench_geofence(args):
+    """Geofence matching cost per location event against many store fences"""
+    logging.disable(logging.ERROR)
+    from external_coupons import JST
+    from geo_utils import destination_point
+    from geofence import GeofenceEngine, NotificationSender
+    from spatial_index import CouponSpatialIndex, IndexedCoupon
+
+    class CountingSender(NotificationSender):
+        def __init__(self):
+            self.count = 0
+
+        def send(self, notifications):
+            self.count += len(notifications)
+
+    rng = random.Random(args.seed)
+    now = datetime.now(JST).replace(tzinfo=None)
+    index = CouponSpatialIndex()
+    # Stores spread over central Tokyo (about 20 x 20 km), one or two coupons each
+    for store in range(args.stores):
+        lat, lng = 35.6627 + rng.uniform(-0.09, 0.09), 139.7307 + rng.uniform(-0.11, 0.11)
+        for coupon in range(rng.choice((1, 2))):
+            index.upsert(IndexedCoupon(
+                id=f"coupon-{store}-{coupon}", store_id=f"store-{store}", shop_name=f"ベンチ店舗{store}",
+                title="ベンチクーポン", description=None, lat=lat, lng=lng, discount_rate_initial=20,
+                discount_rate_schedule=None, expires_at=now + timedelta(hours=rng.randint(1, 6))
+            ))
+
+    sender = CountingSender()
+    engine = GeofenceEngine(index, sender)
+    # Users walk around; each event moves one user 10-40m
+    positions = [(35.6627 + rng.uniform(-0.09, 0.09), 139.7307 + rng.uniform(-0.11, 0.11)) for _ in range(args.users)]
+    events = []
+    for _ in range(args.events):
+        user = rng.randrange(args.users)
+        positions[user] = destination_point(*positions[user], rng.uniform(10, 40), rng.uniform(0, 2 * math.pi))
+        events.append((f"bench-user-{user}", *positions[user]))
+
+    samples = []
+    started = time.perf_counter()
+    for count, (user_id, lat, lng) in enumerate(events, start=1):
+        event_started = time.perf_counter()
+        engine.observe(user_id, lat, lng)
+        samples.append((time.perf_counter() - event_started) * 1000)
+        if count % 1000 == 0:
+            engine.deliver()  # Stands in for the background delivery task
+    elapsed = time.perf_counter() - started
+    engine.deliver()
+
+    stats = engine.stats()
+    print(f"Geofence matching ({stats['fences']:,} store fences, {args.users:,} users, {args.events:,} location events)")
+    print_latency("per event", samples)
+    print(f"   throughput: {args.events / elapsed:,.0f} events/s (single thread)")
+    print(f"   fences entered: {stats['entered']:,}, notifications sent: {sender.count:,}, "
+          f"deduplicated: {stats['deduplicated']:,}, dropped: {stats['dropped']:,}")
+
+
+def bench_notification_outbox(args):
+    """Draining a queued notification backlog through the outbox worker and the push stand-in"""
+    logging.disable(logging.ERROR)
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.orm import sessionmaker
+    from models import Base, NotificationOutbox
+    from circuit_breaker import CircuitBreaker
+    from notification_outbox import HttpPushProvider, NotificationOutboxWorker
+    from push_server import push_endpoint_url, start_push_server
+
+    rng = random.Random(args.seed)
+    db_path = os.path.join(tempfile.mkdtemp(prefix="coupon_bench_"), "outbox.db")
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    server = start_push_server(profile=args.profile, seed=args.seed)
+    # Short cooldown so an open circuit doesn't dominate the run
+    provider = HttpPushProvider(push_endpoint_url(server), breaker=CircuitBreaker("push", cooldown_seconds=1))
+    worker = NotificationOutboxWorker(session_factory, {"http": provider}, coalesce_seconds=0)
+
+    rows = [{"user_id": f"bench-user-{rng.randrange(args.users)}", "coupon_id": f"coupon-{i}",
+             "store_id": f"store-{i % 5000}", "title": "ベンチクーポン", "message": f"ベンチ店舗{i % 5000}の20%OFFクーポンが近くにあります"}
+            for i in range(args.notifications)]
+    started = time.perf_counter()
+    for offset in range(0, len(rows), 500):
+        worker.enqueue(rows[offset:offset + 500])
+    enqueue_elapsed = time.perf_counter() - started
+
+    def remaining():
+        db = session_factory()
+        try:
+            return dict(db.query(NotificationOutbox.status, func.count()).group_by(NotificationOutbox.status).all())
+        finally:
+            db.close()
+
+    # Each pass runs an hour later on the worker's clock, so retries are due on the next pass
+    clock = datetime.now()
+    passes = 0
+    started = time.perf_counter()
+    while remaining().get("pending"):
+        if not worker.process_once(clock):
+            time.sleep(0.2)  # Circuit open
+        passes += 1
+        clock += timedelta(hours=1)
+    elapsed = time.perf_counter() - started
+    left = remaining()
+    server.shutdown()
+    stats = worker.stats()
+    received = server.push_state.stats()["counters"]
+    print(f"Notification outbox ({args.notifications:,} alerts for {args.users:,} users, push profile {args.profile})")
+    print(f"   enqueue: {args.notifications / enqueue_elapsed:,.0f} alerts/s (500 per insert)")
+    print(f"   delivery: {stats['delivered'] / elapsed:,.0f} alerts/s, {elapsed:.2f}s in {passes} passes")
+    print(f"   pushes: {stats['pushes']:,} ({stats['delivered'] / max(stats['pushes'], 1):.1f} alerts each), "
+          f"HTTP requests: {stats['requests']:,} (one per alert would be {args.notifications:,})")
+    print(f"   endpoint errors: {received['errors']:,}, retried rows: {stats['retries']:,}, "
+          f"deferred while circuit open: {stats['deferred']:,}, "
+          f"failed: {left.get('failed', 0):,}, still pending: {left.get('pending', 0):,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coupon backend benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rakuten = subparsers.add_parser("rakuten-projection", help="Rakuten Market per-user projection cost")
+    rakuten.add_argument("--items", type=int, default=30)
+    rakuten.add_argument("--requests", type=int, default=2000)
+    rakuten.add_argument("--concurrency", type=int, default=200)
+    rakuten.set_defaults(func=bench_rakuten_projection)
+
+    replay = subparsers.add_parser("nearby-replay", help="External nearby pipeline against the replay server")
+    replay.add_argument("--requests", type=int, default=500)
+    replay.add_argument("--concurrency", type=int, default=50)
+    replay.add_argument("--profile", default="typical", choices=["instant", "typical", "slow", "flaky", "throttled"])
+    replay.add_argument("--provider-profile", action="append", default=[])
+    replay.add_argument("--seed", type=int, default=1)
+    replay.add_argument("--cold", action="store_true", help="Clear provider caches before the run")
+    replay.set_defaults(func=bench_nearby_replay)
+
+    exclusion = subparsers.add_parser("obtained-exclusion", help="Excluding obtained coupons for heavy users")
+    exclusion.add_argument("--obtained", type=int, default=10000)
+    exclusion.add_argument("--nearby", type=int, default=500)
+    exclusion.add_argument("--requests", type=int, default=200)
+    exclusion.set_defaults(func=bench_obtained_exclusion)
+
+    sampling = subparsers.add_parser("geo-sampling", help="GeoPoint write volume with movement sampling")
+    sampling.add_argument("--users", type=int, default=200)
+    sampling.add_argument("--hours", type=int, default=12)
+    sampling.add_argument("--seed", type=int, default=3)
+    sampling.set_defaults(func=bench_geo_sampling)
+
+    aging = subparsers.add_parser("geo-aging", help="GeoPoint insert/query cost as history accumulates")
+    aging.add_argument("--days", type=int, default=60)
+    aging.add_argument("--points-per-day", type=int, default=20000)
+    aging.add_argument("--users", type=int, default=500)
+    aging.add_argument("--seed", type=int, default=4)
+    aging.set_defaults(func=bench_geo_aging)
+
+    geofence = subparsers.add_parser("geofence", help="Geofence matching of location events")
+    geofence.add_argument("--stores", type=int, default=5000)
+    geofence.add_argument("--users", type=int, default=20000)
+    geofence.add_argument("--events", type=int, default=200000)
+    geofence.add_argument("--seed", type=int, default=6)
+    geofence.set_defaults(func=bench_geofence)
+
+    outbox = subparsers.add_parser("notification-outbox", help="Notification outbox delivery throughput")
+    outbox.add_argument("--notifications", type=int, default=100000)
+    outbox.add_argument("--users", type=int, default=20000)
+    outbox.add_argument("--profile", default="typical", choices=["instant", "typical", "slow", "flaky", "throttled"])
+    outbox.add_argument("--seed", type=int, default=7)
+    outbox.set_defaults(func=bench_notification_outbox)
+
+    args = parser.parse_args()
+    if asyncio.iscoroutinefunction(args.func):
+        asyncio.run(args.func(args))
+    else:
+        args.func(args)
+
+
+if __name__ == "__main__":
+    main()
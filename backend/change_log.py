@@ -0,0 +1,232 @@
+"""
+Coupon change log for delta sync
+Records which coupons were added, changed or removed so /api/coupons/changes can send a client
+only what changed since its last sync token instead of the whole nearby list.
+
+- Fed by the spatial index (admin writes, provider ingestion, periodic rebuild diffs), by
+  coupon obtains (user-scoped) and by time: a heap of each coupon's next discount-tier boundary
+  and expiry is advanced on read, so tier changes and expiries are logged without polling; only
+  the latest transition per coupon is live, and superseded ones are compacted out of the heap
+- Upserts that leave a coupon exactly as it was are not logged
+- Kept as a ring buffer of CHANGE_LOG_SIZE events; tokens older than the buffer, or from another
+  process / before a restart, get a reset (full snapshot) instead of a delta
+- Tokens are "<epoch>-<seq>"; a delta lists each touched coupon once, with its current state
+- Sinks (pubsub.py) receive every event as it is logged, for the realtime stream, with the index
+  entries before and after it for upserts
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from spatial_index import CouponSpatialIndex, IndexedCoupon, coupon_index
+from external_coupons import JST
+
+logger = logging.getLogger(__name__)
+
+CHANGE_LOG_SIZE = int(os.getenv("CHANGE_LOG_SIZE", "10000"))
+
+# Legacy escalation tiers (minutes remaining) used when a coupon has no schedule,
+# see repositories.discount_for_time_remaining
+LEGACY_DISCOUNT_TIERS = (60, 30, 10)
+
+
+class ChangeEvent:
+    __slots__ = ("seq", "coupon_id", "kind", "user_id", "lat", "lng")
+
+    def __init__(self, seq: int, coupon_id: str, kind: str, user_id: Optional[str], lat: float, lng: float):
+        self.seq = seq
+        self.coupon_id = coupon_id
+        self.kind = kind  # added / changed / removed / expired / obtained
+        self.user_id = user_id  # Only set for user-scoped events
+        self.lat = lat
+        self.lng = lng
+
+
+def _naive_jst(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(JST).replace(tzinfo=None)
+    return value
+
+
+def next_transition(entry: IndexedCoupon, now: datetime) -> Optional[Tuple[datetime, str]]:
+    """When the coupon next changes discount tier ("changed") or expires ("expired")"""
+    expires_at = _naive_jst(entry.expires_at)
+    remaining = (expires_at - _naive_jst(now)).total_seconds() / 60
+    if remaining <= 0:
+        return None
+    if not entry.is_external:
+        if entry.discount_rate_schedule:
+            tiers = sorted({item["time_remain_min"] for item in entry.discount_rate_schedule}, reverse=True)
+        else:
+            tiers = LEGACY_DISCOUNT_TIERS
+        for tier in tiers:
+            if tier < remaining:
+                return expires_at - timedelta(minutes=tier), "changed"
+    return expires_at, "expired"
+
+
+# sink(event, old entry, new entry)
+Sink = Callable[[ChangeEvent, Optional[IndexedCoupon], Optional[IndexedCoupon]], None]
+
+
+class CouponChangeLog:
+    """Ring buffer of coupon change events with sequence-number tokens"""
+
+    def __init__(self, index: CouponSpatialIndex, max_events: int = CHANGE_LOG_SIZE):
+        self.index = index
+        self.epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._events: "deque[ChangeEvent]" = deque(maxlen=max_events)
+        self._known: Dict[str, IndexedCoupon] = {}
+        self._transitions: List[Tuple[datetime, int, str, IndexedCoupon, int]] = []
+        self._scheduled: Dict[str, int] = {}  # Coupon id -> tiebreak of its live transition
+        self._tiebreak = itertools.count()
+        self._sinks: List[Sink] = []
+        self._lock = threading.Lock()
+        index.add_listener(self._on_change)
+
+    def add_sink(self, sink: Sink) -> None:
+        """Call sink(event, old, new) for every new event (under the log's lock, so it must not block)
+
+        old / new are the index entries an upsert replaced and stored; both are None for time-based,
+        user-scoped and removal events.
+        """
+        self._sinks.append(sink)
+
+    def token(self, seq: Optional[int] = None) -> str:
+        return f"{self.epoch}-{self._seq if seq is None else seq}"
+
+    def _parse_token(self, token: str) -> Optional[int]:
+        """Sequence number of a token, or None if it belongs to another epoch (raises ValueError if malformed)"""
+        epoch, _, seq = token.partition("-")
+        seq = int(seq)
+        if epoch != self.epoch or seq > self._seq:
+            return None
+        return seq
+
+    def _append_locked(self, coupon_id: str, kind: str, lat: float, lng: float, user_id: Optional[str] = None,
+                       old: Optional[IndexedCoupon] = None, new: Optional[IndexedCoupon] = None) -> None:
+        self._seq += 1
+        event = ChangeEvent(self._seq, coupon_id, kind, user_id, lat, lng)
+        self._events.append(event)
+        for sink in self._sinks:
+            try:
+                sink(event, old, new)
+            except Exception as e:
+                logger.error(f"Change log sink failed: {e}")
+
+    def _schedule_locked(self, entry: IndexedCoupon, now: datetime) -> None:
+        """Make entry's next transition its coupon's only live one"""
+        self._scheduled.pop(entry.id, None)
+        transition = next_transition(entry, now)
+        if transition is not None:
+            tiebreak = next(self._tiebreak)
+            self._scheduled[entry.id] = tiebreak
+            heapq.heappush(self._transitions, (transition[0], tiebreak, transition[1], entry,
+                                               entry.current_discount(now)))
+        if len(self._transitions) > 2 * len(self._scheduled) + 64:
+            # Drop superseded transitions instead of keeping them until they come due
+            self._transitions = [item for item in self._transitions if self._scheduled.get(item[3].id) == item[1]]
+            heapq.heapify(self._transitions)
+
+    def _track_locked(self, old: Optional[IndexedCoupon], new: Optional[IndexedCoupon], now: datetime) -> None:
+        if new is not None and new.same_as(old):
+            return  # Nothing changed; the known entry and its scheduled transition stay as they are
+        if new is not None:
+            self._known[new.id] = new
+            self._append_locked(new.id, "changed" if old is not None else "added", new.lat, new.lng,
+                                old=old, new=new)
+            if old is not None and (old.lat, old.lng) != (new.lat, new.lng):
+                # Moved: clients around the old position need to drop it
+                self._append_locked(old.id, "removed", old.lat, old.lng)
+            self._schedule_locked(new, now)
+        elif old is not None:
+            self._known.pop(old.id, None)
+            self._scheduled.pop(old.id, None)
+            self._append_locked(old.id, "removed", old.lat, old.lng)
+
+    def _on_change(self, event: str, old: Optional[IndexedCoupon], new: Optional[IndexedCoupon]) -> None:
+        now = datetime.now(JST)
+        if event != "rebuild":
+            with self._lock:
+                self._track_locked(old, new, now)
+            return
+
+        # Diff the rebuilt index against what was known, so other processes' writes show up too
+        current = {entry.id: entry for entry in self.index.entries()}
+        with self._lock:
+            for coupon_id, old_entry in list(self._known.items()):
+                if coupon_id not in current:
+                    self._track_locked(old_entry, None, now)
+            for coupon_id, entry in current.items():
+                old_entry = self._known.get(coupon_id)
+                if old_entry is None and entry.minutes_remaining(now) <= 0:
+                    continue  # Expired but still indexed until its row is deactivated
+                # Unchanged coupons keep their known object and scheduled transition (_track_locked skips them)
+                self._track_locked(old_entry, entry, now)
+
+    def record_obtained(self, user_id: str, coupon_id: str, lat: float, lng: float) -> None:
+        """The coupon disappears from this user's map"""
+        with self._lock:
+            self._append_locked(coupon_id, "obtained", lat, lng, user_id=user_id)
+
+    def advance(self, now: datetime) -> None:
+        """Log discount-tier changes and expiries that are due"""
+        now_naive = _naive_jst(now)
+        with self._lock:
+            while self._transitions and self._transitions[0][0] <= now_naive:
+                when, tiebreak, kind, entry, discount = heapq.heappop(self._transitions)
+                if self._scheduled.get(entry.id) != tiebreak:
+                    continue  # Replaced or removed since it was scheduled
+                if kind == "expired":
+                    self._known.pop(entry.id, None)
+                    self._scheduled.pop(entry.id, None)
+                    self._append_locked(entry.id, "expired", entry.lat, entry.lng)
+                    continue
+                # Step from the transition itself so a late advance still walks every tier up to expiry
+                if entry.current_discount(when) != discount:
+                    self._append_locked(entry.id, "changed", entry.lat, entry.lng)
+                self._schedule_locked(entry, when)
+
+    def changes_since(self, token: str, user_id: Optional[str] = None) -> Optional[Dict[str, Tuple[str, str, List[Tuple[float, float]]]]]:
+        """
+        Coupons touched since the token: id -> (first kind, last kind, positions).
+        None means the token can't be served (too old / other epoch) and the client must reset.
+        """
+        with self._lock:
+            seq = self._parse_token(token)
+            if seq is None:
+                return None
+            if self._events and self._events[0].seq > seq + 1:
+                return None  # Events after the token were already dropped from the ring buffer
+            touched: Dict[str, Tuple[str, str, List[Tuple[float, float]]]] = {}
+            # Events are in seq order, so walk back from the newest
+            for event in reversed(self._events):
+                if event.seq <= seq:
+                    break
+                if event.user_id is not None and event.user_id != user_id:
+                    continue
+                first, last, positions = touched.get(event.coupon_id, (event.kind, event.kind, []))
+                positions.append((event.lat, event.lng))
+                touched[event.coupon_id] = (event.kind, last, positions)
+            return touched
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "token": self.token(),
+                "events": len(self._events),
+                "tracked": len(self._known),
+                "pending_transitions": len(self._scheduled),
+                "transition_heap": len(self._transitions)
+            }
+
+
+# Shared by all requests in this process
+coupon_change_log = CouponChangeLog(coupon_index)
@@ -0,0 +1,143 @@
+"""
+Circuit breaker for external coupon providers
+Stops paying the full request timeout when a provider is degraded.
+
+- closed: calls go through; outcomes and latencies are recorded in a rolling window
+- open: calls fail immediately with CircuitOpenError until the cooldown elapses
+- half_open: a single probe call is let through; success closes the circuit, failure re-opens it,
+  and a probe that ends without an outcome (cancelled) must be released so the next call can probe
+
+The request timeout adapts to the provider's observed p95 latency.
+"""
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import requests
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling a provider whose circuit is open"""
+
+
+class CircuitBreaker:
+    """Rolling-window circuit breaker with an adaptive timeout for one provider"""
+
+    def __init__(
+        self,
+        name: str,
+        error_rate_threshold: float = 0.5,
+        min_requests: int = 5,
+        window_seconds: float = 60.0,
+        cooldown_seconds: float = 30.0,
+        min_timeout: float = 1.0,
+        max_timeout: float = 10.0,
+        timeout_multiplier: float = 2.0,
+        max_samples: int = 200
+    ):
+        self.name = name
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.state = CLOSED
+        self.opened_at: Optional[float] = None
+        self.short_circuited = 0
+        self._probe_in_flight = False
+        # (timestamp, succeeded, latency_seconds)
+        self._samples: Deque[Tuple[float, bool, float]] = deque(maxlen=max_samples)
+
+    def _prune(self, now: float) -> None:
+        while self._samples and now - self._samples[0][0] > self.window_seconds:
+            self._samples.popleft()
+
+    def error_rate(self) -> float:
+        """Get the error rate over the rolling window"""
+        self._prune(time.monotonic())
+        if not self._samples:
+            return 0.0
+        failures = sum(1 for _, succeeded, _ in self._samples if not succeeded)
+        return failures / len(self._samples)
+
+    def p95_latency(self) -> Optional[float]:
+        """Get the p95 latency of successful calls over the rolling window"""
+        self._prune(time.monotonic())
+        latencies = sorted(latency for _, succeeded, latency in self._samples if succeeded)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, math.ceil(len(latencies) * 0.95) - 1)]
+
+    def current_timeout(self) -> float:
+        """Get the request timeout derived from observed p95 latency"""
+        p95 = self.p95_latency()
+        if p95 is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p95 * self.timeout_multiplier))
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpenError if the provider should not be called right now; True if this call is the probe"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                self.short_circuited += 1
+                raise CircuitOpenError(f"Circuit for {self.name} is open")
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                self.short_circuited += 1
+                raise CircuitOpenError(f"Circuit for {self.name} is half-open (probe in flight)")
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def release_probe(self) -> None:
+        """Give up the probe slot of a call that ended without a recorded outcome (e.g. cancelled)"""
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+
+    def record_success(self, latency: float) -> None:
+        """Record a successful call"""
+        self._samples.append((time.monotonic(), True, latency))
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self.state = CLOSED
+            self.opened_at = None
+            # Start the new closed period with a clean error history
+            self._samples.clear()
+            self._samples.append((time.monotonic(), True, latency))
+
+    def record_failure(self, latency: float) -> None:
+        """Record a failed call and open the circuit if the error rate is too high"""
+        now = time.monotonic()
+        self._samples.append((now, False, latency))
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self._open(now)
+            return
+        self._prune(now)
+        if len(self._samples) >= self.min_requests and self.error_rate() >= self.error_rate_threshold:
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = OPEN
+        self.opened_at = now
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Get breaker state for the health endpoint"""
+        p95 = self.p95_latency()
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 3),
+            "samples": len(self._samples),
+            "p95_latency_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "timeout_seconds": round(self.current_timeout(), 2),
+            "short_circuited": self.short_circuited,
+            "open_for_seconds": round(time.monotonic() - self.opened_at, 1) if self.opened_at is not None else None
+        }
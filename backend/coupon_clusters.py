@@ -0,0 +1,202 @@
+"""
+Server-side clustering of coupon pins for zoomed-out maps
+Groups the spatial index's coupons into a Web Mercator pixel grid per zoom level so the
+viewport endpoint can return a handful of clusters instead of hundreds of pins.
+
+- Each zoom level's grid cell is CLUSTER_CELL_PIXELS screen pixels square (256px tiles);
+  zoom levels above CLUSTER_MAX_ZOOM reuse the top level
+- Cluster membership is kept incrementally from the spatial index's change events, so an
+  admin edit only touches the coupon's own cell at each zoom level
+- Aggregates (count, centroid, max current discount, soonest expiry) are computed per
+  tile and cached until the tile changes or the minute rolls over (discounts and expiry
+  move with time)
+"""
+import math
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from spatial_index import CouponSpatialIndex, IndexedCoupon, coupon_index
+
+TILE_SIZE = 256
+CLUSTER_CELL_PIXELS = int(os.getenv("CLUSTER_CELL_PIXELS", "64"))
+CLUSTER_MAX_ZOOM = int(os.getenv("CLUSTER_MAX_ZOOM", "16"))
+
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def world_pixel(lat: float, lng: float, zoom: int) -> Tuple[float, float]:
+    """Web Mercator pixel coordinates of a point at a zoom level (origin top-left)"""
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    scale = TILE_SIZE * (1 << zoom)
+    x = (lng + 180.0) / 360.0 * scale
+    sin_lat = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+
+def tile_of(lat: float, lng: float, zoom: int) -> Tuple[int, int]:
+    x, y = world_pixel(lat, lng, zoom)
+    last = (1 << zoom) - 1
+    return min(last, max(0, int(x // TILE_SIZE))), min(last, max(0, int(y // TILE_SIZE)))
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(min_lat, min_lng, max_lat, max_lng) of a tile"""
+    n = 1 << zoom
+
+    def lat_of(tile_y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return lat_of(y + 1), x / n * 360.0 - 180.0, lat_of(y), (x + 1) / n * 360.0 - 180.0
+
+
+class _Tile:
+    """Cluster cells of one tile, plus its cached aggregates"""
+
+    __slots__ = ("cells", "version", "cached_version", "cached_minute", "cached_clusters")
+
+    def __init__(self):
+        self.cells: Dict[Tuple[int, int], Dict[str, IndexedCoupon]] = {}
+        self.version = 0
+        self.cached_version = -1
+        self.cached_minute = None
+        self.cached_clusters: List[Dict[str, Any]] = []
+
+
+class CouponClusterIndex:
+    """Per-zoom grid clusters over a CouponSpatialIndex"""
+
+    def __init__(self, index: CouponSpatialIndex, cell_pixels: int = CLUSTER_CELL_PIXELS,
+                 max_zoom: int = CLUSTER_MAX_ZOOM):
+        self.index = index
+        self.cell_pixels = cell_pixels
+        self.max_zoom = max_zoom
+        self.cells_per_tile = max(1, TILE_SIZE // cell_pixels)
+        self._tiles: List[Dict[Tuple[int, int], _Tile]] = [{} for _ in range(max_zoom + 1)]
+        self._lock = threading.RLock()
+        self._rebuild(index.entries())
+        index.add_listener(self._on_change)
+
+    def _cell_keys(self, entry: IndexedCoupon) -> List[Tuple[int, int]]:
+        """Cluster cell of the coupon at each zoom level, derived from one projection at max zoom"""
+        x, y = world_pixel(entry.lat, entry.lng, self.max_zoom)
+        keys = []
+        for zoom in range(self.max_zoom + 1):
+            size = self.cell_pixels * (1 << (self.max_zoom - zoom))
+            keys.append((int(x // size), int(y // size)))
+        return keys
+
+    def _add_locked(self, entry: IndexedCoupon) -> None:
+        for zoom, cell_key in enumerate(self._cell_keys(entry)):
+            tile_key = (cell_key[0] // self.cells_per_tile, cell_key[1] // self.cells_per_tile)
+            tile = self._tiles[zoom].get(tile_key)
+            if tile is None:
+                tile = self._tiles[zoom][tile_key] = _Tile()
+            tile.cells.setdefault(cell_key, {})[entry.id] = entry
+            tile.version += 1
+
+    def _remove_locked(self, entry: IndexedCoupon) -> None:
+        for zoom, cell_key in enumerate(self._cell_keys(entry)):
+            tile_key = (cell_key[0] // self.cells_per_tile, cell_key[1] // self.cells_per_tile)
+            tile = self._tiles[zoom].get(tile_key)
+            if tile is None:
+                continue
+            members = tile.cells.get(cell_key)
+            if members is not None and members.pop(entry.id, None) is not None:
+                tile.version += 1
+                if not members:
+                    del tile.cells[cell_key]
+                    if not tile.cells:
+                        del self._tiles[zoom][tile_key]
+
+    def _rebuild(self, entries: List[IndexedCoupon]) -> None:
+        with self._lock:
+            self._tiles = [{} for _ in range(self.max_zoom + 1)]
+            for entry in entries:
+                self._add_locked(entry)
+
+    def _on_change(self, event: str, old: Optional[IndexedCoupon], new: Optional[IndexedCoupon]) -> None:
+        if event == "rebuild":
+            self._rebuild(self.index.entries())
+            return
+        with self._lock:
+            if old is not None:
+                self._remove_locked(old)
+            if new is not None:
+                self._add_locked(new)
+
+    def _aggregate(self, zoom: int, tile: _Tile, now: datetime) -> List[Dict[str, Any]]:
+        clusters = []
+        for (cell_x, cell_y), members in tile.cells.items():
+            count = 0
+            sum_lat = sum_lng = 0.0
+            max_discount = 0
+            soonest = None
+            single = None
+            for entry in members.values():
+                if entry.minutes_remaining(now) <= 0:
+                    continue  # Expired since the last rebuild
+                count += 1
+                sum_lat += entry.lat
+                sum_lng += entry.lng
+                max_discount = max(max_discount, entry.current_discount(now))
+                if soonest is None or entry.expires_at < soonest:
+                    soonest = entry.expires_at
+                single = entry
+            if count:
+                clusters.append({
+                    "id": f"{zoom}/{cell_x}/{cell_y}",
+                    "location": {"lat": sum_lat / count, "lng": sum_lng / count},
+                    "count": count,
+                    "max_discount": max_discount,
+                    "soonest_expires_at": soonest,
+                    "coupon_id": single.id if count == 1 else None
+                })
+        return clusters
+
+    def tile_clusters(self, zoom: int, x: int, y: int, now: datetime) -> List[Dict[str, Any]]:
+        """Clusters of one tile, from cache while neither the tile nor the minute changed"""
+        zoom = min(zoom, self.max_zoom)
+        minute = int(now.timestamp() // 60)
+        with self._lock:
+            tile = self._tiles[zoom].get((x, y))
+            if tile is None:
+                return []
+            if tile.cached_version != tile.version or tile.cached_minute != minute:
+                tile.cached_clusters = self._aggregate(zoom, tile, now)
+                tile.cached_version = tile.version
+                tile.cached_minute = minute
+            return tile.cached_clusters
+
+    def query_box(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float, zoom: int,
+                  now: datetime) -> List[Dict[str, Any]]:
+        """Clusters whose centroid is inside the box"""
+        zoom = min(zoom, self.max_zoom)
+        min_x, min_y = tile_of(max_lat, min_lng, zoom)
+        max_x, max_y = tile_of(min_lat, max_lng, zoom)
+        with self._lock:
+            occupied = self._tiles[zoom]
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > len(occupied):
+                tile_keys = [key for key in occupied if min_x <= key[0] <= max_x and min_y <= key[1] <= max_y]
+            else:
+                tile_keys = [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+            clusters = []
+            for x, y in tile_keys:
+                for cluster in self.tile_clusters(zoom, x, y, now):
+                    location = cluster["location"]
+                    if min_lat <= location["lat"] <= max_lat and min_lng <= location["lng"] <= max_lng:
+                        clusters.append(cluster)
+        return clusters
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "tiles": sum(len(tiles) for tiles in self._tiles),
+                "max_zoom": self.max_zoom
+            }
+
+
+# Shared by all requests in this process
+coupon_clusters = CouponClusterIndex(coupon_index)
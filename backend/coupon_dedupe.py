@@ -0,0 +1,192 @@
+"""
+Cross-provider duplicate shop detection
+The same restaurant can show up from Hot Pepper, Kumapon and our own stores, which stacks pins on
+the map and ships redundant payloads. This module keeps the best offer per physical shop.
+
+- Candidates are bucketed by a fine geohash (precision 7, roughly 150m x 150m) and only compared
+  with candidates in the same or neighbouring cells
+- Shop names are normalized (NFKC, case, punctuation) and compared with a 64-bit SimHash over
+  character bigrams, so small spelling differences still match; listings whose branch suffixes
+  (本店 / 支店 / N号店) differ are never the same shop
+- Only listings from different providers are merged, and a shop keeps at most one listing per
+  provider: two coupons of one internal store, or two Hot Pepper shops, are always kept. The only
+  same-provider merge is an exact repeat of one upstream record (same provider store id)
+- Runs in near-linear time: each candidate is compared only with the few candidates around it
+"""
+import hashlib
+import logging
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from geo_utils import calculate_distance
+
+logger = logging.getLogger(__name__)
+
+GEOHASH_PRECISION = 7
+DUPLICATE_DISTANCE_M = 60  # Two listings this close with similar names are the same shop
+SIMHASH_MAX_HAMMING = 8
+
+_BRANCH_SUFFIX = re.compile(r"(\d+号店|本店|支店)$")
+_ANNOTATION_SUFFIX = re.compile(r"[\s　]*[\(（][^)）]*[\)）]$")
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def _geohash_cell_size(precision: int) -> Tuple[float, float]:
+    lng_bits = (precision * 5 + 1) // 2
+    lat_bits = precision * 5 // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+_CELL_LAT_SIZE, _CELL_LNG_SIZE = _geohash_cell_size(GEOHASH_PRECISION)
+
+
+def geohash_cell(lat: float, lng: float) -> Tuple[int, int]:
+    """Row/column of the geohash cell containing a point
+
+    A geohash string just interleaves these two indices, so neighbours are found with
+    arithmetic instead of re-encoding offset points.
+    """
+    return int((lat + 90.0) // _CELL_LAT_SIZE), int((lng + 180.0) // _CELL_LNG_SIZE)
+
+
+def split_shop_name(name: str) -> Tuple[str, str]:
+    """Normalize a shop name (width, case, punctuation) into (base name, branch suffix)"""
+    normalized = unicodedata.normalize("NFKC", name or "").strip().lower()
+    normalized = _NON_WORD.sub("", _ANNOTATION_SUFFIX.sub("", normalized))
+    branch = _BRANCH_SUFFIX.search(normalized)
+    if branch is None or branch.start() == 0:
+        return normalized, ""
+    return normalized[:branch.start()], branch.group(1)
+
+
+def normalize_shop_name(name: str) -> str:
+    """Normalize a shop name for comparison, without its branch suffix"""
+    return split_shop_name(name)[0]
+
+
+@lru_cache(maxsize=8192)
+def simhash(text: str) -> int:
+    """64-bit SimHash of a string over its character bigrams"""
+    if not text:
+        return 0
+    grams = [text[i:i + 2] for i in range(max(1, len(text) - 1))]
+    weights = [0] * 64
+    for gram in grams:
+        value = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    result = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            result |= 1 << bit
+    return result
+
+
+def _field(coupon: Any, name: str, default: Any = None) -> Any:
+    if isinstance(coupon, dict):
+        return coupon.get(name, default)
+    return getattr(coupon, name, default)
+
+
+def coupon_provider(coupon: Any) -> str:
+    """Provider a listing came from (rakuten_market and rakuten_travel are both rakuten)"""
+    source = _field(coupon, "provider") or _field(coupon, "source", "internal") or "internal"
+    return source.split("_", 1)[0]
+
+
+class _Candidate:
+    __slots__ = ("name", "branch", "name_hash", "lat", "lng", "provider", "store_key")
+
+    def __init__(self, name: str, branch: str, lat: float, lng: float, provider: str, store_key: Optional[str]):
+        self.name = name
+        self.branch = branch
+        self.name_hash = simhash(name)
+        self.lat = lat
+        self.lng = lng
+        self.provider = provider
+        self.store_key = store_key
+
+
+def _candidate_info(coupon: Any) -> Optional[_Candidate]:
+    name = _field(coupon, "shop_name") or _field(coupon, "store_name") or ""
+    location = _field(coupon, "location")
+    if location is None:
+        return None
+    lat = _field(location, "lat")
+    lng = _field(location, "lng")
+    if lat is None or lng is None:
+        return None
+    provider = coupon_provider(coupon)
+    # Internal coupons have no provider store id: two of them are always different offers
+    external_id = _field(coupon, "external_id") if provider != "internal" else None
+    base, branch = split_shop_name(name)
+    return _Candidate(base, branch, float(lat), float(lng), provider, str(external_id) if external_id else None)
+
+
+def _same_shop(candidate: _Candidate, other: _Candidate) -> bool:
+    if candidate.branch and other.branch and candidate.branch != other.branch:
+        return False
+    if candidate.name != other.name and bin(candidate.name_hash ^ other.name_hash).count("1") > SIMHASH_MAX_HAMMING:
+        return False
+    return calculate_distance(candidate.lat, candidate.lng, other.lat, other.lng) <= DUPLICATE_DISTANCE_M
+
+
+def _offer_rank(coupon: Any) -> Tuple[int, int, float]:
+    # Higher discount wins, then internal coupons (obtainable in-app), then the nearer listing
+    is_internal = 1 if _field(coupon, "source", "internal") == "internal" else 0
+    distance = _field(coupon, "distance_meters") or 0.0
+    return (_field(coupon, "current_discount", 0) or 0, is_internal, -distance)
+
+
+def dedupe_coupons(coupons: List[Any]) -> List[Any]:
+    """Drop duplicate listings of the same shop, keeping the best offer; order is preserved"""
+    buckets: Dict[Tuple[int, int], List[int]] = {}
+    infos: List[Optional[_Candidate]] = []
+    # Index of the winning coupon for each group, keyed by the group's first member
+    group_of: List[int] = []
+    best: Dict[int, int] = {}
+    # Provider -> store key of each group's members (a shop has one listing per provider)
+    group_listings: Dict[int, Dict[str, Optional[str]]] = {}
+
+    for index, coupon in enumerate(coupons):
+        info = _candidate_info(coupon)
+        infos.append(info)
+        group_of.append(index)
+        if info is None or not info.name:
+            best[index] = index
+            continue
+
+        row, col = geohash_cell(info.lat, info.lng)
+        match = None
+        for cell in ((row + dr, col + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)):
+            for other in buckets.get(cell, ()):
+                listings = group_listings[group_of[other]]
+                if info.provider in listings:
+                    # Same provider: only an exact repeat of the same upstream record is a duplicate
+                    store_key = listings[info.provider]
+                    if info.store_key is None or store_key != info.store_key:
+                        continue
+                if _same_shop(info, infos[other]):
+                    match = other
+                    break
+            if match is not None:
+                break
+
+        if match is None:
+            best[index] = index
+            group_listings[index] = {info.provider: info.store_key}
+        else:
+            group = group_of[match]
+            group_of[index] = group
+            group_listings[group].setdefault(info.provider, info.store_key)
+            if _offer_rank(coupon) > _offer_rank(coupons[best[group]]):
+                best[group] = index
+        buckets.setdefault((row, col), []).append(index)
+
+    keep = set(best.values())
+    removed = len(coupons) - len(keep)
+    if removed:
+        logger.info(f"Removed {removed} duplicate shop listings out of {len(coupons)} candidates")
+    return [coupon for index, coupon in enumerate(coupons) if index in keep]
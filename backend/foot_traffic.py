@@ -0,0 +1,219 @@
+"""
+Foot-traffic rollups for store heatmaps
+Folds GeoPoints into per-cell, per-hour counters as they are written, so a store owner's heatmap
+is a small indexed range read over foot_traffic_cells instead of a scan of geo_points.
+
+- Cells are Web Mercator tiles at each of FOOT_TRAFFIC_ZOOMS (about 1 km, 250 m and 60 m in
+  Tokyo); every point increments its cell at every zoom for the hour it was recorded in
+- Since a stationary user is stored as one point with a growing dwell_seconds (geo_writer.py),
+  each cell-hour also counts distinct visitors: a user is counted once in every hour their point
+  and its dwell time cover, however many points they left there. Visitors are deduplicated in
+  memory for the last FOOT_TRAFFIC_SEEN_HOURS hours (per process)
+- Fed by geo_writer's committed batches and dwell updates: one multi-row upsert
+  (ON CONFLICT DO UPDATE) per batch
+- Rollups older than FOOT_TRAFFIC_RETENTION_DAYS are pruned by the geo_points maintenance job
+- heatmap() picks the finest zoom that keeps the area within HEATMAP_MAX_CELLS_ACROSS cells and
+  counts visitors; cell-hours with fewer than HEATMAP_MIN_VISITORS visitors are left out so a
+  cell never reveals an individual
+"""
+import os
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
+
+from sqlalchemy import delete, func
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from coupon_clusters import tile_bounds, tile_of
+from geo_retention import geo_maintenance
+from geo_utils import bounding_box
+from geo_writer import geo_writer
+from models import FootTrafficCell
+from supabase_client import SessionLocal
+
+FOOT_TRAFFIC_ZOOMS = (15, 17, 19)
+FOOT_TRAFFIC_RETENTION_DAYS = int(os.getenv("FOOT_TRAFFIC_RETENTION_DAYS", "180"))
+FOOT_TRAFFIC_SEEN_HOURS = 3
+HEATMAP_MAX_CELLS_ACROSS = 32
+HEATMAP_MIN_VISITORS = int(os.getenv("HEATMAP_MIN_VISITORS", "5"))
+
+CellKey = Tuple[int, int, int, datetime]
+Visit = Tuple[str, int, int, int]  # user_id, zoom, x, y
+
+
+def _hour_of(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup(rows: List[Dict[str, Any]], zooms: Tuple[int, ...] = FOOT_TRAFFIC_ZOOMS) -> Dict[CellKey, int]:
+    """Point counts per (zoom, x, y, hour) for a batch of GeoPoint rows"""
+    counts: Dict[CellKey, int] = {}
+    for row in rows:
+        hour = _hour_of(row["timestamp"])
+        for zoom in zooms:
+            x, y = tile_of(row["latitude"], row["longitude"], zoom)
+            key = (zoom, x, y, hour)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def presence(rows: List[Dict[str, Any]],
+             zooms: Tuple[int, ...] = FOOT_TRAFFIC_ZOOMS) -> Iterator[Tuple[datetime, Visit]]:
+    """(hour, visit) for every hour each row's point and dwell time cover, at every zoom"""
+    for row in rows:
+        start = row["timestamp"]
+        hour = _hour_of(start)
+        last_hour = _hour_of(start + timedelta(seconds=row.get("dwell_seconds") or 0))
+        cells = [(zoom, *tile_of(row["latitude"], row["longitude"], zoom)) for zoom in zooms]
+        while hour <= last_hour:
+            for zoom, x, y in cells:
+                yield hour, (row["user_id"], zoom, x, y)
+            hour += timedelta(hours=1)
+
+
+def _upsert_statement(dialect: str):
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(FootTrafficCell)
+    return statement.on_conflict_do_update(
+        index_elements=["zoom", "cell_x", "cell_y", "hour"],
+        set_={"points": FootTrafficCell.points + statement.excluded.points,
+              "visitors": FootTrafficCell.visitors + statement.excluded.visitors}
+    )
+
+
+class FootTrafficAggregator:
+    """Incremental per-cell, per-hour GeoPoint and visitor counters"""
+
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal,
+                 zooms: Tuple[int, ...] = FOOT_TRAFFIC_ZOOMS,
+                 retention_days: int = FOOT_TRAFFIC_RETENTION_DAYS,
+                 seen_hours: int = FOOT_TRAFFIC_SEEN_HOURS,
+                 min_visitors: int = HEATMAP_MIN_VISITORS):
+        self.session_factory = session_factory
+        self.zooms = zooms
+        self.retention_days = retention_days
+        self.seen_hours = seen_hours
+        self.min_visitors = min_visitors
+        self._seen: Dict[datetime, Set[Visit]] = {}  # Visits already counted, by hour
+        self.metrics = {"points": 0, "visits": 0, "cell_updates": 0, "failures": 0}
+
+    def _new_visits(self, rows: List[Dict[str, Any]]) -> Dict[CellKey, int]:
+        """Visitor counts per cell-hour for visits not counted before"""
+        counts: Dict[CellKey, int] = {}
+        for hour, visit in presence(rows, self.zooms):
+            seen = self._seen.get(hour)
+            if seen is None:
+                if len(self._seen) >= self.seen_hours and hour < min(self._seen):
+                    continue  # Older than every tracked hour: can't tell whether it was counted
+                seen = self._seen[hour] = set()
+                while len(self._seen) > self.seen_hours:
+                    del self._seen[min(self._seen)]
+            if visit in seen:
+                continue
+            seen.add(visit)
+            _, zoom, x, y = visit
+            key = (zoom, x, y, hour)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def fold(self, rows: List[Dict[str, Any]]) -> None:
+        """Add a batch of written GeoPoint rows to the counters (geo_writer sink)"""
+        self._write(rollup(rows, self.zooms), self._new_visits(rows))
+        self.metrics["points"] += len(rows)
+
+    def fold_dwell(self, rows: List[Dict[str, Any]]) -> None:
+        """Count stationary users in the hours their updated dwell time now reaches (geo_writer dwell sink)"""
+        self._write({}, self._new_visits(rows))
+
+    def _write(self, points: Dict[CellKey, int], visitors: Dict[CellKey, int]) -> None:
+        keys = points.keys() | visitors.keys()
+        if not keys:
+            return
+        db = self.session_factory()
+        try:
+            db.execute(_upsert_statement(db.get_bind().dialect.name), [
+                {"zoom": zoom, "cell_x": x, "cell_y": y, "hour": hour,
+                 "points": points.get((zoom, x, y, hour), 0), "visitors": visitors.get((zoom, x, y, hour), 0)}
+                for zoom, x, y, hour in keys
+            ])
+            db.commit()
+            self.metrics["visits"] += sum(visitors.values())
+            self.metrics["cell_updates"] += len(keys)
+        except Exception:
+            db.rollback()
+            self.metrics["failures"] += 1
+            raise
+        finally:
+            db.close()
+
+    def prune(self, conn: Connection, today: date) -> None:
+        """Drop hours older than the retention period (geo_points maintenance step)"""
+        cutoff = datetime.combine(today - timedelta(days=self.retention_days), datetime.min.time())
+        conn.execute(delete(FootTrafficCell).where(FootTrafficCell.hour < cutoff))
+
+    def zoom_for(self, lat: float, lng: float, radius_m: int) -> int:
+        """Finest rollup zoom that covers the area in at most HEATMAP_MAX_CELLS_ACROSS cells"""
+        _, min_lng, _, max_lng = bounding_box(lat, lng, radius_m)
+        for zoom in sorted(self.zooms, reverse=True):
+            left, _ = tile_of(lat, min_lng, zoom)
+            right, _ = tile_of(lat, max_lng, zoom)
+            if right - left + 1 <= HEATMAP_MAX_CELLS_ACROSS:
+                return zoom
+        return min(self.zooms)
+
+    def heatmap(self, db: Session, lat: float, lng: float, radius_m: int, hours: int,
+                now: datetime) -> Dict[str, Any]:
+        """Cells with their visitor counts around (lat, lng) over the last `hours`, plus an hour-of-day profile
+
+        Counts are visitor-hours (a user staying three hours counts three times); a cell-hour with
+        fewer than min_visitors visitors is left out entirely.
+        """
+        zoom = self.zoom_for(lat, lng, radius_m)
+        min_lat, min_lng, max_lat, max_lng = bounding_box(lat, lng, radius_m)
+        # Tile y grows southwards
+        min_x, min_y = tile_of(max_lat, min_lng, zoom)
+        max_x, max_y = tile_of(min_lat, max_lng, zoom)
+        since = _hour_of(now) - timedelta(hours=hours - 1)
+        in_area = (
+            (FootTrafficCell.zoom == zoom)
+            & FootTrafficCell.cell_x.between(min_x, max_x)
+            & FootTrafficCell.cell_y.between(min_y, max_y)
+            & (FootTrafficCell.hour >= since)
+            & (FootTrafficCell.visitors >= self.min_visitors)
+        )
+
+        cells = []
+        for x, y, points in db.query(FootTrafficCell.cell_x, FootTrafficCell.cell_y,
+                                     func.sum(FootTrafficCell.visitors)).filter(in_area).group_by(
+                                         FootTrafficCell.cell_x, FootTrafficCell.cell_y):
+            south, west, north, east = tile_bounds(zoom, x, y)
+            cells.append({"x": x, "y": y, "min_lat": south, "min_lng": west, "max_lat": north,
+                          "max_lng": east, "count": int(points)})
+
+        by_hour_of_day = [0] * 24
+        for hour, points in db.query(FootTrafficCell.hour, func.sum(FootTrafficCell.visitors)).filter(
+                in_area).group_by(FootTrafficCell.hour):
+            by_hour_of_day[hour.hour] += int(points)
+
+        return {
+            "zoom": zoom,
+            "since": since,
+            "min_visitors": self.min_visitors,
+            "cells": cells,
+            "max_count": max((cell["count"] for cell in cells), default=0),
+            "total": sum(cell["count"] for cell in cells),
+            "by_hour_of_day": by_hour_of_day
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.metrics)
+
+
+# Shared by all requests in this process
+foot_traffic = FootTrafficAggregator()
+geo_writer.add_sink(foot_traffic.fold)
+geo_writer.add_dwell_sink(foot_traffic.fold_dwell)
+geo_maintenance.add_step(foot_traffic.prune)
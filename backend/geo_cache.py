@@ -0,0 +1,117 @@
+"""
+Geo-tiled response cache
+Shares external provider responses between users standing in the same geo tile.
+
+- Keys are usually geo_utils.tile_key() tiles so nearby requests map to one entry
+- StaleWhileRevalidateCache serves fresh entries directly, serves stale entries while a
+  background refresh runs, and only blocks callers on a true miss
+- Hit/miss counters are tracked per tile level so each range bucket can be tuned separately
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheEntry:
+    __slots__ = ("value", "stored_at", "refreshing")
+
+    def __init__(self, value: Any, stored_at: float):
+        self.value = value
+        self.stored_at = stored_at
+        self.refreshing = False
+
+
+class StaleWhileRevalidateCache:
+    """In-process LRU cache that serves stale values while refreshing them in the background"""
+
+    def __init__(self, name: str, fresh_ttl: float, stale_ttl: float, max_entries: int = 1024):
+        self.name = name
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, _CacheEntry]" = OrderedDict()
+        self._metrics: Dict[str, Dict[str, int]] = {}
+        self._background_tasks = set()
+
+    def _count(self, level: Hashable, metric: str) -> None:
+        level_metrics = self._metrics.setdefault(str(level), {
+            "hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0
+        })
+        level_metrics[metric] += 1
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = _CacheEntry(value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _refresh(self, key: Hashable, level: Hashable, fetcher: Callable[[], Awaitable[Any]]) -> None:
+        entry = self._entries.get(key)
+        try:
+            value = await fetcher()
+            self._store(key, value)
+            self._count(level, "refreshes")
+        except Exception as e:
+            # Keep serving the stale value until it ages out completely
+            self._count(level, "refresh_errors")
+            logger.warning(f"Background refresh failed for {self.name} tile {key}: {e}")
+        finally:
+            if entry is not None:
+                entry.refreshing = False
+
+    def _schedule_refresh(self, key: Hashable, level: Hashable, entry: _CacheEntry,
+                          fetcher: Callable[[], Awaitable[Any]]) -> None:
+        if entry.refreshing:
+            return
+        entry.refreshing = True
+        task = asyncio.get_running_loop().create_task(self._refresh(key, level, fetcher))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Get a cached value regardless of age, without touching metrics"""
+        entry = self._entries.get(key)
+        return entry.value if entry is not None else None
+
+    async def get_or_fetch(self, key: Hashable, level: Hashable, fetcher: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value for key, fetching or revalidating it as needed"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.stored_at
+            if age < self.fresh_ttl:
+                self._entries.move_to_end(key)
+                self._count(level, "hits")
+                return entry.value
+            if age < self.fresh_ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self._count(level, "stale_hits")
+                self._schedule_refresh(key, level, entry, fetcher)
+                return entry.value
+            del self._entries[key]
+
+        self._count(level, "misses")
+        value = await fetcher()
+        self._store(key, value)
+        return value
+
+    def clear(self) -> None:
+        """Drop all cached entries (metrics are kept)"""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Get cache size and per-level hit/miss counters"""
+        levels = {}
+        for level, counters in self._metrics.items():
+            lookups = counters["hits"] + counters["stale_hits"] + counters["misses"]
+            levels[level] = dict(counters, hit_ratio=round((counters["hits"] + counters["stale_hits"]) / lookups, 3) if lookups else 0.0)
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "fresh_ttl_seconds": self.fresh_ttl,
+            "stale_ttl_seconds": self.stale_ttl,
+            "levels": levels
+        }
@@ -0,0 +1,262 @@
+"""
+Time partitioning, retention and compaction for geo_points
+Keeps location history from growing into one ever larger table: inserts only touch the current
+day's partition, old days are dropped whole, and older history is kept as coarser trajectories.
+
+- PostgreSQL: geo_points is a native partitioned table (RANGE on timestamp, see
+  supabase_schema.sql) with one geo_points_pYYYYMMDD partition per day, created
+  GEO_PARTITION_PREMAKE_DAYS ahead; a DEFAULT partition catches anything outside them. Each day is
+  created in its own transaction; rows the DEFAULT partition already holds for that day (e.g. after
+  maintenance was down) are moved into a new table that is then attached as the day's partition
+- SQLite: geo_points is the live table for the current day; rows from earlier days are moved
+  into rotating geo_points_pYYYYMMDD tables, so the live table stays one day small
+- Retention: partitions older than GEO_RETENTION_DAYS are dropped with DROP TABLE (no row deletes);
+  only rows left in the DEFAULT partition are deleted
+- Compaction: partitions older than GEO_COMPACT_AFTER_DAYS are downsampled in SQL to one point per
+  user per GEO_COMPACT_BUCKET_MINUTES (mean position, summed dwell time) and marked with a "c" suffix
+- Other modules can add steps (foot_traffic.py prunes its rollups)
+- Runs every GEO_MAINTENANCE_SECONDS in the local server; `python geo_retention.py` runs it once
+  (e.g. from cron where there is no long-running process)
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+from datetime import date, datetime, time as dt_time, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import Column, MetaData, Table, delete, func, insert, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from models import GeoPoint
+from supabase_client import engine as default_engine
+
+logger = logging.getLogger(__name__)
+
+GEO_RETENTION_DAYS = int(os.getenv("GEO_RETENTION_DAYS", "90"))
+GEO_COMPACT_AFTER_DAYS = int(os.getenv("GEO_COMPACT_AFTER_DAYS", "7"))
+GEO_COMPACT_BUCKET_MINUTES = int(os.getenv("GEO_COMPACT_BUCKET_MINUTES", "10"))
+GEO_PARTITION_PREMAKE_DAYS = 2
+GEO_MAINTENANCE_SECONDS = float(os.getenv("GEO_MAINTENANCE_SECONDS", "3600"))
+
+PARTITION_PREFIX = "geo_points_p"
+PARTITION_PATTERN = re.compile(r"^geo_points_p(\d{8})(c?)$")
+DEFAULT_PARTITION = "geo_points_default"
+
+
+class GeoPartition:
+    __slots__ = ("name", "day", "compacted")
+
+    def __init__(self, name: str, day: date, compacted: bool):
+        self.name = name
+        self.day = day
+        self.compacted = compacted
+
+
+def partition_name(day: date, compacted: bool = False) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}{'c' if compacted else ''}"
+
+
+class GeoPointMaintenance:
+    """Creates, rotates, compacts and drops geo_points day partitions"""
+
+    def __init__(self, engine: Engine = default_engine, retention_days: int = GEO_RETENTION_DAYS,
+                 compact_after_days: int = GEO_COMPACT_AFTER_DAYS,
+                 bucket_minutes: int = GEO_COMPACT_BUCKET_MINUTES):
+        self.engine = engine
+        self.retention_days = retention_days
+        self.compact_after_days = compact_after_days
+        self.bucket_minutes = bucket_minutes
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self.last_run: Optional[datetime] = None
+        self._extra_steps: List[Callable[[Connection, date], None]] = []
+        self.metrics = {"runs": 0, "created": 0, "rotated_rows": 0, "compacted": 0,
+                        "compacted_rows_removed": 0, "dropped": 0, "dropped_default_rows": 0, "failures": 0}
+
+    @property
+    def is_postgres(self) -> bool:
+        return self.engine.dialect.name == "postgresql"
+
+    def _table(self, name: str) -> Table:
+        # Partitions share geo_points' columns (archived days don't need the users foreign key)
+        return Table(name, MetaData(), *(Column(column.name, column.type, primary_key=column.primary_key,
+                                                nullable=column.nullable)
+                                         for column in GeoPoint.__table__.columns))
+
+    def partitions(self, conn: Connection) -> List[GeoPartition]:
+        found = []
+        for name in inspect(conn).get_table_names():
+            match = PARTITION_PATTERN.match(name)
+            if match:
+                found.append(GeoPartition(name, datetime.strptime(match.group(1), "%Y%m%d").date(),
+                                          bool(match.group(2))))
+        return sorted(found, key=lambda partition: partition.day)
+
+    def _is_partitioned(self, conn: Connection) -> bool:
+        return conn.execute(text(
+            "SELECT c.relkind = 'p' FROM pg_class c WHERE c.relname = 'geo_points' "
+            "AND c.relnamespace = to_regnamespace(current_schema())::oid"
+        )).scalar() is True
+
+    def ensure_partitions(self, conn: Connection, today: date) -> None:
+        """PostgreSQL: create today's and the next days' partitions. SQLite: rotate the live table"""
+        if not self.is_postgres:
+            self._rotate_live_table(conn, today)
+            return
+        existing = {partition.day for partition in self.partitions(conn)}
+        days = {today + timedelta(days=offset) for offset in range(GEO_PARTITION_PREMAKE_DAYS + 1)}
+        # Days that landed in the DEFAULT partition (maintenance was down) get their partition too
+        days.update(conn.execute(text(
+            f"SELECT DISTINCT CAST(timestamp AS date) FROM {DEFAULT_PARTITION} WHERE timestamp >= :cutoff"
+        ), {"cutoff": today - timedelta(days=self.retention_days)}).scalars())
+        conn.commit()
+        for day in sorted(days - existing):
+            # Own transaction per day, so one failing day doesn't block the others
+            try:
+                self._create_partition(conn, day)
+                conn.commit()
+                self.metrics["created"] += 1
+            except Exception as e:
+                conn.rollback()
+                self.metrics["failures"] += 1
+                logger.error(f"Creating GeoPoint partition {partition_name(day)} failed: {e}")
+
+    def _create_partition(self, conn: Connection, day: date) -> None:
+        name = partition_name(day)
+        start, end = day.isoformat(), (day + timedelta(days=1)).isoformat()
+        in_day = f"timestamp >= '{start}' AND timestamp < '{end}'"
+        # Lock first so no rows for the day can land in the DEFAULT partition between the check and the move
+        conn.execute(text(f"LOCK TABLE {DEFAULT_PARTITION} IN SHARE ROW EXCLUSIVE MODE"))
+        if conn.execute(text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_day} LIMIT 1")).first() is None:
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF geo_points "
+                              f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+            return
+        # CREATE ... PARTITION OF would violate the DEFAULT partition's constraint: move the day's
+        # rows into a standalone table, then attach it (ATTACH creates the parent's indexes on it)
+        conn.execute(text(f"CREATE TABLE {name} (LIKE geo_points INCLUDING DEFAULTS)"))
+        # Matches the partition bounds, so ATTACH can skip its validation scan
+        conn.execute(text(f"ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK ({in_day})"))
+        moved = conn.execute(text(f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE {in_day}")).rowcount
+        conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_day}"))
+        conn.execute(text(f"ALTER TABLE geo_points ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"))
+        conn.execute(text(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds"))
+        logger.info(f"Moved {moved} GeoPoint rows from {DEFAULT_PARTITION} into new partition {name}")
+
+    def _rotate_live_table(self, conn: Connection, today: date) -> None:
+        live = GeoPoint.__table__
+        today_start = datetime.combine(today, dt_time.min)
+        oldest = conn.execute(select(func.min(live.c.timestamp))).scalar()
+        if oldest is None or oldest >= today_start:
+            return
+        # Normally one day of rows; more if the server was down over several midnights
+        day = oldest.date()
+        existing = {partition.day: partition for partition in self.partitions(conn)}
+        while day < today:
+            start = datetime.combine(day, dt_time.min)
+            end = start + timedelta(days=1)
+            in_day = (live.c.timestamp >= start) & (live.c.timestamp < end)
+            if conn.execute(select(func.count()).select_from(live).where(in_day)).scalar():
+                # Late rows for an already rotated (or compacted) day are appended to it
+                target = self._table(existing[day].name if day in existing else partition_name(day))
+                target.create(conn, checkfirst=True)
+                result = conn.execute(insert(target).from_select([c.name for c in live.c], select(live).where(in_day)))
+                self.metrics["rotated_rows"] += result.rowcount or 0
+            day += timedelta(days=1)
+        conn.execute(delete(live).where(live.c.timestamp < today_start))
+
+    def drop_expired(self, conn: Connection, today: date) -> None:
+        cutoff = today - timedelta(days=self.retention_days)
+        for partition in self.partitions(conn):
+            if partition.day < cutoff:
+                conn.execute(text(f"DROP TABLE IF EXISTS {partition.name}"))
+                self.metrics["dropped"] += 1
+                logger.info(f"Dropped GeoPoint partition {partition.name}")
+        if self.is_postgres:
+            # Stragglers in the DEFAULT partition are the only rows retention deletes one by one
+            result = conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp < :cutoff"),
+                                  {"cutoff": cutoff.isoformat()})
+            self.metrics["dropped_default_rows"] += result.rowcount or 0
+
+    def _bucket_sql(self) -> str:
+        seconds = self.bucket_minutes * 60
+        if self.is_postgres:
+            return f"floor(extract(epoch FROM timestamp) / {seconds})"
+        return f"CAST(strftime('%s', timestamp) AS INTEGER) / {seconds}"
+
+    def compact(self, conn: Connection, today: date) -> None:
+        cutoff = today - timedelta(days=self.compact_after_days)
+        # One point per user per bucket: first timestamp (and smallest id), mean position, summed dwell
+        first_id = "CAST(min(CAST(id AS text)) AS uuid)" if self.is_postgres else "min(id)"
+        columns = "id, user_id, latitude, longitude, timestamp, dwell_seconds"
+        for partition in self.partitions(conn):
+            if partition.compacted or partition.day >= cutoff:
+                continue
+            before = conn.execute(text(f"SELECT count(*) FROM {partition.name}")).scalar()
+            conn.execute(text(
+                f"CREATE TEMPORARY TABLE geo_points_compacting AS "
+                f"SELECT {first_id} AS id, user_id, avg(latitude) AS latitude, avg(longitude) AS longitude, "
+                f"min(timestamp) AS timestamp, coalesce(sum(dwell_seconds), 0) AS dwell_seconds "
+                f"FROM {partition.name} GROUP BY user_id, {self._bucket_sql()}"
+            ))
+            conn.execute(text(f"DELETE FROM {partition.name}"))
+            after = conn.execute(text(
+                f"INSERT INTO {partition.name} ({columns}) SELECT {columns} FROM geo_points_compacting"
+            )).rowcount
+            conn.execute(text("DROP TABLE geo_points_compacting"))
+            conn.execute(text(f"ALTER TABLE {partition.name} RENAME TO {partition_name(partition.day, True)}"))
+            self.metrics["compacted"] += 1
+            self.metrics["compacted_rows_removed"] += before - after
+            logger.info(f"Compacted GeoPoint partition {partition.name}: {before} -> {after} points")
+
+    def add_step(self, step: Callable[[Connection, date], None]) -> None:
+        """Also run step(conn, today) on every pass, e.g. retention of tables derived from geo_points"""
+        self._extra_steps.append(step)
+
+    def run(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """One maintenance pass (blocking); each step runs in its own transaction(s)"""
+        today = (now or datetime.now()).date()
+        with self._lock:
+            if self.is_postgres:
+                with self.engine.connect() as conn:
+                    if not self._is_partitioned(conn):
+                        logger.warning("geo_points is not partitioned; run the migration in supabase_schema.sql")
+                        return self.stats()
+            for step in (self.ensure_partitions, self.drop_expired, self.compact, *self._extra_steps):
+                try:
+                    # A step may commit part of its work itself (ensure_partitions commits per day)
+                    with self.engine.connect() as conn:
+                        step(conn, today)
+                        conn.commit()
+                except Exception as e:
+                    self.metrics["failures"] += 1
+                    logger.error(f"GeoPoint maintenance step {step.__name__} failed: {e}")
+            self.metrics["runs"] += 1
+            self.last_run = datetime.now()
+        return self.stats()
+
+    def start(self) -> None:
+        """Run maintenance every GEO_MAINTENANCE_SECONDS on the current event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.run)
+            except Exception as e:
+                logger.error(f"GeoPoint maintenance failed: {e}")
+            await asyncio.sleep(GEO_MAINTENANCE_SECONDS)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.metrics, "last_run": self.last_run}
+
+
+# Shared by all requests in this process
+geo_maintenance = GeoPointMaintenance()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(geo_maintenance.run())
@@ -0,0 +1,106 @@
+"""
+Geographic helpers shared by the coupon services
+Distance math and fixed-size grid tiles used for caching and indexing.
+"""
+import math
+from typing import List, Tuple
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE_LAT = 111320.0
+
+
+def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Calculate distance between two points using Haversine formula"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = math.radians(lat2 - lat1)
+    delta_lng = math.radians(lng2 - lng1)
+
+    a = (math.sin(delta_lat / 2) ** 2 +
+         math.cos(lat1_rad) * math.cos(lat2_rad) *
+         math.sin(delta_lng / 2) ** 2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+    return EARTH_RADIUS_M * c
+
+
+def bounding_box(lat: float, lng: float, radius_m: float) -> Tuple[float, float, float, float]:
+    """(min_lat, min_lng, max_lat, max_lng) of the box around a search circle"""
+    lat_delta = radius_m / METERS_PER_DEGREE_LAT
+    lng_delta = radius_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+    return lat - lat_delta, lng - lng_delta, lat + lat_delta, lng + lng_delta
+
+
+def destination_point(lat: float, lng: float, distance_m: float, bearing_rad: float) -> Tuple[float, float]:
+    """Get the point distance_m away from (lat, lng) along the given bearing"""
+    distance_rad = distance_m / EARTH_RADIUS_M
+    lat1 = math.radians(lat)
+    lng1 = math.radians(lng)
+
+    lat2 = math.asin(math.sin(lat1) * math.cos(distance_rad) +
+                     math.cos(lat1) * math.sin(distance_rad) * math.cos(bearing_rad))
+    lng2 = lng1 + math.atan2(math.sin(bearing_rad) * math.sin(distance_rad) * math.cos(lat1),
+                             math.cos(distance_rad) - math.sin(lat1) * math.sin(lat2))
+
+    return math.degrees(lat2), math.degrees(lng2)
+
+
+def _lng_step(tile_size_m: int, row: int) -> float:
+    # Use the row's center latitude so every point in the row shares the same column width
+    row_center_lat = (row + 0.5) * tile_size_m / METERS_PER_DEGREE_LAT
+    return tile_size_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(row_center_lat)), 0.01))
+
+
+def tile_key(lat: float, lng: float, tile_size_m: int) -> Tuple[int, int, int]:
+    """Snap a coordinate to the (tile_size_m, row, col) tile that contains it"""
+    row = math.floor(lat / (tile_size_m / METERS_PER_DEGREE_LAT))
+    col = math.floor(lng / _lng_step(tile_size_m, row))
+    return (tile_size_m, row, col)
+
+
+def tile_center(key: Tuple[int, int, int]) -> Tuple[float, float]:
+    """Get the center coordinate of a tile returned by tile_key()"""
+    tile_size_m, row, col = key
+    return (row + 0.5) * tile_size_m / METERS_PER_DEGREE_LAT, (col + 0.5) * _lng_step(tile_size_m, row)
+
+
+def decode_polyline(encoded: str, precision: int = 5) -> List[Tuple[float, float]]:
+    """Decode a Google encoded polyline into (lat, lng) points"""
+    points = []
+    index = lat = lng = 0
+    factor = 10 ** precision
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                if index >= len(encoded):
+                    raise ValueError("Truncated polyline")
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+    return points
+
+
+def distance_to_segment(lat: float, lng: float, start: Tuple[float, float],
+                        end: Tuple[float, float]) -> Tuple[float, float]:
+    """
+    (distance, offset) in meters from a point to the segment start-end, where offset is how far
+    along the segment the closest point lies. Uses a local flat projection (fine for segments of
+    a few km).
+    """
+    scale_lng = METERS_PER_DEGREE_LAT * math.cos(math.radians(start[0]))
+    seg_x = (end[1] - start[1]) * scale_lng
+    seg_y = (end[0] - start[0]) * METERS_PER_DEGREE_LAT
+    pt_x = (lng - start[1]) * scale_lng
+    pt_y = (lat - start[0]) * METERS_PER_DEGREE_LAT
+    length_sq = seg_x * seg_x + seg_y * seg_y
+    t = 0.0 if length_sq == 0 else max(0.0, min(1.0, (pt_x * seg_x + pt_y * seg_y) / length_sq))
+    return math.hypot(pt_x - t * seg_x, pt_y - t * seg_y), t * math.sqrt(length_sq)
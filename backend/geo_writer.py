@@ -0,0 +1,309 @@
+"""
+Buffered GeoPoint writer
+Location tracking on /api/coupons used to INSERT + commit + refresh a GeoPoint on every poll.
+Points are now queued in memory and written in batches by a background task, off the read path.
+
+- The queue holds at most GEO_WRITE_QUEUE_SIZE points; when it is full the oldest point is
+  dropped (the newest positions matter most for tracking and prefetch) and counted
+- A flush runs every GEO_WRITE_FLUSH_SECONDS, or as soon as GEO_WRITE_BATCH_SIZE points are
+  waiting, as one multi-row INSERT per batch in a worker thread
+- A failed batch is put back at the front of the queue (space permitting) and retried on the
+  next flush
+- close() flushes whatever is left; it is called on application shutdown
+- Polls are sampled per user first (LocationSampler): a position within GEO_SAMPLE_MIN_DISTANCE_M
+  of the user's last stored point adds no row, it extends that point's dwell_seconds instead
+  (written at most every GEO_SAMPLE_MAX_INTERVAL_SECONDS, and when the user moves on)
+- Sinks (foot_traffic.py) receive every batch once it is committed, and dwell sinks every set of
+  dwell updates (the updated points with their new dwell_seconds)
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.orm import Session
+
+from geo_utils import calculate_distance
+from models import GeoPoint
+from supabase_client import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+GEO_WRITE_QUEUE_SIZE = int(os.getenv("GEO_WRITE_QUEUE_SIZE", "10000"))
+GEO_WRITE_BATCH_SIZE = int(os.getenv("GEO_WRITE_BATCH_SIZE", "500"))
+GEO_WRITE_FLUSH_SECONDS = float(os.getenv("GEO_WRITE_FLUSH_SECONDS", "2"))
+GEO_SAMPLE_MIN_DISTANCE_M = float(os.getenv("GEO_SAMPLE_MIN_DISTANCE_M", "25"))  # 0 stores every poll
+GEO_SAMPLE_MAX_INTERVAL_SECONDS = float(os.getenv("GEO_SAMPLE_MAX_INTERVAL_SECONDS", "60"))
+GEO_SAMPLE_MAX_USERS = 50000
+
+# (point id, point timestamp, dwell seconds, point latitude, point longitude) to write for an already
+# stored point; the timestamp lets PostgreSQL prune the update to the point's partition (geo_retention.py)
+DwellUpdate = Tuple[str, datetime, int, float, float]
+
+
+class _Anchor:
+    """A user's last stored point and how long they have stayed near it"""
+
+    __slots__ = ("point_id", "lat", "lng", "timestamp", "last_seen", "reported_at")
+
+    def __init__(self, point_id: str, lat: float, lng: float, timestamp: datetime):
+        self.point_id = point_id
+        self.lat = lat
+        self.lng = lng
+        self.timestamp = timestamp
+        self.last_seen = timestamp
+        self.reported_at = timestamp
+
+    def dwell(self) -> DwellUpdate:
+        return (self.point_id, self.timestamp, int((self.last_seen - self.timestamp).total_seconds()),
+                self.lat, self.lng)
+
+
+class LocationSampler:
+    """Decides which polls become GeoPoint rows, keeping an LRU of each user's last stored point"""
+
+    def __init__(self, min_distance_m: float = GEO_SAMPLE_MIN_DISTANCE_M,
+                 max_interval_seconds: float = GEO_SAMPLE_MAX_INTERVAL_SECONDS,
+                 max_users: int = GEO_SAMPLE_MAX_USERS):
+        self.min_distance_m = min_distance_m
+        self.max_interval_seconds = max_interval_seconds
+        self.max_users = max_users
+        self._anchors: "OrderedDict[str, _Anchor]" = OrderedDict()
+
+    def observe(self, user_id: str, point_id: str, lat: float, lng: float,
+                timestamp: datetime) -> Tuple[bool, Optional[DwellUpdate]]:
+        """Whether to store this poll as point_id, and a dwell update to write for an earlier point"""
+        anchor = self._anchors.get(user_id)
+        if anchor is None or calculate_distance(anchor.lat, anchor.lng, lat, lng) >= self.min_distance_m:
+            # Moved on (or first seen): new point, and close out how long they stayed at the last one
+            dwell = anchor.dwell() if anchor is not None and anchor.last_seen > anchor.reported_at else None
+            self._anchors[user_id] = _Anchor(point_id, lat, lng, timestamp)
+            self._anchors.move_to_end(user_id)
+            while len(self._anchors) > self.max_users:
+                # An evicted user's dwell is at most max_interval_seconds out of date
+                self._anchors.popitem(last=False)
+            return True, dwell
+
+        anchor.last_seen = timestamp
+        self._anchors.move_to_end(user_id)
+        if (timestamp - anchor.reported_at).total_seconds() >= self.max_interval_seconds:
+            anchor.reported_at = timestamp
+            return False, anchor.dwell()
+        return False, None
+
+    def __len__(self) -> int:
+        return len(self._anchors)
+
+
+class GeoPointWriter:
+    """Bounded in-memory queue of GeoPoint rows, flushed in batches"""
+
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal,
+                 max_queue: int = GEO_WRITE_QUEUE_SIZE, batch_size: int = GEO_WRITE_BATCH_SIZE,
+                 flush_seconds: float = GEO_WRITE_FLUSH_SECONDS, sampler: Optional[LocationSampler] = None):
+        self.session_factory = session_factory
+        self.sampler = sampler if sampler is not None else LocationSampler()
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._pending: Dict[str, Dict[str, Any]] = {}  # Queued rows by id, for dwell updates before insert
+        # Dwell updates for rows already written: id -> (timestamp, seconds, user_id, latitude, longitude)
+        self._dwell: Dict[str, Tuple[datetime, int, str, float, float]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closed = False
+        self._sinks: List[Callable[[List[Dict[str, Any]]], None]] = []
+        self._dwell_sinks: List[Callable[[List[Dict[str, Any]]], None]] = []
+        self.metrics = {"polls": 0, "sampled_out": 0, "queued": 0, "written": 0, "dwell_updates": 0,
+                        "dropped": 0, "batches": 0, "failures": 0, "max_depth": 0, "last_flush_ms": 0.0}
+
+    def add_sink(self, sink: Callable[[List[Dict[str, Any]]], None]) -> None:
+        """Call sink(rows) with every batch of GeoPoint rows after it is written (in the flushing thread)"""
+        self._sinks.append(sink)
+
+    def add_dwell_sink(self, sink: Callable[[List[Dict[str, Any]]], None]) -> None:
+        """Call sink(rows) with the points whose dwell_seconds were updated, after the update is written"""
+        self._dwell_sinks.append(sink)
+
+    def add_location_point(self, user_id: str, latitude: float, longitude: float) -> datetime:
+        """Sample a polled location and queue what needs writing; returns the poll's timestamp"""
+        return self.record(user_id, latitude, longitude, datetime.now())
+
+    def record(self, user_id: str, latitude: float, longitude: float, timestamp: datetime) -> datetime:
+        """add_location_point with the poll time given (replays, benchmarks)"""
+        point_id = str(uuid.uuid4())
+        with self._lock:
+            self.metrics["polls"] += 1
+            store, dwell = self.sampler.observe(user_id, point_id, latitude, longitude, timestamp)
+            if dwell is not None:
+                self._queue_dwell_locked(user_id, *dwell)
+            if store:
+                if len(self._queue) >= self.max_queue:
+                    self._pending.pop(self._queue.popleft()["id"], None)
+                    self.metrics["dropped"] += 1
+                row = {"id": point_id, "user_id": user_id, "latitude": latitude, "longitude": longitude,
+                       "timestamp": timestamp, "dwell_seconds": 0}
+                self._queue.append(row)
+                self._pending[point_id] = row
+                self.metrics["queued"] += 1
+            else:
+                self.metrics["sampled_out"] += 1
+            depth = len(self._queue)
+            self.metrics["max_depth"] = max(self.metrics["max_depth"], depth)
+
+        if self._closed:
+            # Shutting down: nothing will flush later
+            self.flush()
+        else:
+            self._ensure_flusher()
+            if depth >= self.batch_size and self._wakeup is not None:
+                self._wakeup.set()
+        return timestamp
+
+    def _queue_dwell_locked(self, user_id: str, point_id: str, timestamp: datetime, seconds: int,
+                            latitude: float, longitude: float) -> None:
+        row = self._pending.get(point_id)
+        if row is not None:
+            row["dwell_seconds"] = seconds  # Not inserted yet: goes in with the row
+        else:
+            self._dwell[point_id] = (timestamp, seconds, user_id, latitude, longitude)
+        self.metrics["dwell_updates"] += 1
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"GeoPoint flush failed: {e}")
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            count = min(self.batch_size, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(count)]
+            for row in batch:
+                self._pending.pop(row["id"], None)
+            return batch
+
+    def _requeue(self, batch: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            room = self.max_queue - len(self._queue)
+            kept = batch[-room:] if room > 0 else []
+            self._queue.extendleft(reversed(kept))
+            for row in kept:
+                # Dwell updates that arrived while the batch was in flight go back into the row
+                update_values = self._dwell.pop(row["id"], None)
+                if update_values is not None:
+                    row["dwell_seconds"] = update_values[1]
+                self._pending[row["id"]] = row
+            self.metrics["dropped"] += len(batch) - len(kept)
+
+    def flush(self) -> int:
+        """Write everything queued so far (blocking); returns the number of points written"""
+        written = 0
+        failed = False
+        with self._flush_lock:
+            started = time.perf_counter()
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                db = self.session_factory()
+                try:
+                    db.execute(insert(GeoPoint), batch)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    self.metrics["failures"] += 1
+                    self._requeue(batch)
+                    logger.warning(f"Failed to write {len(batch)} GeoPoints, will retry: {e}")
+                    failed = True
+                    break
+                finally:
+                    db.close()
+                written += len(batch)
+                self.metrics["batches"] += 1
+                for sink in self._sinks:
+                    try:
+                        sink(batch)
+                    except Exception as e:
+                        logger.error(f"GeoPoint sink failed: {e}")
+            if not failed:
+                self._flush_dwell()
+            self.metrics["written"] += written
+            if written:
+                self.metrics["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return written
+
+    def _flush_dwell(self) -> None:
+        with self._lock:
+            updates, self._dwell = self._dwell, {}
+        if not updates:
+            return
+        db = self.session_factory()
+        try:
+            # One executemany UPDATE for the whole set, keyed on id and timestamp
+            statement = update(GeoPoint.__table__).where(
+                GeoPoint.__table__.c.id == bindparam("point_id"),
+                GeoPoint.__table__.c.timestamp == bindparam("point_timestamp")
+            ).values(dwell_seconds=bindparam("seconds"))
+            db.execute(statement, [{"point_id": point_id, "point_timestamp": timestamp, "seconds": seconds}
+                                   for point_id, (timestamp, seconds, *_) in updates.items()])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.metrics["failures"] += 1
+            with self._lock:
+                for point_id, update_values in updates.items():
+                    self._dwell.setdefault(point_id, update_values)
+            logger.warning(f"Failed to update {len(updates)} GeoPoint dwell times, will retry: {e}")
+            return
+        finally:
+            db.close()
+        rows = [{"id": point_id, "user_id": user_id, "latitude": latitude, "longitude": longitude,
+                 "timestamp": timestamp, "dwell_seconds": seconds}
+                for point_id, (timestamp, seconds, user_id, latitude, longitude) in updates.items()]
+        for sink in self._dwell_sinks:
+            try:
+                sink(rows)
+            except Exception as e:
+                logger.error(f"GeoPoint dwell sink failed: {e}")
+
+    async def close(self) -> None:
+        """Stop the background flusher and write what is left"""
+        self._closed = True
+        if self._flusher is not None:
+            self._wakeup.set()
+            try:
+                await self._flusher
+            except Exception as e:
+                logger.error(f"GeoPoint flusher failed: {e}")
+            self._flusher = None
+        await asyncio.to_thread(self.flush)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.metrics, "queue_depth": len(self._queue), "queue_capacity": self.max_queue,
+                    "pending_dwell_updates": len(self._dwell), "sampled_users": len(self.sampler)}
+
+
+# Shared by all requests in this process
+geo_writer = GeoPointWriter()
@@ -0,0 +1,307 @@
+"""
+Geofence matching for "coupon nearby" notifications (RDD 4.3)
+Each store with active coupons is a geofence of OBTAIN_RADIUS_METERS (the distance within which a
+coupon can be obtained); location updates are matched against them and users entering a fence
+are notified of its coupons.
+
+- Fences are kept in a GEOFENCE_CELL_DEGREES grid; a fence is registered in every cell its circle
+  overlaps, so matching a location is one dict lookup plus distance checks on a few fences
+- Maintained incrementally from the spatial index's change events (internal coupons only)
+- Only fences the user was not already inside trigger; each (user, coupon) is notified at most
+  once per GEOFENCE_DEDUPE_SECONDS, and never after the user obtained the coupon
+- Notifications are queued (bounded, NOTIFICATION_QUEUE_SIZE) and handed to a pluggable
+  NotificationSender in batches by a background task; LogNotificationSender is the local
+  stand-in and appends JSON lines to GEOFENCE_NOTIFICATION_LOG (or logs them)
+- A batch the sender fails on is put back at the front of the queue (space permitting) and
+  retried on the next delivery
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from change_log import ChangeEvent, CouponChangeLog, coupon_change_log
+from external_coupons import JST
+from geo_utils import bounding_box, calculate_distance
+from spatial_index import CouponSpatialIndex, IndexedCoupon, coupon_index
+
+logger = logging.getLogger(__name__)
+
+# Users must be this close to a store to obtain its coupons (see obtain_coupon)
+OBTAIN_RADIUS_METERS = 200
+
+GEOFENCE_ENABLED = os.getenv("GEOFENCE_NOTIFICATIONS", "true").lower() == "true"
+GEOFENCE_CELL_DEGREES = 0.002  # ~220m, about one obtain radius
+GEOFENCE_DEDUPE_SECONDS = float(os.getenv("GEOFENCE_DEDUPE_SECONDS", "21600"))
+GEOFENCE_MAX_USERS = 100000
+GEOFENCE_MAX_NOTIFIED = 500000
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", "10000"))
+NOTIFICATION_FLUSH_SECONDS = 1.0
+NOTIFICATION_BATCH_SIZE = 500
+
+
+class Fence:
+    """A store's obtain radius and its active coupons"""
+
+    __slots__ = ("store_id", "lat", "lng", "cells", "coupons")
+
+    def __init__(self, store_id: str, lat: float, lng: float, cells: List[Tuple[int, int]]):
+        self.store_id = store_id
+        self.lat = lat
+        self.lng = lng
+        self.cells = cells
+        self.coupons: Dict[str, IndexedCoupon] = {}
+
+
+class Notification:
+    __slots__ = ("user_id", "coupon_id", "store_id", "shop_name", "title", "discount", "distance_m", "created_at")
+
+    def __init__(self, user_id: str, coupon: IndexedCoupon, discount: int, distance_m: float, created_at: datetime):
+        self.user_id = user_id
+        self.coupon_id = coupon.id
+        self.store_id = coupon.store_id
+        self.shop_name = coupon.shop_name
+        self.title = coupon.title
+        self.discount = discount
+        self.distance_m = distance_m
+        self.created_at = created_at
+
+    @property
+    def message(self) -> str:
+        return f"{self.shop_name}の{self.discount}%OFFクーポンが近くにあります"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "user_id": self.user_id,
+            "coupon_id": self.coupon_id,
+            "store_id": self.store_id,
+            "title": self.title,
+            "message": self.message,
+            "discount": self.discount,
+            "distance_meters": round(self.distance_m, 1),
+            "created_at": self.created_at.isoformat()
+        }
+
+
+class NotificationSender:
+    """Delivers notifications (push service, etc.); send() is called from a worker thread"""
+
+    def send(self, notifications: List[Notification]) -> None:
+        raise NotImplementedError
+
+
+class LogNotificationSender(NotificationSender):
+    """Local stand-in: appends JSON lines to a file, or logs them when no path is set"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+
+    def send(self, notifications: List[Notification]) -> None:
+        lines = [json.dumps(notification.to_dict(), ensure_ascii=False) for notification in notifications]
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        else:
+            for line in lines:
+                logger.info(f"Notification: {line}")
+
+
+class GeofenceEngine:
+    """Matches location updates against store geofences and queues entry notifications"""
+
+    def __init__(self, index: CouponSpatialIndex, sender: NotificationSender,
+                 change_log: Optional[CouponChangeLog] = None, radius_m: float = OBTAIN_RADIUS_METERS,
+                 cell_degrees: float = GEOFENCE_CELL_DEGREES, enabled: bool = GEOFENCE_ENABLED):
+        self.index = index
+        self.sender = sender
+        self.radius_m = radius_m
+        self.cell_degrees = cell_degrees
+        self.enabled = enabled
+        self._fences: Dict[str, Fence] = {}
+        self._grid: Dict[Tuple[int, int], Dict[str, Fence]] = {}
+        self._inside: "OrderedDict[str, Set[str]]" = OrderedDict()  # user -> store ids
+        self._notified: "OrderedDict[Tuple[str, str], float]" = OrderedDict()  # (user, coupon) -> until
+        self._queue: Deque[Notification] = deque()
+        self._lock = threading.Lock()
+        self._sender_task: Optional[asyncio.Task] = None
+        self.metrics = {"events": 0, "entered": 0, "queued": 0, "deduplicated": 0, "dropped": 0,
+                        "sent": 0, "send_failures": 0}
+        index.add_listener(self._on_change)
+        if change_log is not None:
+            change_log.add_sink(self._on_change_event)
+        self._rebuild()
+
+    def set_sender(self, sender: NotificationSender) -> None:
+        self.sender = sender
+
+    def _cell_of(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    # Fence maintenance (spatial index listener)
+
+    def _add_locked(self, entry: IndexedCoupon) -> None:
+        if entry.is_external or entry.store_id is None:
+            return
+        fence = self._fences.get(entry.store_id)
+        if fence is not None and (fence.lat, fence.lng) != (entry.lat, entry.lng):
+            self._remove_fence_locked(fence)  # Store moved
+            fence = None
+        if fence is None:
+            min_lat, min_lng, max_lat, max_lng = bounding_box(entry.lat, entry.lng, self.radius_m)
+            min_row, min_col = self._cell_of(min_lat, min_lng)
+            max_row, max_col = self._cell_of(max_lat, max_lng)
+            cells = [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+            fence = Fence(entry.store_id, entry.lat, entry.lng, cells)
+            self._fences[entry.store_id] = fence
+            for cell in cells:
+                self._grid.setdefault(cell, {})[entry.store_id] = fence
+        fence.coupons[entry.id] = entry
+
+    def _remove_fence_locked(self, fence: Fence) -> None:
+        self._fences.pop(fence.store_id, None)
+        for cell in fence.cells:
+            members = self._grid.get(cell)
+            if members is not None:
+                members.pop(fence.store_id, None)
+                if not members:
+                    del self._grid[cell]
+
+    def _discard_locked(self, entry: IndexedCoupon) -> None:
+        fence = self._fences.get(entry.store_id) if entry.store_id is not None else None
+        if fence is None:
+            return
+        fence.coupons.pop(entry.id, None)
+        if not fence.coupons:
+            self._remove_fence_locked(fence)
+
+    def _rebuild(self) -> None:
+        entries = self.index.entries()
+        with self._lock:
+            self._fences.clear()
+            self._grid.clear()
+            for entry in entries:
+                self._add_locked(entry)
+
+    def _on_change(self, event: str, old: Optional[IndexedCoupon], new: Optional[IndexedCoupon]) -> None:
+        if event == "rebuild":
+            self._rebuild()
+            return
+        with self._lock:
+            if old is not None:
+                self._discard_locked(old)
+            if new is not None:
+                self._add_locked(new)
+
+    def _on_change_event(self, event: ChangeEvent, old: Optional[IndexedCoupon], new: Optional[IndexedCoupon]) -> None:
+        # Obtained coupons are never announced to that user again
+        if event.kind == "obtained" and event.user_id is not None:
+            with self._lock:
+                self._mark_notified_locked(event.user_id, event.coupon_id, math.inf)
+
+    def _mark_notified_locked(self, user_id: str, coupon_id: str, until: float) -> None:
+        key = (user_id, coupon_id)
+        self._notified[key] = until
+        self._notified.move_to_end(key)
+        while len(self._notified) > GEOFENCE_MAX_NOTIFIED:
+            self._notified.popitem(last=False)
+
+    # Matching
+
+    def observe(self, user_id: str, lat: float, lng: float, now: Optional[datetime] = None) -> List[Notification]:
+        """Match a location update; returns (and queues) the notifications for newly entered fences"""
+        if not self.enabled:
+            return []
+        now = now or datetime.now(JST)
+        clock = time.monotonic()
+        notifications = []
+        with self._lock:
+            self.metrics["events"] += 1
+            inside: Dict[str, float] = {}
+            for store_id, fence in self._grid.get(self._cell_of(lat, lng), {}).items():
+                distance = calculate_distance(lat, lng, fence.lat, fence.lng)
+                if distance <= self.radius_m:
+                    inside[store_id] = distance
+
+            previous = self._inside.get(user_id)
+            if inside or previous:
+                self._inside[user_id] = set(inside)
+                self._inside.move_to_end(user_id)
+                while len(self._inside) > GEOFENCE_MAX_USERS:
+                    self._inside.popitem(last=False)
+
+            for store_id, distance in inside.items():
+                if previous is not None and store_id in previous:
+                    continue
+                self.metrics["entered"] += 1
+                for coupon in self._fences[store_id].coupons.values():
+                    if coupon.minutes_remaining(now) <= 0:
+                        continue
+                    if self._notified.get((user_id, coupon.id), 0) > clock:
+                        self.metrics["deduplicated"] += 1
+                        continue
+                    self._mark_notified_locked(user_id, coupon.id, clock + GEOFENCE_DEDUPE_SECONDS)
+                    notifications.append(Notification(user_id, coupon, coupon.current_discount(now), distance, now))
+
+            for notification in notifications:
+                if len(self._queue) >= NOTIFICATION_QUEUE_SIZE:
+                    self._queue.popleft()
+                    self.metrics["dropped"] += 1
+                self._queue.append(notification)
+            self.metrics["queued"] += len(notifications)
+        return notifications
+
+    # Delivery
+
+    def start(self) -> None:
+        """Deliver queued notifications from a background task on the current event loop"""
+        if self._sender_task is None or self._sender_task.done():
+            self._sender_task = asyncio.get_running_loop().create_task(self._deliver_loop())
+
+    async def _deliver_loop(self) -> None:
+        while True:
+            await asyncio.sleep(NOTIFICATION_FLUSH_SECONDS)
+            try:
+                await asyncio.to_thread(self.deliver)
+            except Exception as e:
+                logger.error(f"Notification delivery failed: {e}")
+
+    def _requeue(self, batch: List[Notification]) -> None:
+        with self._lock:
+            room = NOTIFICATION_QUEUE_SIZE - len(self._queue)
+            kept = batch[-room:] if room > 0 else []
+            self._queue.extendleft(reversed(kept))
+            self.metrics["dropped"] += len(batch) - len(kept)
+
+    def deliver(self) -> int:
+        """Hand everything queued to the sender (blocking); returns the number sent"""
+        sent = 0
+        while True:
+            with self._lock:
+                batch = [self._queue.popleft() for _ in range(min(NOTIFICATION_BATCH_SIZE, len(self._queue)))]
+            if not batch:
+                return sent
+            try:
+                self.sender.send(batch)
+            except Exception as e:
+                self.metrics["send_failures"] += 1
+                self._requeue(batch)
+                logger.warning(f"Failed to send {len(batch)} notifications, will retry: {e}")
+                return sent
+            sent += len(batch)
+            self.metrics["sent"] += len(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.metrics, "fences": len(self._fences), "cells": len(self._grid),
+                    "tracked_users": len(self._inside), "queue_depth": len(self._queue)}
+
+
+# Shared by all requests in this process
+geofences = GeofenceEngine(coupon_index, LogNotificationSender(os.getenv("GEOFENCE_NOTIFICATION_LOG")),
+                           change_log=coupon_change_log)
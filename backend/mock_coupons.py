@@ -0,0 +1,265 @@
+"""
+Deterministic mock coupon provider
+Fallback coupons used when Hot Pepper / Rakuten return nothing (no API key, outage, open circuit).
+
+Mock coupons are generated per geo cell from a cell-seeded RNG, so the same cell always yields the
+same ids, shops and positions. Positions are scattered over the widest search radius and each request
+only keeps the ones within its own radius, so an id never moves between requests with different
+radii. Generated cells are memoized with an LRU; the memoized data is
+time-independent (each coupon keeps a lifetime in days), and the per-user distance plus the
+start/end times are applied at request time, so long-lived processes never serve expired mocks.
+Every mock coupon carries is_mock=True so it is never treated as real provider data (e.g. indexed).
+"""
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from geo_utils import calculate_distance, destination_point, tile_center, tile_key
+
+# Define JST timezone (UTC+9)
+JST = timezone(timedelta(hours=9))
+
+MOCK_CELL_SIZE_M = int(os.getenv("MOCK_COUPON_CELL_SIZE_M", "500"))
+MOCK_CELL_CACHE_SIZE = int(os.getenv("MOCK_COUPON_CACHE_CELLS", "4096"))
+# Farthest a mock coupon is placed from its cell center (requests with a smaller radius filter)
+HOTPEPPER_MOCK_MAX_DISTANCE_M = 2000
+RAKUTEN_MOCK_MAX_DISTANCE_M = 20000
+# Mocks within this distance of the cell center are always kept, whatever the request radius
+MOCK_MIN_SPREAD_M = 1000
+
+# Restaurant types and names for mock data
+RESTAURANT_TYPES = [
+    {"genre": "和食", "names": ["海鮮居酒屋 魚心", "日本料理 さくら", "寿司 まつ", "うなぎ 川重", "天ぷら 金の華", "割烹 青山"], "emoji": "🍣"},
+    {"genre": "イタリアン・フレンチ", "names": ["トラットリア・ベラヴィスタ", "カフェレストラン マルコ", "ビストロ プティ", "リストランテ・アモーレ"], "emoji": "🍝"},
+    {"genre": "焼肉・韓国料理", "names": ["炭火焼肉 牛角", "韓国料理 ソウル", "焼肉 大将", "韓国家庭料理 オモニ"], "emoji": "🥩"},
+    {"genre": "中華", "names": ["中華料理 龍門", "餃子の王将", "四川料理 麻辣", "広東料理 香港"], "emoji": "🥟"},
+    {"genre": "カフェ・スイーツ", "names": ["カフェ ドトール", "パティスリー アンジュ", "喫茶店 珈琲館", "スイーツカフェ ミエル"], "emoji": "☕"},
+    {"genre": "ファミリーレストラン", "names": ["ファミレス サイゼリヤ", "デニーズ", "ガスト", "ジョイフル"], "emoji": "🍽️"},
+    {"genre": "居酒屋", "names": ["大衆酒場 にぎわい", "立ち飲み 晩杯屋", "居酒屋 つぼ八", "海鮮居酒屋 浜焼太郎"], "emoji": "🍺"},
+    {"genre": "ラーメン・つけ麺", "names": ["ラーメン 一蘭", "つけ麺 六厘舎", "家系ラーメン 壱角家", "味噌ラーメン 花月嵐"], "emoji": "🍜"}
+]
+
+# Rakuten service types
+RAKUTEN_SERVICES = [
+    # Rakuten Market categories
+    {"category": "楽天市場", "types": ["ファッション", "グルメ・食品", "家電・PC", "美容・コスメ", "スポーツ・アウトドア"], "emoji": "🛍️", "source": "rakuten_market"},
+    {"category": "楽天市場", "types": ["本・雑誌・コミック", "おもちゃ・ゲーム", "キッチン用品", "インテリア", "ペット用品"], "emoji": "📦", "source": "rakuten_market"},
+    # Rakuten Travel categories
+    {"category": "楽天トラベル", "types": ["シティホテル", "ビジネスホテル", "リゾートホテル", "旅館", "民宿"], "emoji": "🏨", "source": "rakuten_travel"},
+    {"category": "楽天トラベル", "types": ["温泉宿", "ペンション", "コテージ", "カプセルホテル", "ゲストハウス"], "emoji": "🏩", "source": "rakuten_travel"},
+]
+
+# Fixed test coupons returned when no external coupons are available at all
+FIXED_TEST_COUPONS = [
+    {"id": "test_tokyo_1", "shop_name": "東京駅周辺店舗", "title": "テスト用クーポン 40% OFF", "current_discount": 40,
+     "location": {"lat": 35.6812, "lng": 139.7671}, "hours": 2, "description": "これは動作確認用のテストクーポンです",
+     "external_url": "https://example.com/test1"},
+    {"id": "test_shibuya_1", "shop_name": "渋谷テスト店", "title": "テスト用クーポン 30% OFF", "current_discount": 30,
+     "location": {"lat": 35.6598, "lng": 139.7006}, "hours": 3, "description": "渋谷エリアのテストクーポンです",
+     "external_url": "https://example.com/test2"},
+    {"id": "test_shinjuku_1", "shop_name": "新宿サンプル店", "title": "テスト用クーポン 25% OFF", "current_discount": 25,
+     "location": {"lat": 35.6896, "lng": 139.6917}, "hours": 4, "description": "新宿エリアのテストクーポンです",
+     "external_url": "https://example.com/test3"},
+]
+
+
+def _cell_seed(provider: str, cell: Tuple[int, int, int]) -> str:
+    return f"{provider}:{cell[0]}:{cell[1]}:{cell[2]}"
+
+
+@lru_cache(maxsize=MOCK_CELL_CACHE_SIZE)
+def hotpepper_mock_cell(cell: Tuple[int, int, int], count: int = 20) -> Tuple[Tuple[float, Dict], ...]:
+    """Generate the Hot Pepper mock coupons for one geo cell (memoized), each with its distance from the cell center"""
+    rng = random.Random(_cell_seed("hotpepper", cell))
+    center_lat, center_lng = tile_center(cell)
+    coupons = []
+
+    for i in range(count):
+        # Positions concentrated near the cell center
+        angle = rng.uniform(0, 2 * 3.14159)
+        rand = rng.random()
+        if rand < 0.5:  # 50% within 500m
+            distance_m = rng.uniform(30, 500)
+        elif rand < 0.8:  # 30% within 500m-1000m
+            distance_m = rng.uniform(500, 1000)
+        else:  # 20% within 1000m-2000m
+            distance_m = rng.uniform(1000, HOTPEPPER_MOCK_MAX_DISTANCE_M)
+        coupon_lat, coupon_lng = destination_point(center_lat, center_lng, distance_m, angle)
+
+        restaurant_type = rng.choice(RESTAURANT_TYPES)
+        shop_name = rng.choice(restaurant_type["names"]) + f" {i+1}号店"
+        discount = rng.choice([10, 15, 20, 25, 30])
+        budget = rng.choice(["1000～2000円", "2000～3000円", "3000～4000円", "4000～5000円", "5000円～"])
+        open_time = rng.choice(["11:00～23:00", "17:00～翌2:00", "11:30～14:30、17:00～22:00", "24時間営業", "10:00～22:00"])
+        mock_id = f"{cell[1]}_{cell[2]}_{i+1}"
+
+        coupons.append((distance_m, {
+            'id': f'hotpepper_mock_{mock_id}',
+            'title': f'{shop_name} - {restaurant_type["genre"]}クーポン',
+            'description': f'{restaurant_type["emoji"]} {restaurant_type["genre"]}をお楽しみください。ディナータイム限定{discount}%OFF！',
+            'store_name': shop_name,
+            'shop_name': shop_name,
+            'current_discount': discount,
+            'discount_rate_initial': discount,
+            'location': {'lat': coupon_lat, 'lng': coupon_lng},
+            'lifetime_days': 30,
+            'active_status': 'active',
+            'source': 'hotpepper',
+            'external_id': f'hp_mock_{mock_id}',
+            'is_mock': True,
+            'external_url': f'https://www.hotpepper.jp/strJ00{1000000 + rng.randint(0, 999999)}/',
+            'distance_meters': 0,  # Calculated per user
+            'genre': restaurant_type["genre"],
+            'budget': budget,
+            'access': '',  # Calculated per user
+            'open_time': open_time
+        }))
+
+    return tuple(coupons)
+
+
+@lru_cache(maxsize=MOCK_CELL_CACHE_SIZE)
+def rakuten_mock_cell(cell: Tuple[int, int, int], count: int = 25) -> Tuple[Tuple[float, Dict], ...]:
+    """Generate the Rakuten mock coupons for one geo cell (memoized), each with its distance from the cell center"""
+    rng = random.Random(_cell_seed("rakuten", cell))
+    center_lat, center_lng = tile_center(cell)
+    coupons = []
+
+    for i in range(count):
+        service_group = rng.choice(RAKUTEN_SERVICES)
+        service_type = rng.choice(service_group["types"])
+        source = service_group["source"]
+
+        distance_m = 0.0
+        if source == "rakuten_market":
+            # Online shopping - virtual location near the cell
+            coupon_lat = center_lat + rng.uniform(-0.005, 0.005)
+            coupon_lng = center_lng + rng.uniform(-0.005, 0.005)
+            shop_name = f"{service_type}{rng.choice(['楽天ショップ', '公式ストア', '専門店', 'セレクトショップ', '直営店'])}"
+            discount = rng.choice([10, 15, 20, 25, 30, 35])
+            original_price = rng.choice([2000, 3000, 5000, 8000, 12000, 15000])
+            address = "全国配送対応（楽天市場）"
+        else:
+            # Travel - actual physical location 1-20km away
+            distance_m = rng.uniform(1000, RAKUTEN_MOCK_MAX_DISTANCE_M)
+            coupon_lat, coupon_lng = destination_point(center_lat, center_lng, distance_m, rng.uniform(0, 2 * 3.14159))
+            hotel_prefix = rng.choice(["グランド", "プレミアム", "ロイヤル", "パーク", "セントラル", "東京", "新宿", "渋谷"])
+            shop_name = f"{hotel_prefix}{service_type}"
+            discount = rng.choice([20, 25, 30, 35, 40, 45])
+            original_price = rng.choice([8000, 12000, 15000, 20000, 25000, 30000])
+            area = rng.choice(["新宿区", "渋谷区", "港区", "千代田区", "中央区", "品川区", "目黒区", "世田谷区"])
+            address = f"東京都{area}{rng.randint(1, 5)}-{rng.randint(1, 30)}-{rng.randint(1, 15)}"
+
+        lifetime_days = rng.randint(7, 60)
+        mock_id = f"{cell[1]}_{cell[2]}_{i+1}"
+
+        coupons.append((distance_m, {
+            'id': f'rakuten_{source}_{mock_id}',
+            'title': f'{shop_name} - {service_type}クーポン',
+            'description': f'{service_group["emoji"]} 楽天の{service_group["category"]}でお得なクーポンです。{discount}%OFF！',
+            'store_name': shop_name,
+            'shop_name': shop_name,
+            'current_discount': discount,
+            'discount_rate_initial': discount,
+            'location': {'lat': coupon_lat, 'lng': coupon_lng},
+            'lifetime_days': lifetime_days,
+            'active_status': 'active',
+            'source': source,
+            'external_id': f'rakuten_mock_{mock_id}',
+            'is_mock': True,
+            'external_url': f'https://{"item" if source == "rakuten_market" else "travel"}.rakuten.co.jp/',
+            'original_price': original_price,
+            'sale_price': int(original_price * (100 - discount) / 100),
+            'distance_meters': rng.randint(100, 500) if source == "rakuten_market" else 0,
+            'genre': service_type,
+            'address': address,
+            'review_count': rng.randint(10, 500),
+            'review_average': round(rng.uniform(3.5, 4.8), 1)
+        }))
+
+    return tuple(coupons)
+
+
+def _stamp_times(base: Dict, now: datetime, **overrides) -> Dict:
+    """Copy a memoized mock coupon and give it start/end times relative to now"""
+    coupon = dict(base, **overrides)
+    expires_at = now + timedelta(days=coupon.pop('lifetime_days'))
+    coupon['start_time'] = now
+    coupon['end_time'] = expires_at
+    coupon['expires_at'] = expires_at.isoformat()
+    return coupon
+
+
+def generate_hotpepper_mock_coupons(user_lat: float, user_lng: float, radius: int) -> List[Dict]:
+    """Get the Hot Pepper mock coupons for the user's cell, sorted by distance from the user"""
+    cell = tile_key(user_lat, user_lng, MOCK_CELL_SIZE_M)
+    now = datetime.now(JST)
+    coupons = []
+    spread_m = max(MOCK_MIN_SPREAD_M, min(radius, HOTPEPPER_MOCK_MAX_DISTANCE_M))
+    for from_center_m, base in hotpepper_mock_cell(cell):
+        if from_center_m > spread_m:
+            continue
+        distance_m = calculate_distance(user_lat, user_lng, base['location']['lat'], base['location']['lng'])
+        coupons.append(_stamp_times(base, now, distance_meters=distance_m,
+                                    access=f'現在地から徒歩{max(1, int(distance_m / 80))}分'))
+    coupons.sort(key=lambda x: x['distance_meters'])
+    return coupons
+
+
+def generate_rakuten_mock_coupons(user_lat: float, user_lng: float, radius: int) -> List[Dict]:
+    """Get the Rakuten mock coupons for the user's cell, sorted by distance from the user"""
+    cell = tile_key(user_lat, user_lng, MOCK_CELL_SIZE_M)
+    now = datetime.now(JST)
+    coupons = []
+    spread_m = max(MOCK_MIN_SPREAD_M, min(radius, RAKUTEN_MOCK_MAX_DISTANCE_M))
+    for from_center_m, base in rakuten_mock_cell(cell):
+        if from_center_m > spread_m:
+            continue
+        if base['source'] == 'rakuten_market':
+            # Online items keep their virtual distance
+            coupons.append(_stamp_times(base, now))
+        else:
+            distance_m = calculate_distance(user_lat, user_lng, base['location']['lat'], base['location']['lng'])
+            coupons.append(_stamp_times(base, now, distance_meters=distance_m))
+    coupons.sort(key=lambda x: x['distance_meters'])
+    return coupons
+
+
+def get_fixed_test_coupons(lat: float, lng: float, radius: int) -> List[Dict]:
+    """Get the fixed test coupons within radius, sorted by distance"""
+    now = datetime.now(JST)
+    coupons = []
+    for base in FIXED_TEST_COUPONS:
+        distance = round(calculate_distance(lat, lng, base['location']['lat'], base['location']['lng']))
+        if distance > radius:
+            continue
+        end_time = now + timedelta(hours=base['hours'])
+        coupons.append({
+            "id": base['id'],
+            "shop_name": base['shop_name'],
+            "title": base['title'],
+            "current_discount": base['current_discount'],
+            "location": dict(base['location']),
+            "expires_at": end_time.isoformat(),
+            "time_remaining_minutes": base['hours'] * 60,
+            "distance_meters": distance,
+            "description": base['description'],
+            "source": "external",
+            "store_name": base['shop_name'],
+            "end_time": end_time,
+            "external_url": base['external_url'],
+            "is_mock": True
+        })
+    coupons.sort(key=lambda x: x['distance_meters'])
+    return coupons
+
+
+def mock_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Get LRU hit/miss counters for the memoized mock cells"""
+    stats = {}
+    for name, cached in (("hotpepper", hotpepper_mock_cell), ("rakuten", rakuten_mock_cell)):
+        info = cached.cache_info()
+        stats[name] = {"hits": info.hits, "misses": info.misses, "cells": info.currsize}
+    return stats
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, Text, JSON, ForeignKey
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, Text, JSON, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
@@ -70,6 +70,14 @@ class Coupon(Base):
 
 class UserCoupon(Base):
     __tablename__ = "user_coupons"
+    # Same as UNIQUE(user_id, coupon_id) in supabase_schema.sql; its index serves the
+    # "already obtained" anti-join in nearby_pipeline.py. The wallet indexes serve the keyset
+    # pages of /api/user/me/coupons (read backwards for obtained_at DESC, id DESC)
+    __table_args__ = (
+        UniqueConstraint("user_id", "coupon_id", name="user_coupons_user_id_coupon_id_key"),
+        Index("idx_user_coupons_wallet", "user_id", "obtained_at", "id"),
+        Index("idx_user_coupons_wallet_status", "user_id", "status", "obtained_at", "id"),
+    )
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
@@ -105,10 +113,44 @@ class GeoPoint(Base):
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     timestamp = Column(DateTime, default=datetime.now)
+    dwell_seconds = Column(Integer, default=0, nullable=False)  # How long the user stayed here after timestamp
     
     # Relationships
     user = relationship("User", back_populates="geo_points")
 
+class FootTrafficCell(Base):
+    """Hourly GeoPoint and visitor count of one Web Mercator tile (zoom/x/y), see foot_traffic.py"""
+    __tablename__ = "foot_traffic_cells"
+    
+    zoom = Column(Integer, primary_key=True)
+    cell_x = Column(Integer, primary_key=True)
+    cell_y = Column(Integer, primary_key=True)
+    hour = Column(DateTime, primary_key=True)  # Start of the hour
+    points = Column(Integer, nullable=False, default=0)
+    visitors = Column(Integer, nullable=False, default=0)  # Distinct users present during the hour
+
+class NotificationOutbox(Base):
+    """A push notification waiting for delivery, see notification_outbox.py"""
+    __tablename__ = "notification_outbox"
+    # The worker polls for due pending rows
+    __table_args__ = (
+        Index("idx_notification_outbox_due", "status", "next_attempt_at"),
+    )
+    
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    kind = Column(String, nullable=False, default="nearby")  # nearby / expiry
+    provider = Column(String, nullable=False)  # Push provider that delivers it
+    coupon_id = Column(String)
+    store_id = Column(String)
+    title = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending / sending (leased) / failed; delivered rows are deleted
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.now)
+    last_error = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+
 class Reservation(Base):
     __tablename__ = "reservations"
     
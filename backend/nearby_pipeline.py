@@ -0,0 +1,388 @@
+"""
+Nearby coupon pipeline
+One staged implementation of the "coupons near me" flow shared by every nearby endpoint
+(/api/coupons/, /public, /internal, /external and server.py's /api/coupons).
+
+Stages, each timed:
+- fetch:     internal coupons (bounding-box prefiltered, column-only query) and external coupons,
+             concurrently: the database query runs in a worker thread on its own short-lived
+             session while the provider requests run on the event loop; real provider results
+             are also ingested into the map's spatial index (spatial_index.py)
+- exclude:   drop coupons the user already obtained; internal coupons are excluded inside the fetch
+             query with a NOT EXISTS anti-join on user_coupons(user_id, coupon_id), external ones
+             are checked against only this request's candidate ids
+- distance:  exact distance for internal coupons, radius filter
+- discount:  current discount for the remaining internal coupons, persisted in one bulk update
+- rank:      cross-provider dedupe, then nearest-first ordering; with a limit only the top K
+             after the cursor are selected with a heap instead of sorting everything
+- serialize: plain dicts for the endpoint's response model (validated once by FastAPI)
+
+Endpoints choose the sources and options through NearbyPipeline's constructor. Pages are ordered
+by (distance, id); the cursor for the next page is returned in the X-Next-Cursor header. With
+NEARBY_PIPELINE_TIMING=true the per-stage breakdown is returned in a Server-Timing header.
+"""
+import asyncio
+import base64
+import heapq
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Response
+from sqlalchemy import exists, update
+from sqlalchemy.orm import Session
+
+from models import Coupon, Store, UserCoupon
+from supabase_client import SessionLocal
+from repositories import discount_for_time_remaining
+from external_coupons import ExternalCouponService, JST, get_mock_external_coupons
+from spatial_index import IndexedCoupon, coupon_index
+from geo_utils import bounding_box, calculate_distance
+from coupon_dedupe import dedupe_coupons
+
+logger = logging.getLogger(__name__)
+
+TIMING_HEADERS_ENABLED = os.getenv("NEARBY_PIPELINE_TIMING", "false").lower() == "true"
+
+
+class NearbyCandidate:
+    """A coupon moving through the pipeline (internal or external)"""
+
+    __slots__ = (
+        "id", "shop_name", "title", "description", "current_discount", "discount_rate_initial",
+        "discount_rate_schedule", "location", "expires_at", "distance_meters", "source", "external_url",
+        "provider", "external_id"
+    )
+
+    def __init__(self, id: str, shop_name: str, title: str, description: Optional[str], current_discount: int,
+                 location: Dict[str, float], expires_at: datetime, distance_meters: Optional[float] = None,
+                 source: str = "internal", external_url: Optional[str] = None,
+                 discount_rate_initial: Optional[int] = None, discount_rate_schedule: Optional[List[Dict]] = None,
+                 provider: Optional[str] = None, external_id: Optional[str] = None):
+        self.id = id
+        self.shop_name = shop_name
+        self.title = title
+        self.description = description
+        self.current_discount = current_discount
+        self.discount_rate_initial = discount_rate_initial
+        self.discount_rate_schedule = discount_rate_schedule
+        self.location = location
+        self.expires_at = expires_at
+        self.distance_meters = distance_meters
+        self.source = source
+        self.external_url = external_url
+        # Real origin and provider store id, kept even when source is relabelled "external" (used by dedupe)
+        self.provider = provider or source
+        self.external_id = external_id
+
+
+class NearbyResult:
+    """Serialized coupons, the next-page cursor and the per-stage timing breakdown (milliseconds)"""
+
+    def __init__(self, coupons: List[Dict[str, Any]], timings: Dict[str, float], next_cursor: Optional[str] = None):
+        self.coupons = coupons
+        self.timings = timings
+        self.next_cursor = next_cursor
+
+    def server_timing(self) -> str:
+        """Format the timings as a Server-Timing header value"""
+        return ", ".join(f"{stage};dur={duration:.2f}" for stage, duration in self.timings.items())
+
+    def apply_headers(self, response: Response) -> None:
+        """Attach the next-page cursor, and the timing breakdown when NEARBY_PIPELINE_TIMING is enabled"""
+        if self.next_cursor:
+            response.headers["X-Next-Cursor"] = self.next_cursor
+        if TIMING_HEADERS_ENABLED:
+            response.headers["Server-Timing"] = self.server_timing()
+
+
+def _rank_key(candidate: "NearbyCandidate") -> Tuple[float, str]:
+    return (candidate.distance_meters or 0.0, candidate.id)
+
+
+def encode_cursor(key: Tuple[float, str]) -> str:
+    """Opaque, URL-safe cursor for the (distance, id) of the last coupon on a page"""
+    return base64.urlsafe_b64encode(json.dumps(list(key), separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
+    """Parse a cursor from encode_cursor (400 if it was tampered with)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        distance, coupon_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return float(distance), str(coupon_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def minutes_until(expires_at: datetime, now: datetime) -> float:
+    """Minutes from now until expires_at (naive datetimes are treated as JST)"""
+    if expires_at.tzinfo is None:
+        now = now.replace(tzinfo=None)
+    return (expires_at - now).total_seconds() / 60
+
+
+def _parse_external_expiry(ext_coupon: Dict) -> datetime:
+    try:
+        return datetime.fromisoformat(ext_coupon['expires_at'].replace('Z', '+00:00'))
+    except Exception:
+        return ext_coupon['end_time']
+
+
+def _index_entry(ext_coupon: Dict, shop_name: str, expires_at: datetime) -> IndexedCoupon:
+    if expires_at.tzinfo is not None:
+        expires_at = expires_at.astimezone(JST).replace(tzinfo=None)  # Stored like coupons.end_time
+    return IndexedCoupon(
+        id=ext_coupon['id'], store_id=None, shop_name=shop_name, title=ext_coupon['title'],
+        description=ext_coupon.get('description', ''), lat=ext_coupon['location']['lat'],
+        lng=ext_coupon['location']['lng'], discount_rate_initial=ext_coupon['current_discount'],
+        discount_rate_schedule=None, expires_at=expires_at, source=ext_coupon.get('source', 'external'),
+        external_url=ext_coupon.get('external_url')
+    )
+
+
+class NearbyPipeline:
+    """Configurable nearby-coupon flow; one instance per endpoint"""
+
+    def __init__(self, include_internal: bool = True, include_external: bool = True,
+                 exclude_obtained: bool = True, mock_fallback: bool = True, dedupe: bool = True,
+                 external_source_label: Optional[str] = "external"):
+        self.include_internal = include_internal
+        self.include_external = include_external
+        self.exclude_obtained = exclude_obtained
+        self.mock_fallback = mock_fallback
+        self.dedupe = dedupe
+        # Routes label every external coupon "external"; None keeps the provider name
+        self.external_source_label = external_source_label
+
+    async def run(self, db: Session, lat: float, lng: float, radius: int, user_id: Optional[str] = None,
+                  limit: Optional[int] = None, cursor: Optional[str] = None) -> NearbyResult:
+        """Run all stages for one request, returning at most limit coupons after cursor"""
+        timings: Dict[str, float] = {}
+        now = datetime.now(JST)
+        after = decode_cursor(cursor) if cursor else None
+
+        started = time.perf_counter()
+        external_task = None
+        if self.include_external:
+            external_task = asyncio.ensure_future(self._fetch_external(lat, lng, radius))
+        exclude_user_id = user_id if self.exclude_obtained else None
+        candidates = []
+        if self.include_internal:
+            try:
+                # Worker thread so the provider requests keep running while the query executes
+                candidates = await asyncio.to_thread(self._fetch_internal_isolated, lat, lng, radius, now, exclude_user_id)
+            except BaseException:
+                if external_task is not None:
+                    external_task.cancel()
+                raise
+        external_candidates = await external_task if external_task is not None else []
+        timings["fetch"] = self._elapsed_ms(started)
+
+        started = time.perf_counter()
+        if exclude_user_id is not None and external_candidates:
+            external_candidates = self._exclude_obtained(db, exclude_user_id, external_candidates)
+        candidates.extend(external_candidates)
+        timings["exclude"] = self._elapsed_ms(started)
+
+        started = time.perf_counter()
+        candidates = self._apply_distance(candidates, lat, lng, radius)
+        timings["distance"] = self._elapsed_ms(started)
+
+        started = time.perf_counter()
+        self._apply_discounts(db, candidates, now)
+        timings["discount"] = self._elapsed_ms(started)
+
+        started = time.perf_counter()
+        if self.dedupe:
+            candidates = dedupe_coupons(candidates)
+        candidates, next_cursor = self._select_page(candidates, limit, after)
+        timings["rank"] = self._elapsed_ms(started)
+
+        started = time.perf_counter()
+        coupons = [self._serialize(candidate, now) for candidate in candidates]
+        timings["serialize"] = self._elapsed_ms(started)
+
+        result = NearbyResult(coupons, timings, next_cursor)
+        logger.debug(f"Nearby pipeline returned {len(coupons)} coupons ({result.server_timing()})")
+        return result
+
+    @staticmethod
+    def _select_page(candidates: List[NearbyCandidate], limit: Optional[int],
+                     after: Optional[Tuple[float, str]]) -> Tuple[List[NearbyCandidate], Optional[str]]:
+        if after is not None:
+            candidates = [candidate for candidate in candidates if _rank_key(candidate) > after]
+        if limit is None:
+            return sorted(candidates, key=_rank_key), None
+        # Top-K selection is O(n log k); only the page itself ends up sorted
+        page = heapq.nsmallest(limit, candidates, key=_rank_key)
+        next_cursor = encode_cursor(_rank_key(page[-1])) if len(candidates) > limit else None
+        return page, next_cursor
+
+    @staticmethod
+    def _elapsed_ms(started: float) -> float:
+        return (time.perf_counter() - started) * 1000
+
+    def internal_query(self, db: Session, lat: float, lng: float, radius: int, now: datetime):
+        """Column-only query for active internal coupons whose store is inside the search bounding box"""
+        # Bounding box around the search circle so the store location index can be used;
+        # the exact distance is checked in the distance stage
+        min_lat, min_lng, max_lat, max_lng = bounding_box(lat, lng, radius)
+
+        return db.query(
+            Coupon.id, Coupon.title, Coupon.description, Coupon.current_discount,
+            Coupon.discount_rate_initial, Coupon.discount_rate_schedule, Coupon.end_time,
+            Store.name, Store.latitude, Store.longitude
+        ).join(
+            Store, Coupon.store_id == Store.id
+        ).filter(
+            Coupon.active_status == "active",
+            Coupon.end_time > now,
+            Store.is_active == True,
+            Store.latitude.between(min_lat, max_lat),
+            Store.longitude.between(min_lng, max_lng)
+        )
+
+    def _fetch_internal_isolated(self, lat: float, lng: float, radius: int, now: datetime,
+                                 exclude_user_id: Optional[str] = None) -> List[NearbyCandidate]:
+        # Sessions aren't thread-safe, so the worker thread uses its own; candidates are plain objects
+        db = SessionLocal()
+        try:
+            return self._fetch_internal(db, lat, lng, radius, now, exclude_user_id)
+        finally:
+            db.close()
+
+    def _fetch_internal(self, db: Session, lat: float, lng: float, radius: int, now: datetime,
+                        exclude_user_id: Optional[str] = None) -> List[NearbyCandidate]:
+        query = self.internal_query(db, lat, lng, radius, now)
+        if exclude_user_id is not None:
+            # Correlated anti-join: one bound parameter however many coupons the user holds
+            query = query.filter(~exists().where(
+                UserCoupon.user_id == exclude_user_id,
+                UserCoupon.coupon_id == Coupon.id
+            ))
+        rows = query.all()
+
+        return [
+            NearbyCandidate(
+                id=str(row.id),
+                shop_name=row.name,
+                title=row.title,
+                description=row.description,
+                current_discount=row.current_discount,
+                discount_rate_initial=row.discount_rate_initial,
+                discount_rate_schedule=row.discount_rate_schedule,
+                location={'lat': row.latitude, 'lng': row.longitude},
+                expires_at=row.end_time,
+                source="internal"
+            )
+            for row in rows
+        ]
+
+    async def _fetch_external(self, lat: float, lng: float, radius: int) -> List[NearbyCandidate]:
+        try:
+            external_service = ExternalCouponService()
+            external_coupons = await external_service.get_external_coupons_near_location(lat, lng, radius)
+
+            # If no real external coupons found, add some mock data for testing
+            if not external_coupons and self.mock_fallback:
+                external_coupons = await get_mock_external_coupons(lat, lng, radius)
+        except Exception as e:
+            # Log error but don't fail the entire request
+            logger.error(f"Failed to fetch external coupons: {e}")
+            return []
+
+        candidates = []
+        indexed = []
+        for ext_coupon in external_coupons:
+            shop_name = ext_coupon.get('shop_name', ext_coupon.get('store_name', '店舗名不明'))
+            expires_at = _parse_external_expiry(ext_coupon)
+            # Online (Rakuten Market) items are placed next to each user, so they have no position to index
+            if not ext_coupon.get('is_mock') and ext_coupon.get('source') != 'rakuten_market':
+                indexed.append(_index_entry(ext_coupon, shop_name, expires_at))
+            candidates.append(NearbyCandidate(
+                id=ext_coupon['id'],
+                shop_name=shop_name,
+                title=ext_coupon['title'],
+                description=ext_coupon.get('description', ''),
+                current_discount=ext_coupon['current_discount'],
+                location={'lat': ext_coupon['location']['lat'], 'lng': ext_coupon['location']['lng']},
+                expires_at=expires_at,
+                distance_meters=ext_coupon['distance_meters'],
+                source=self.external_source_label or ext_coupon.get('source', 'external'),
+                external_url=ext_coupon.get('external_url'),
+                provider=ext_coupon.get('source', 'external'),
+                external_id=ext_coupon.get('external_id')
+            ))
+        if indexed:
+            # Real provider results (never mocks) at fixed places feed the map's spatial index
+            coupon_index.ingest_external(indexed)
+        return candidates
+
+    async def prefetch(self, lat: float, lng: float, radius: int) -> None:
+        """Warm the cached external providers for a location (uncached ones would only add upstream calls)"""
+        if self.include_external:
+            await ExternalCouponService().warm_provider_caches(lat, lng, radius)
+
+    def _exclude_obtained(self, db: Session, user_id: str, candidates: List[NearbyCandidate]) -> List[NearbyCandidate]:
+        # Only look up this request's candidate ids (bounded by the provider result sizes)
+        candidate_ids = {candidate.id for candidate in candidates}
+        obtained_ids = frozenset(row[0] for row in db.query(UserCoupon.coupon_id).filter(
+            UserCoupon.user_id == user_id,
+            UserCoupon.coupon_id.in_(candidate_ids)
+        ))
+        if not obtained_ids:
+            return candidates
+        return [candidate for candidate in candidates if candidate.id not in obtained_ids]
+
+    def _apply_distance(self, candidates: List[NearbyCandidate], lat: float, lng: float,
+                        radius: int) -> List[NearbyCandidate]:
+        nearby = []
+        for candidate in candidates:
+            if candidate.source == "internal":
+                candidate.distance_meters = calculate_distance(
+                    lat, lng, candidate.location['lat'], candidate.location['lng']
+                )
+                if candidate.distance_meters > radius:
+                    continue
+            nearby.append(candidate)
+        return nearby
+
+    def _apply_discounts(self, db: Session, candidates: List[NearbyCandidate], now: datetime) -> None:
+        changed = []
+        for candidate in candidates:
+            if candidate.source != "internal":
+                continue
+            discount = discount_for_time_remaining(
+                candidate.discount_rate_initial, candidate.discount_rate_schedule,
+                minutes_until(candidate.expires_at, now)
+            )
+            if discount != candidate.current_discount:
+                candidate.current_discount = discount
+                changed.append({"id": candidate.id, "current_discount": discount})
+
+        if changed:
+            # Bulk UPDATE by primary key instead of loading and flushing each row
+            db.execute(update(Coupon), changed)
+            db.commit()
+
+    @staticmethod
+    def _serialize(candidate: NearbyCandidate, now: datetime) -> Dict[str, Any]:
+        # Superset of the routes' and server.py's CouponResponse fields; the response model drops extras
+        return {
+            "id": candidate.id,
+            "shop_name": candidate.shop_name,
+            "store_name": candidate.shop_name,
+            "title": candidate.title,
+            "description": candidate.description,
+            "current_discount": candidate.current_discount,
+            "location": candidate.location,
+            "expires_at": candidate.expires_at,
+            "time_remaining_minutes": max(0, int(minutes_until(candidate.expires_at, now))),
+            "distance_meters": round(candidate.distance_meters, 1) if candidate.distance_meters is not None else None,
+            "source": candidate.source,
+            "external_url": candidate.external_url
+        }
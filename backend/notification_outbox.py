@@ -0,0 +1,368 @@
+"""
+Notification outbox and batched push delivery
+Alerts (geofence "coupon nearby", later expiry) are written to the notification_outbox table and
+delivered by a worker, so a slow or failing push service never blocks the code raising them and
+nothing is lost across restarts.
+
+- The worker claims all due pending rows of up to OUTBOX_CLAIM_USERS users per pass (FOR UPDATE
+  SKIP LOCKED on PostgreSQL, so several workers can share the table) and leases them in a short
+  transaction: status "sending", next_attempt_at pushed OUTBOX_LEASE_SECONDS out. Pushes are sent
+  with no transaction open, and the outcome is written in a second short transaction; rows whose
+  lease runs out (the worker died mid-pass) are claimed again
+- A user's alerts are held for OUTBOX_COALESCE_SECONDS and sent as one push ("3 coupons near
+  you") instead of one per coupon
+- Pushes are sent per provider in batches of the provider's max_batch (one HTTP call each)
+- Delivered rows are deleted; failed ones are retried with exponential backoff and jitter
+  (OUTBOX_BACKOFF_BASE_SECONDS doubling up to OUTBOX_BACKOFF_MAX_SECONDS) and marked failed
+  after OUTBOX_MAX_ATTEMPTS; while a provider's circuit is open its rows go back to pending
+  without using up attempts
+- Providers: "http" posts to PUSH_ENDPOINT_URL (push_server.py is the local stand-in) behind a
+  circuit breaker; "log" just logs, and is the default when no endpoint is configured
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from geofence import Notification, NotificationSender
+from models import NotificationOutbox
+from supabase_client import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+PUSH_ENDPOINT_URL = os.getenv("PUSH_ENDPOINT_URL", "")
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "500"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_COALESCE_SECONDS = float(os.getenv("OUTBOX_COALESCE_SECONDS", "30"))
+OUTBOX_CLAIM_USERS = 1000
+OUTBOX_CLAIM_LIMIT = 5000
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "5"))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "600"))
+# Titles listed in a coalesced push before "他N件"
+COALESCED_TITLES_SHOWN = 3
+
+
+class PushMessage:
+    """One push to one user, covering one or more outbox rows"""
+
+    __slots__ = ("user_id", "provider", "title", "body", "data", "outbox_ids")
+
+    def __init__(self, user_id: str, provider: str, title: str, body: str, data: Dict[str, Any],
+                 outbox_ids: List[str]):
+        self.user_id = user_id
+        self.provider = provider
+        self.title = title
+        self.body = body
+        self.data = data
+        self.outbox_ids = outbox_ids
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"to": self.user_id, "title": self.title, "body": self.body, "data": self.data}
+
+
+class PushProvider:
+    """Delivers batches of push messages; send_batch returns one success flag per message"""
+
+    name = "base"
+    max_batch = PUSH_BATCH_SIZE
+
+    def send_batch(self, messages: List[PushMessage]) -> List[bool]:
+        raise NotImplementedError
+
+
+class LogPushProvider(PushProvider):
+    name = "log"
+
+    def send_batch(self, messages: List[PushMessage]) -> List[bool]:
+        for message in messages:
+            logger.info(f"Push to {message.user_id}: {message.title} / {message.body}")
+        return [True] * len(messages)
+
+
+class HttpPushProvider(PushProvider):
+    """Posts {"messages": [...]} to a batch push endpoint and reads {"results": [{"ok": ...}]}"""
+
+    name = "http"
+
+    def __init__(self, url: str, max_batch: int = PUSH_BATCH_SIZE, breaker: Optional[CircuitBreaker] = None):
+        self.url = url
+        self.max_batch = max_batch
+        self.breaker = breaker or CircuitBreaker("push")
+        self._session = requests.Session()
+
+    def send_batch(self, messages: List[PushMessage]) -> List[bool]:
+        probe = self.breaker.before_call()
+        started = time.monotonic()
+        try:
+            response = self._session.post(self.url, json={"messages": [message.to_dict() for message in messages]},
+                                          timeout=self.breaker.current_timeout())
+            response.raise_for_status()
+            results = response.json()["results"]
+        except Exception:
+            self.breaker.record_failure(time.monotonic() - started)
+            raise
+        except BaseException:
+            if probe:
+                self.breaker.release_probe()
+            raise
+        self.breaker.record_success(time.monotonic() - started)
+        return [bool(result.get("ok")) for result in results]
+
+
+def default_providers() -> Dict[str, PushProvider]:
+    providers: Dict[str, PushProvider] = {"log": LogPushProvider()}
+    if PUSH_ENDPOINT_URL:
+        providers["http"] = HttpPushProvider(PUSH_ENDPOINT_URL)
+    return providers
+
+
+def coalesce(rows: List[NotificationOutbox]) -> List[PushMessage]:
+    """One push per (provider, user): the alert itself, or a summary of several"""
+    grouped: Dict[tuple, List[NotificationOutbox]] = {}
+    for row in rows:
+        grouped.setdefault((row.provider, row.user_id), []).append(row)
+
+    messages = []
+    for (provider, user_id), members in grouped.items():
+        members.sort(key=lambda row: row.created_at)
+        if len(members) == 1:
+            row = members[0]
+            title, body = row.title, row.message
+        else:
+            title = f"近くに{len(members)}件のクーポンがあります"
+            shown = [row.title for row in members[:COALESCED_TITLES_SHOWN]]
+            rest = len(members) - len(shown)
+            body = "、".join(shown) + (f" 他{rest}件" if rest else "")
+        data = {"coupon_ids": [row.coupon_id for row in members if row.coupon_id],
+                "kinds": sorted({row.kind for row in members})}
+        messages.append(PushMessage(user_id, provider, title, body, data, [row.id for row in members]))
+    return messages
+
+
+class NotificationOutboxWorker:
+    """Enqueues alerts into notification_outbox and delivers them in coalesced batches"""
+
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal,
+                 providers: Optional[Dict[str, PushProvider]] = None, default_provider: Optional[str] = None,
+                 coalesce_seconds: float = OUTBOX_COALESCE_SECONDS, claim_users: int = OUTBOX_CLAIM_USERS,
+                 claim_limit: int = OUTBOX_CLAIM_LIMIT, lease_seconds: float = OUTBOX_LEASE_SECONDS):
+        self.session_factory = session_factory
+        self.providers = providers if providers is not None else default_providers()
+        self.default_provider = default_provider or ("http" if "http" in self.providers else "log")
+        self.coalesce_seconds = coalesce_seconds
+        self.claim_users = claim_users
+        self.claim_limit = claim_limit
+        self.lease_seconds = lease_seconds
+        self.rng = random.Random()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self.metrics = {"enqueued": 0, "delivered": 0, "pushes": 0, "requests": 0, "retries": 0,
+                        "deferred": 0, "failed": 0, "last_pass_ms": 0.0}
+
+    def enqueue(self, rows: List[Dict[str, Any]]) -> None:
+        """Insert alerts (dicts of NotificationOutbox columns; provider defaults) in one statement"""
+        if not rows:
+            return
+        now = datetime.now()
+        values = [{"provider": self.default_provider, "kind": "nearby", "status": "pending", "attempts": 0,
+                   "next_attempt_at": now, "created_at": now, **row} for row in rows]
+        db = self.session_factory()
+        try:
+            db.execute(insert(NotificationOutbox), values)
+            db.commit()
+        finally:
+            db.close()
+        self.metrics["enqueued"] += len(values)
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+        return delay * self.rng.uniform(0.8, 1.2)
+
+    def process_once(self, now: Optional[datetime] = None) -> int:
+        """One delivery pass (blocking); returns how many outbox rows were delivered or rescheduled"""
+        now = now or datetime.now()
+        started = time.perf_counter()
+        with self._lock:
+            claimed = self._claim(now)
+            if claimed is None:
+                return 0
+            messages, attempts, lease_until = claimed
+
+            # No transaction or pooled connection is held while the providers are called
+            delivered_ids: List[str] = []
+            failed: Dict[str, str] = {}
+            deferred_ids: List[str] = []
+            for provider_name, provider_messages in self._by_provider(messages).items():
+                provider = self.providers.get(provider_name)
+                if provider is None:
+                    failed.update((outbox_id, f"unknown provider {provider_name}")
+                                  for message in provider_messages for outbox_id in message.outbox_ids)
+                    continue
+                for offset in range(0, len(provider_messages), provider.max_batch):
+                    chunk = provider_messages[offset:offset + provider.max_batch]
+                    try:
+                        results, error = provider.send_batch(chunk), "rejected by provider"
+                    except CircuitOpenError:
+                        # Handed back as pending; picked up again once the circuit closes
+                        deferred_ids.extend(outbox_id for message in provider_messages[offset:]
+                                            for outbox_id in message.outbox_ids)
+                        break
+                    except (requests.RequestException, ValueError, KeyError) as e:
+                        results, error = [False] * len(chunk), str(e)[:500]
+                    if len(results) != len(chunk):
+                        # Can't tell which messages the results belong to: retry the whole chunk
+                        error = f"provider returned {len(results)} results for {len(chunk)} messages"
+                        results = [False] * len(chunk)
+                    self.metrics["requests"] += 1
+                    for message, ok in zip(chunk, results):
+                        if ok:
+                            delivered_ids.extend(message.outbox_ids)
+                            self.metrics["pushes"] += 1
+                        else:
+                            failed.update((outbox_id, error) for outbox_id in message.outbox_ids)
+
+            self._settle(delivered_ids, self._retry_values(attempts, failed, now), deferred_ids, lease_until, now)
+        self.metrics["delivered"] += len(delivered_ids)
+        self.metrics["deferred"] += len(deferred_ids)
+        self.metrics["last_pass_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return len(attempts) - len(deferred_ids)
+
+    def _claim(self, now: datetime):
+        """Lease the due rows of the next users (short transaction); returns their messages, attempts
+        per row and the lease expiry, or None when nothing is due"""
+        db = self.session_factory()
+        try:
+            ready = now - timedelta(seconds=self.coalesce_seconds)
+            # Pending rows that are due, and rows whose sender's lease ran out (e.g. the worker died)
+            due = NotificationOutbox.status.in_(("pending", "sending")) & (NotificationOutbox.next_attempt_at <= now)
+            # Users whose oldest due alert has waited out the coalescing window...
+            users = select(NotificationOutbox.user_id).where(
+                due & (NotificationOutbox.created_at <= ready)
+            ).group_by(NotificationOutbox.user_id).order_by(
+                func.min(NotificationOutbox.created_at)
+            ).limit(self.claim_users).scalar_subquery()
+            # ...are sent everything due for them, newer alerts included
+            rows = db.execute(
+                select(NotificationOutbox).where(due & NotificationOutbox.user_id.in_(users))
+                .order_by(NotificationOutbox.user_id, NotificationOutbox.created_at).limit(self.claim_limit)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            if not rows:
+                db.commit()
+                return None
+            messages = coalesce(rows)
+            attempts = {row.id: row.attempts for row in rows}
+            lease_until = now + timedelta(seconds=self.lease_seconds)
+            db.execute(update(NotificationOutbox).where(NotificationOutbox.id.in_(list(attempts))).values(
+                status="sending", next_attempt_at=lease_until
+            ))
+            db.commit()
+            return messages, attempts, lease_until
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _settle(self, delivered_ids: List[str], retries: List[Dict[str, Any]], deferred_ids: List[str],
+                lease_until: datetime, now: datetime) -> None:
+        """Delete delivered rows and reschedule the rest (short transaction); rows whose lease ran out
+        and were claimed again by another pass are left to that pass"""
+        table = NotificationOutbox.__table__
+        leased = (table.c.status == "sending") & (table.c.next_attempt_at == lease_until)
+        db = self.session_factory()
+        try:
+            if delivered_ids:
+                db.execute(delete(table).where(table.c.id.in_(delivered_ids)))
+            if retries:
+                db.execute(self._retry_statement().where(leased), retries)
+            if deferred_ids:
+                db.execute(update(table).where(table.c.id.in_(deferred_ids) & leased).values(
+                    status="pending", next_attempt_at=now
+                ))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @staticmethod
+    def _by_provider(messages: List[PushMessage]) -> Dict[str, List[PushMessage]]:
+        grouped: Dict[str, List[PushMessage]] = {}
+        for message in messages:
+            grouped.setdefault(message.provider, []).append(message)
+        return grouped
+
+    @staticmethod
+    def _retry_statement():
+        table = NotificationOutbox.__table__
+        return update(table).where(table.c.id == bindparam("row_id")).values(
+            attempts=bindparam("attempts"), status=bindparam("new_status"),
+            next_attempt_at=bindparam("retry_at"), last_error=bindparam("error")
+        )
+
+    def _retry_values(self, attempts_by_id: Dict[str, int], failed: Dict[str, str],
+                      now: datetime) -> List[Dict[str, Any]]:
+        values = []
+        for row_id, error in failed.items():
+            attempts = attempts_by_id[row_id] + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                self.metrics["failed"] += 1
+                status = "failed"
+            else:
+                self.metrics["retries"] += 1
+                status = "pending"
+            values.append({"row_id": row_id, "attempts": attempts, "new_status": status,
+                           "retry_at": now + timedelta(seconds=self.backoff(attempts)), "error": error})
+        return values
+
+    def start(self) -> None:
+        """Deliver from a background task on the current event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                handled = await asyncio.to_thread(self.process_once)
+            except Exception as e:
+                logger.error(f"Notification delivery pass failed: {e}")
+                handled = 0
+            if handled < self.claim_limit:
+                await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.metrics, "providers": sorted(self.providers), "default_provider": self.default_provider}
+
+
+class OutboxNotificationSender(NotificationSender):
+    """Geofence sender that writes notifications to the outbox"""
+
+    def __init__(self, worker: NotificationOutboxWorker):
+        self.worker = worker
+
+    def send(self, notifications: List[Notification]) -> None:
+        self.worker.enqueue([{
+            "user_id": notification.user_id,
+            "kind": "nearby",
+            "coupon_id": notification.coupon_id,
+            "store_id": notification.store_id,
+            "title": notification.title,
+            "message": notification.message
+        } for notification in notifications])
+
+
+# Shared by all requests in this process
+notification_outbox = NotificationOutboxWorker()
@@ -0,0 +1,200 @@
+"""
+In-process geo pub/sub for realtime coupon events
+Fans change-log events out to /api/coupons/stream subscribers by geo cell, so one event reaches
+every subscriber in the area without per-client database queries.
+
+- Subscribers are registered in every PUBSUB_CELL_DEGREES grid cell their circle overlaps; an
+  event only visits the subscribers of its own cell, then an exact distance check
+- Each subscriber has a bounded asyncio queue; delivery is thread-safe (events can be logged from
+  worker threads) and a subscriber that falls PUBSUB_QUEUE_SIZE events behind is marked lagged
+  and told to resync through /api/coupons/changes instead of blocking the publisher
+- Events are rendered to SSE frames once per event and shared by all subscribers
+- Upserts that leave a coupon exactly as it was are not pushed
+- A ticker advances the change log every PUBSUB_TICK_SECONDS while anyone is subscribed, so
+  discount-tier changes and explosions (expiry) are pushed without a client request
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional, Set, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from change_log import ChangeEvent, CouponChangeLog, coupon_change_log
+from external_coupons import JST
+from geo_utils import bounding_box, calculate_distance
+from spatial_index import CouponSpatialIndex, IndexedCoupon, coupon_index
+from supabase_client import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_CELL_DEGREES = float(os.getenv("PUBSUB_CELL_DEGREES", "0.01"))
+PUBSUB_QUEUE_SIZE = int(os.getenv("PUBSUB_QUEUE_SIZE", "256"))
+PUBSUB_TICK_SECONDS = float(os.getenv("PUBSUB_TICK_SECONDS", "5"))
+RENDERED_EVENT_CACHE = 1024
+
+# Change-log kinds as sent on the stream (expiry is shown as an explosion, RDD 2.4)
+STREAM_EVENT_NAMES = {
+    "added": "added",
+    "changed": "changed",
+    "removed": "removed",
+    "expired": "exploded",
+    "obtained": "obtained",
+}
+
+
+class Subscription:
+    """One connected client and the area it watches"""
+
+    __slots__ = ("lat", "lng", "radius", "user_id", "obtained_ids", "cells", "queue", "loop", "lagged")
+
+    def __init__(self, lat: float, lng: float, radius: int, user_id: Optional[str], obtained_ids: Set[str],
+                 cells: Set[Tuple[int, int]], loop: asyncio.AbstractEventLoop):
+        self.lat = lat
+        self.lng = lng
+        self.radius = radius
+        self.user_id = user_id
+        self.obtained_ids = obtained_ids  # Coupons this user already has; never pushed again
+        self.cells = cells
+        self.queue: "asyncio.Queue[ChangeEvent]" = asyncio.Queue(maxsize=PUBSUB_QUEUE_SIZE)
+        self.loop = loop
+        self.lagged = False
+
+
+class GeoPubSub:
+    """Geo-cell indexed fan-out of change-log events to subscriptions"""
+
+    def __init__(self, change_log: CouponChangeLog, index: CouponSpatialIndex,
+                 cell_degrees: float = PUBSUB_CELL_DEGREES):
+        self.change_log = change_log
+        self.index = index
+        self.cell_degrees = cell_degrees
+        self._cells: Dict[Tuple[int, int], Set[Subscription]] = {}
+        self._subscribers = 0
+        self._rendered: "OrderedDict[int, Optional[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._ticker: Optional[asyncio.Task] = None
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        change_log.add_sink(self.publish)
+
+    def _cell_of(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def subscribe(self, lat: float, lng: float, radius: int, user_id: Optional[str] = None,
+                  obtained_ids: Optional[Set[str]] = None) -> Subscription:
+        """Register the caller's event loop for events within radius of (lat, lng)"""
+        min_lat, min_lng, max_lat, max_lng = bounding_box(lat, lng, radius)
+        min_row, min_col = self._cell_of(min_lat, min_lng)
+        max_row, max_col = self._cell_of(max_lat, max_lng)
+        cells = {(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)}
+        subscription = Subscription(lat, lng, radius, user_id, set(obtained_ids or ()), cells,
+                                    asyncio.get_running_loop())
+        with self._lock:
+            for cell in cells:
+                self._cells.setdefault(cell, set()).add(subscription)
+            self._subscribers += 1
+        self._ensure_ticker()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for cell in subscription.cells:
+                members = self._cells.get(cell)
+                if members is not None:
+                    members.discard(subscription)
+                    if not members:
+                        del self._cells[cell]
+            self._subscribers -= 1
+
+    def publish(self, event: ChangeEvent, old: Optional[IndexedCoupon] = None,
+                new: Optional[IndexedCoupon] = None) -> None:
+        """Route an event to the subscriptions whose area contains it (change-log sink)"""
+        if new is not None and new.same_as(old):
+            return  # Re-ingested unchanged: nothing for clients to redraw
+        with self._lock:
+            self.published += 1
+            members = list(self._cells.get(self._cell_of(event.lat, event.lng), ()))
+        for subscription in members:
+            if event.user_id is not None and event.user_id != subscription.user_id:
+                continue
+            if calculate_distance(subscription.lat, subscription.lng, event.lat, event.lng) > subscription.radius:
+                continue
+            subscription.loop.call_soon_threadsafe(self._offer, subscription, event)
+
+    def _offer(self, subscription: Subscription, event: ChangeEvent) -> None:
+        # Runs on the subscriber's event loop
+        if subscription.lagged:
+            return
+        try:
+            subscription.queue.put_nowait(event)
+            self.delivered += 1
+        except asyncio.QueueFull:
+            subscription.lagged = True
+            self.dropped += 1
+
+    def render(self, event: ChangeEvent) -> Optional[str]:
+        """SSE frame for an event, rendered once and shared (None if the coupon is already gone)"""
+        with self._lock:
+            if event.seq in self._rendered:
+                return self._rendered[event.seq]
+        frame = None
+        coupon = None
+        if event.kind in ("added", "changed"):
+            entry = self.index.get(event.coupon_id)
+            if entry is not None:
+                coupon = jsonable_encoder(entry.to_response(datetime.now(JST)))
+        if coupon is not None or event.kind not in ("added", "changed"):
+            data = {"id": event.coupon_id, "coupon": coupon}
+            frame = (f"id: {self.change_log.token(event.seq)}\n"
+                     f"event: {STREAM_EVENT_NAMES[event.kind]}\n"
+                     f"data: {json.dumps(data, ensure_ascii=False)}\n\n")
+        with self._lock:
+            self._rendered[event.seq] = frame
+            while len(self._rendered) > RENDERED_EVENT_CACHE:
+                self._rendered.popitem(last=False)
+        return frame
+
+    def _ensure_ticker(self) -> None:
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.get_running_loop().create_task(self._tick())
+
+    async def _tick(self) -> None:
+        """Advance time-based transitions (and refresh the index) while anyone is subscribed"""
+        while self._subscribers > 0:
+            try:
+                now = datetime.now(JST)
+                if self.index.needs_refresh():
+                    # The rebuild is a blocking query; keep it off the event loop
+                    await asyncio.to_thread(self._refresh_index)
+                self.change_log.advance(now)
+            except Exception as e:
+                logger.error(f"Realtime ticker failed: {e}")
+            await asyncio.sleep(PUBSUB_TICK_SECONDS)
+
+    def _refresh_index(self) -> None:
+        db = SessionLocal()
+        try:
+            self.index.ensure_loaded(db)
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "subscribers": self._subscribers,
+                "cells": len(self._cells),
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped": self.dropped
+            }
+
+
+# Shared by all requests in this process
+coupon_events = GeoPubSub(coupon_change_log, coupon_index)
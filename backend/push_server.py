@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Local stand-in push endpoint
+Accepts batched push messages the way a push provider's batch API does, so notification delivery
+(notification_outbox.py) can be run, tested and benchmarked with no push service.
+
+- POST /push/batch with {"messages": [{"to", "title", "body", "data"}, ...]} answers
+  {"results": [{"ok": true}, ...]}, one result per message
+- Latency, error rate and throttling use the replay server's profiles (replay_server.py);
+  a failed request answers 503 and a throttled one 429 with Retry-After
+- GET /_push/stats returns request / message counters; --log writes every message as a JSON line
+
+Usage:
+    python push_server.py [--port 8788] [--profile typical] [--log pushes.jsonl]
+
+    PUSH_ENDPOINT_URL=http://127.0.0.1:8788/push/batch
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from replay_server import PROFILES, TokenBucket
+
+
+class PushState:
+    """Profile, optional message log and counters shared by all handler threads"""
+
+    def __init__(self, profile: Dict, log_path: Optional[str] = None, seed: Optional[int] = None):
+        self.profile = profile
+        self.log_path = log_path
+        self.rng = random.Random(seed)
+        self.bucket = TokenBucket(profile["rate_limit_rps"]) if profile.get("rate_limit_rps") else None
+        self.counters = {"requests": 0, "messages": 0, "errors": 0, "throttled": 0}
+        self._lock = threading.Lock()
+
+    def count(self, metric: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[metric] += amount
+
+    def log(self, messages) -> None:
+        if not self.log_path:
+            return
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                for message in messages:
+                    f.write(json.dumps(message, ensure_ascii=False) + "\n")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"profile": self.profile, "counters": dict(self.counters)}
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    server_version = "CouponPush/1.0"
+    state: PushState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body, headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.startswith("/_push/stats"):
+            self._send_json(200, self.state.stats())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        state = self.state
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path != "/push/batch":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        state.count("requests")
+        if state.bucket is not None and not state.bucket.take():
+            state.count("throttled")
+            self._send_json(429, {"error": "rate limit exceeded"}, {"Retry-After": "1"})
+            return
+
+        profile = state.profile
+        delay_ms = max(0.0, profile["latency_ms"] + state.rng.uniform(-1, 1) * profile["jitter_ms"])
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+        if state.rng.random() < profile["error_rate"]:
+            state.count("errors")
+            self._send_json(503, {"error": "injected push failure"})
+            return
+
+        try:
+            messages = json.loads(body)["messages"]
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": "expected {\"messages\": [...]}"})
+            return
+        state.count("messages", len(messages))
+        state.log(messages)
+        self._send_json(200, {"results": [{"ok": True} for _ in messages]})
+
+
+def start_push_server(host: str = "127.0.0.1", port: int = 0, profile: str = "instant",
+                      log_path: Optional[str] = None, seed: Optional[int] = None) -> ThreadingHTTPServer:
+    """Start the stand-in in a daemon thread; port 0 picks a free port (see push_endpoint_url)"""
+    state = PushState(dict(PROFILES[profile]), log_path=log_path, seed=seed)
+    handler = type("BoundPushHandler", (PushHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.push_state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def push_endpoint_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/push/batch"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in push endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8788)
+    parser.add_argument("--profile", default="instant", choices=sorted(PROFILES))
+    parser.add_argument("--log", default=None, help="Append every received message to this JSON-lines file")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = start_push_server(args.host, args.port, args.profile, args.log, args.seed)
+    print(f"Push stand-in listening on {push_endpoint_url(server)} (profile {args.profile})")
+    print(f"   PUSH_ENDPOINT_URL={push_endpoint_url(server)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
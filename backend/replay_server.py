@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Local replay stand-in for the Kumapon, Hot Pepper and Rakuten APIs
+Serves captured provider payloads so the external coupon pipeline can be exercised, load-tested
+and benchmarked with no network.
+
+- Each provider is mounted under its own prefix (/kumapon, /hotpepper, /rakuten); point
+  ExternalCouponService at it with KUMAPON_BASE_URL / HOTPEPPER_BASE_URL / RAKUTEN_BASE_URL
+- Fixtures live in replay_fixtures/<provider>.json as a list of
+  {"path", "params", "status", "body"} entries; an entry matches when its path is equal and its
+  params are a subset of the request's, and the most specific match wins
+- Latency, error-rate and throttling come from named profiles, settable per provider
+- --record proxies to the real APIs and appends the responses to the fixture files
+  (API keys are never written)
+
+Usage:
+    python replay_server.py [--port 8787] [--profile typical] [--provider-profile hotpepper=flaky]
+    python replay_server.py --record
+
+    KUMAPON_BASE_URL=http://127.0.0.1:8787/kumapon
+    HOTPEPPER_BASE_URL=http://127.0.0.1:8787/hotpepper/
+    RAKUTEN_BASE_URL=http://127.0.0.1:8787/rakuten
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay_fixtures")
+
+# Real endpoints, used by --record
+UPSTREAM_BASE_URLS = {
+    "kumapon": "https://api.kumapon.jp",
+    "hotpepper": "https://webservice.recruit.co.jp/hotpepper/gourmet/v1",
+    "rakuten": "https://app.rakuten.co.jp/services/api",
+}
+
+# Query params that are credentials and must never be stored in fixtures
+SECRET_PARAMS = {"key", "applicationId", "affiliateId"}
+
+# Params a recorded fixture is matched on; location params are dropped so a capture replays anywhere
+RECORD_MATCH_PARAMS = {
+    "kumapon": (),
+    "hotpepper": ("range",),
+    "rakuten": ("keyword",),
+}
+
+PROFILES = {
+    "instant": {"latency_ms": 0, "jitter_ms": 0, "error_rate": 0.0, "rate_limit_rps": None},
+    "typical": {"latency_ms": 120, "jitter_ms": 60, "error_rate": 0.01, "rate_limit_rps": None},
+    "slow": {"latency_ms": 900, "jitter_ms": 400, "error_rate": 0.05, "rate_limit_rps": None},
+    "flaky": {"latency_ms": 200, "jitter_ms": 100, "error_rate": 0.3, "rate_limit_rps": None},
+    "throttled": {"latency_ms": 120, "jitter_ms": 40, "error_rate": 0.0, "rate_limit_rps": 20},
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket used to emulate upstream rate limits"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class ReplayState:
+    """Fixtures, per-provider profiles and counters shared by all handler threads"""
+
+    def __init__(self, profiles: Dict[str, Dict], record: bool = False, fixture_dir: str = FIXTURE_DIR,
+                 seed: Optional[int] = None):
+        self.profiles = profiles
+        self.record = record
+        self.fixture_dir = fixture_dir
+        self.rng = random.Random(seed)
+        self.fixtures = {provider: self._load(provider) for provider in UPSTREAM_BASE_URLS}
+        self.buckets = {
+            provider: TokenBucket(profile["rate_limit_rps"])
+            for provider, profile in profiles.items() if profile.get("rate_limit_rps")
+        }
+        self.counters: Dict[str, Dict[str, int]] = {
+            provider: {"served": 0, "errors": 0, "throttled": 0, "unmatched": 0, "recorded": 0}
+            for provider in UPSTREAM_BASE_URLS
+        }
+        self._lock = threading.Lock()
+
+    def _fixture_path(self, provider: str) -> str:
+        return os.path.join(self.fixture_dir, f"{provider}.json")
+
+    def _load(self, provider: str) -> List[Dict]:
+        path = self._fixture_path(provider)
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def count(self, provider: str, metric: str) -> None:
+        with self._lock:
+            self.counters[provider][metric] += 1
+
+    def match(self, provider: str, path: str, params: Dict[str, str]) -> Optional[Dict]:
+        """Most specific fixture whose path matches and whose params are a subset of the request's"""
+        best = None
+        for entry in self.fixtures[provider]:
+            if entry["path"] != path:
+                continue
+            expected = {k: str(v) for k, v in (entry.get("params") or {}).items()}
+            if any(params.get(k) != v for k, v in expected.items()):
+                continue
+            if best is None or len(expected) > len(best.get("params") or {}):
+                best = entry
+        return best
+
+    def record_response(self, provider: str, path: str, params: Dict[str, str], status: int, body) -> None:
+        """Append a captured upstream response to the provider's fixture file"""
+        kept = {k: v for k, v in params.items() if k in RECORD_MATCH_PARAMS[provider] and k not in SECRET_PARAMS}
+        entry = {"path": path, "params": kept, "status": status, "body": body}
+        with self._lock:
+            self.fixtures[provider] = [
+                existing for existing in self.fixtures[provider]
+                if not (existing["path"] == path and (existing.get("params") or {}) == kept)
+            ] + [entry]
+            os.makedirs(self.fixture_dir, exist_ok=True)
+            with open(self._fixture_path(provider), "w", encoding="utf-8") as f:
+                json.dump(self.fixtures[provider], f, ensure_ascii=False, indent=2)
+            self.counters[provider]["recorded"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "profiles": self.profiles,
+                "fixtures": {provider: len(entries) for provider, entries in self.fixtures.items()},
+                "counters": {provider: dict(counters) for provider, counters in self.counters.items()},
+            }
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Serves /<provider>/<path> from fixtures (or the real API when recording)"""
+
+    server_version = "CouponReplay/1.0"
+    state: ReplayState = None
+
+    def log_message(self, format, *args):
+        # Keep load tests quiet; counters are available at /_replay/stats
+        pass
+
+    def _send_json(self, status: int, body, headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _split_provider(self) -> Tuple[Optional[str], str, Dict[str, str]]:
+        url = urlsplit(self.path)
+        parts = url.path.lstrip("/").split("/", 1)
+        provider = parts[0]
+        path = "/" + (parts[1] if len(parts) > 1 else "")
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        return (provider if provider in UPSTREAM_BASE_URLS else None), path, params
+
+    def do_GET(self):
+        state = self.state
+        if self.path.startswith("/_replay/stats"):
+            self._send_json(200, state.stats())
+            return
+
+        provider, path, params = self._split_provider()
+        if provider is None:
+            self._send_json(404, {"error": f"unknown provider in {self.path}"})
+            return
+
+        profile = state.profiles[provider]
+        bucket = state.buckets.get(provider)
+        if bucket is not None and not bucket.take():
+            state.count(provider, "throttled")
+            self._send_json(429, {"error": "rate limit exceeded"}, {"Retry-After": "1"})
+            return
+
+        delay_ms = max(0.0, profile["latency_ms"] + state.rng.uniform(-1, 1) * profile["jitter_ms"])
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+
+        if state.rng.random() < profile["error_rate"]:
+            state.count(provider, "errors")
+            self._send_json(503, {"error": "injected upstream failure"})
+            return
+
+        if state.record:
+            upstream = requests.get(UPSTREAM_BASE_URLS[provider] + path, params=params, timeout=30)
+            body = upstream.json()
+            state.record_response(provider, path, params, upstream.status_code, body)
+            self._send_json(upstream.status_code, body)
+            return
+
+        entry = state.match(provider, path, params)
+        if entry is None:
+            state.count(provider, "unmatched")
+            self._send_json(404, {"error": f"no {provider} fixture for {path}"})
+            return
+
+        state.count(provider, "served")
+        self._send_json(entry.get("status", 200), entry["body"])
+
+
+def build_profiles(default: str, overrides: List[str]) -> Dict[str, Dict]:
+    """Resolve the profile for each provider from the default and provider=profile overrides"""
+    profiles = {provider: dict(PROFILES[default]) for provider in UPSTREAM_BASE_URLS}
+    for override in overrides:
+        provider, _, name = override.partition("=")
+        if provider not in UPSTREAM_BASE_URLS or name not in PROFILES:
+            raise ValueError(f"Invalid provider profile '{override}' (expected provider=profile)")
+        profiles[provider] = dict(PROFILES[name])
+    return profiles
+
+
+def start_replay_server(host: str = "127.0.0.1", port: int = 0, profiles: Optional[Dict[str, Dict]] = None,
+                        record: bool = False, seed: Optional[int] = None) -> ThreadingHTTPServer:
+    """Start the replay server in a daemon thread; port 0 picks a free port (see server.server_address)"""
+    state = ReplayState(profiles or build_profiles("instant", []), record=record, seed=seed)
+    handler = type("BoundReplayHandler", (ReplayHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.replay_state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def replay_base_urls(server: ThreadingHTTPServer) -> Dict[str, str]:
+    """Environment variables that point ExternalCouponService at a running replay server"""
+    host, port = server.server_address[:2]
+    root = f"http://{host}:{port}"
+    return {
+        "KUMAPON_BASE_URL": f"{root}/kumapon",
+        "HOTPEPPER_BASE_URL": f"{root}/hotpepper/",
+        "RAKUTEN_BASE_URL": f"{root}/rakuten",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay stand-in for external coupon APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--profile", default="instant", choices=sorted(PROFILES))
+    parser.add_argument("--provider-profile", action="append", default=[],
+                        help="Per-provider profile override, e.g. hotpepper=flaky")
+    parser.add_argument("--record", action="store_true", help="Proxy to the real APIs and save responses")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for latency jitter and error injection")
+    args = parser.parse_args()
+
+    server = start_replay_server(args.host, args.port, build_profiles(args.profile, args.provider_profile),
+                                 record=args.record, seed=args.seed)
+    print(f"Replay server listening on http://{args.host}:{server.server_address[1]} "
+          f"({'recording' if args.record else 'replaying'})")
+    for name, value in replay_base_urls(server).items():
+        print(f"   {name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
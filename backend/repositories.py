@@ -1,6 +1,7 @@
+from sqlalchemy import and_, or_, tuple_, update
 from sqlalchemy.orm import Session
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
 from models import User, Store, Coupon, UserCoupon, Admin, GeoPoint, Reservation
 from auth import get_password_hash, verify_password
@@ -221,23 +222,30 @@ class EnhancedCouponRepository:
         time_remaining = end_time - now
         minutes_remaining = time_remaining.total_seconds() / 60
         
-        # Use dynamic schedule if available
-        if coupon.discount_rate_schedule:
-            current_rate = coupon.discount_rate_initial
-            for schedule_item in coupon.discount_rate_schedule:
-                if minutes_remaining <= schedule_item["time_remain_min"]:
-                    current_rate = schedule_item["rate"]
-            return current_rate
-        
-        # Fallback to legacy calculation
-        if minutes_remaining <= 10:
-            return min(50, coupon.discount_rate_initial + 30)
-        elif minutes_remaining <= 30:
-            return min(40, coupon.discount_rate_initial + 20)
-        elif minutes_remaining <= 60:
-            return min(30, coupon.discount_rate_initial + 10)
-        else:
-            return coupon.discount_rate_initial
+        return discount_for_time_remaining(
+            coupon.discount_rate_initial, coupon.discount_rate_schedule, minutes_remaining
+        )
+
+def discount_for_time_remaining(discount_rate_initial: int, discount_rate_schedule: Optional[List[Dict[str, Any]]],
+                                minutes_remaining: float) -> int:
+    """Discount for a coupon with the given minutes left (schedule if set, legacy escalation otherwise)"""
+    # Use dynamic schedule if available
+    if discount_rate_schedule:
+        current_rate = discount_rate_initial
+        for schedule_item in discount_rate_schedule:
+            if minutes_remaining <= schedule_item["time_remain_min"]:
+                current_rate = schedule_item["rate"]
+        return current_rate
+    
+    # Fallback to legacy calculation
+    if minutes_remaining <= 10:
+        return min(50, discount_rate_initial + 30)
+    elif minutes_remaining <= 30:
+        return min(40, discount_rate_initial + 20)
+    elif minutes_remaining <= 60:
+        return min(30, discount_rate_initial + 10)
+    else:
+        return discount_rate_initial
 
 class EnhancedUserCouponRepository:
     def __init__(self, db: Session):
@@ -262,6 +270,46 @@ class EnhancedUserCouponRepository:
         """Get all coupons for a user"""
         return self.db.query(UserCoupon).filter(UserCoupon.user_id == user_id).all()
     
+    def get_wallet_page(self, user_id: str, now: datetime, status: Optional[str] = None, limit: Optional[int] = None,
+                        after: Optional[Tuple[datetime, str]] = None) -> List[Tuple[UserCoupon, Coupon, Store]]:
+        """One page of a user's coupons with coupon and store, newest first (keyset on obtained_at, id)
+        
+        status is "used", "unused" or "expired"; expiry is judged from the coupon's end_time, so rows
+        whose stored status is still "obtained" are filtered correctly before expire_user_coupons runs;
+        limit None returns every remaining row
+        """
+        query = self.db.query(UserCoupon, Coupon, Store).join(
+            Coupon, UserCoupon.coupon_id == Coupon.id
+        ).join(
+            Store, Coupon.store_id == Store.id
+        ).filter(UserCoupon.user_id == user_id)
+        
+        if status == "used":
+            query = query.filter(UserCoupon.status == "used")
+        elif status == "unused":
+            query = query.filter(UserCoupon.status == "obtained", Coupon.end_time > now)
+        elif status == "expired":
+            query = query.filter(or_(
+                UserCoupon.status == "expired",
+                and_(UserCoupon.status == "obtained", Coupon.end_time <= now)
+            ))
+        
+        if after is not None:
+            query = query.filter(tuple_(UserCoupon.obtained_at, UserCoupon.id) < tuple_(*after))
+        
+        return query.order_by(UserCoupon.obtained_at.desc(), UserCoupon.id.desc()).limit(limit).all()
+    
+    def expire_user_coupons(self, user_coupon_ids: List[str]) -> int:
+        """Mark unused coupons as expired in one UPDATE; returns the number of rows changed"""
+        if not user_coupon_ids:
+            return 0
+        result = self.db.execute(update(UserCoupon).where(
+            UserCoupon.id.in_(user_coupon_ids),
+            UserCoupon.status == "obtained"
+        ).values(status="expired").execution_options(synchronize_session=False))
+        self.db.commit()
+        return result.rowcount
+    
     def check_user_has_coupon(self, user_id: str, coupon_id: str) -> bool:
         """Check if user already has this coupon"""
         existing = self.db.query(UserCoupon).filter(
@@ -1,9 +1,10 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, EmailStr
 from typing import List, Optional
 from datetime import datetime, timedelta
+import asyncio
 import math
 import uuid
 import os
@@ -17,7 +18,7 @@ load_dotenv()
 from models import get_db, User, Store, Coupon, UserCoupon, Admin
 from repositories import (
     UserRepository, StoreRepository, EnhancedCouponRepository, 
-    EnhancedUserCouponRepository, AdminRepository, GeoPointRepository,
+    EnhancedUserCouponRepository, AdminRepository,
     user_to_dict, store_to_dict, coupon_to_dict, user_coupon_to_dict
 )
 from auth import (
@@ -25,12 +26,26 @@ from auth import (
     get_current_user_optional, get_current_admin_optional, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 # Import external coupons service
-from external_coupons import ExternalCouponService, get_mock_external_coupons
+from external_coupons import get_external_health
+from nearby_pipeline import NearbyPipeline
+from trajectory import TrajectoryPrefetcher
+from geo_writer import geo_writer
+from geo_retention import geo_maintenance
+from foot_traffic import foot_traffic
+from geofence import geofences
+from notification_outbox import notification_outbox, OutboxNotificationSender
+from spatial_index import coupon_index
+from coupon_clusters import coupon_clusters
+from vector_tiles import coupon_tiles
+from change_log import coupon_change_log
+from pubsub import coupon_events
 
 # Import admin routes
 from api.admin_routes import router as admin_router
 # Import coupon routes
 from api.coupon_routes import router as coupon_router
+# Import map tile routes
+from api.tile_routes import router as tile_router
 
 app = FastAPI(title="Enhanced Coupon Location API v2.0")
 
@@ -47,12 +62,15 @@ app.add_middleware(
     allow_credentials=True,  # 認証トークンを使用するためTrueに設定
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "ETag"],  # Nearby paging / timing, viewport hash
 )
 
 # Include admin routes
 app.include_router(admin_router, prefix="/api/admin", tags=["admin"])
 # Include coupon routes
 app.include_router(coupon_router, prefix="/api/coupons", tags=["coupons"])
+# Include map tile routes
+app.include_router(tile_router, prefix="/api/tiles", tags=["tiles"])
 
 # Pydantic models for requests/responses
 class UserRegisterRequest(BaseModel):
@@ -118,6 +136,11 @@ class TokenResponse(BaseModel):
     user: Optional[dict] = None
     admin: Optional[dict] = None
 
+# Nearby coupons keep each external coupon's provider name as its source
+nearby_pipeline = NearbyPipeline(external_source_label=None)
+# Warms the pipeline's external caches where moving users are heading
+trajectory_prefetcher = TrajectoryPrefetcher(warm=nearby_pipeline.prefetch)
+
 # Utility functions
 def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     """Calculate distance between two points using Haversine formula"""
@@ -250,146 +273,34 @@ async def get_public_stores(db: Session = Depends(get_db)):
 async def get_coupons(
     lat: float, 
     lng: float, 
+    response: Response,
     radius: int = 1000, 
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ) -> List[CouponResponse]:
     """Get all active coupons within radius"""
     try:
         print(f"Getting coupons for lat={lat}, lng={lng}, radius={radius}")
-        coupon_repo = EnhancedCouponRepository(db)
-        store_repo = StoreRepository(db)
-        geo_repo = GeoPointRepository(db)
         
-        # Track user location if authenticated
+        # Track user location if authenticated (written in batches), prefetch where they are heading
+        # and notify them of stores they just walked up to
         try:
-            geo_repo.add_location_point(current_user.id, lat, lng)
+            timestamp = geo_writer.add_location_point(current_user.id, lat, lng)
+            trajectory_prefetcher.observe(db, current_user.id, lat, lng, timestamp, radius)
+            geofences.observe(current_user.id, lat, lng)
         except Exception as e:
             print(f"Failed to track location: {e}")
         
-        # Get user's already obtained coupon IDs
-        user_coupon_repo = EnhancedUserCouponRepository(db)
-        user_obtained_coupons = db.query(UserCoupon.coupon_id).filter(
-            UserCoupon.user_id == current_user.id
-        ).all()
-        obtained_coupon_ids = {str(coupon_id[0]) for coupon_id in user_obtained_coupons}
-        print(f"User has already obtained {len(obtained_coupon_ids)} coupons: {obtained_coupon_ids}")
-        
-        user_location = Location(lat=lat, lng=lng)
-        active_coupons = coupon_repo.get_active_coupons()
-        print(f"Found {len(active_coupons)} active coupons")
-        nearby_coupons = []
-        
-        for coupon in active_coupons:
-            try:
-                # Skip if user has already obtained this coupon
-                if str(coupon.id) in obtained_coupon_ids:
-                    print(f"Skipping already obtained coupon: {coupon.id}")
-                    continue
-                    
-                print(f"Processing coupon: {coupon.id} for store: {coupon.store_id}")
-                # Get store information
-                store = store_repo.get_store_by_id(coupon.store_id)
-                if not store:
-                    print(f"Store not found for coupon {coupon.id}")
-                    continue
-                    
-                distance = calculate_distance(
-                    user_location.lat, user_location.lng,
-                    store.latitude, store.longitude
-                )
-                
-                print(f"Distance to store {store.name}: {distance}m (radius: {radius}m)")
-                
-                if distance <= radius:
-                    # Calculate current discount
-                    current_discount = coupon_repo.calculate_current_discount(coupon)
-                    
-                    # Update coupon current_discount if changed
-                    if current_discount != coupon.current_discount:
-                        coupon.current_discount = current_discount
-                        db.commit()
-                    
-                    now = datetime.now()
-                    
-                    # Handle timezone-aware comparison
-                    end_time = coupon.end_time
-                    if end_time.tzinfo is not None:
-                        end_time = end_time.replace(tzinfo=None)
-                    if now.tzinfo is not None:
-                        now = now.replace(tzinfo=None)
-                    
-                    time_remaining = end_time - now
-                    minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-                    
-                    nearby_coupons.append(CouponResponse(
-                        id=str(coupon.id),
-                        store_name=store.name,
-                        title=coupon.title,
-                        description=coupon.description,
-                        current_discount=current_discount,
-                        location=Location(lat=store.latitude, lng=store.longitude),
-                        expires_at=end_time,
-                        time_remaining_minutes=minutes_remaining,
-                        distance_meters=distance,
-                        source="internal"
-                    ))
-                    print(f"Added coupon {coupon.id} to nearby list")
-            except Exception as e:
-                print(f"Error processing coupon {coupon.id}: {e}")
-                continue
+        result = await nearby_pipeline.run(db, lat, lng, radius, user_id=current_user.id, limit=limit, cursor=cursor)
+        result.apply_headers(response)
         
-        print(f"Found {len(nearby_coupons)} internal coupons")
-        
-        # Get external coupons and add them to the result
-        try:
-            external_service = ExternalCouponService()
-            external_coupons = await external_service.get_external_coupons_near_location(lat, lng, radius)
-            
-            # If no real external coupons found, add some mock data for testing
-            if not external_coupons:
-                external_coupons = await get_mock_external_coupons(lat, lng, radius)
-            
-            for ext_coupon in external_coupons:
-                # Skip if user has already obtained this external coupon
-                if ext_coupon['id'] in obtained_coupon_ids:
-                    print(f"Skipping already obtained external coupon: {ext_coupon['id']}")
-                    continue
-                    
-                # Convert external coupon format to CouponResponse
-                try:
-                    expires_at = datetime.fromisoformat(ext_coupon['expires_at'].replace('Z', '+00:00'))
-                except:
-                    expires_at = ext_coupon['end_time']
-                
-                time_remaining = expires_at - datetime.now()
-                minutes_remaining = max(0, int(time_remaining.total_seconds() / 60))
-                
-                nearby_coupons.append(CouponResponse(
-                    id=ext_coupon['id'],
-                    store_name=ext_coupon.get('shop_name', ext_coupon.get('store_name', '店舗名不明')),
-                    title=ext_coupon['title'],
-                    description=ext_coupon.get('description', ''),
-                    current_discount=ext_coupon['current_discount'],
-                    location=Location(
-                        lat=ext_coupon['location']['lat'],
-                        lng=ext_coupon['location']['lng']
-                    ),
-                    expires_at=expires_at,
-                    time_remaining_minutes=minutes_remaining,
-                    distance_meters=round(ext_coupon['distance_meters'], 1),
-                    source=ext_coupon.get('source', 'external'),
-                    external_url=ext_coupon.get('external_url')
-                ))
-                
-            print(f"Added {len(external_coupons)} external coupons")
-                
-        except Exception as e:
-            print(f"Failed to fetch external coupons: {e}")
-        
-        print(f"Returning {len(nearby_coupons)} total coupons (internal + external)")
-        return nearby_coupons
+        print(f"Returning {len(result.coupons)} total coupons (internal + external)")
+        return result.coupons
         
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         print(f"Error in get_coupons: {e}")
@@ -485,6 +396,7 @@ async def create_store_coupon_legacy(
         "start_time": coupon_data.start_time,
         "end_time": coupon_data.end_time
     })
+    coupon_index.refresh_coupon(db, str(coupon.id))
     
     return {"message": "Coupon created successfully", "coupon": coupon_to_dict(coupon)}
 
@@ -536,7 +448,21 @@ async def simple_coupon_test():
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now(), "version": "2.0"}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now(),
+        "version": "2.0",
+        "spatial_index": {**coupon_index.stats(), "clusters": coupon_clusters.stats(), "tiles": coupon_tiles.stats()},
+        "change_log": coupon_change_log.stats(),
+        "realtime": coupon_events.stats(),
+        "prefetch": trajectory_prefetcher.stats(),
+        "geo_writer": geo_writer.stats(),
+        "geo_maintenance": geo_maintenance.stats(),
+        "foot_traffic": foot_traffic.stats(),
+        "geofences": geofences.stats(),
+        "notifications": notification_outbox.stats(),
+        **get_external_health()
+    }
 
 # Startup event - Create sample data for demo
 @app.on_event("startup")
@@ -544,6 +470,12 @@ async def startup_event():
     """Initialize with sample data if database is empty"""
     from supabase_client import SessionLocal
     
+    geo_maintenance.start()
+    # Geofence alerts go through the outbox so they survive push failures and restarts
+    geofences.set_sender(OutboxNotificationSender(notification_outbox))
+    geofences.start()
+    notification_outbox.start()
+    
     db = SessionLocal()
     user_repo = UserRepository(db)
     admin_repo = AdminRepository(db)
@@ -672,6 +604,12 @@ async def startup_event():
     finally:
         db.close()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Write out buffered location points and notifications"""
+    await geo_writer.close()
+    await asyncio.to_thread(geofences.deliver)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
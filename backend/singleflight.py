@@ -0,0 +1,54 @@
+"""
+Singleflight deduplication for outbound provider calls
+Concurrent callers asking for the same key share one in-flight call instead of each hitting upstream.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+
+def normalize_request_key(url: str, params: Optional[Dict] = None) -> tuple:
+    """Build a stable key from a URL and its query params (case-folded host, sorted params)"""
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    query.extend((str(k), str(v)) for k, v in (params or {}).items())
+    base = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/") or "/", "", ""))
+    return (base, tuple(sorted(query)))
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one shared task"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.executed = 0
+        self.saved = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn for key, or wait for the identical call that is already running"""
+        task = self._calls.get(key)
+        if task is not None:
+            self.saved += 1
+        else:
+            # Run the call in its own task so the leader being cancelled doesn't cancel it for everyone
+            task = asyncio.ensure_future(fn())
+            # Mark exceptions as retrieved even when nobody is left waiting
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self._calls[key] = task
+            self.executed += 1
+        # Shield so one waiter being cancelled doesn't cancel the shared call
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Future) -> None:
+        """Drop the finished call for key so the next caller starts a fresh one"""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        """Get counters of upstream calls made and saved"""
+        return {
+            "upstream_calls": self.executed,
+            "saved_calls": self.saved,
+            "in_flight": len(self._calls)
+        }
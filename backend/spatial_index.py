@@ -0,0 +1,372 @@
+"""
+In-process spatial index of active internal coupons and ingested external ones
+Serves bounding-box lookups for the map (viewport, clusters, tiles) without scanning the database.
+
+- Coupons are bucketed into a fixed lat/lng grid (SPATIAL_INDEX_CELL_DEGREES, default 0.01 deg ~ 1km)
+- Loaded lazily from the database and fully rebuilt every SPATIAL_INDEX_REFRESH_SECONDS so other
+  processes' writes are picked up; admin writes in this process update it immediately
+- External coupons are ingested from the nearby pipeline's provider fetches and kept until they
+  expire or go SPATIAL_INDEX_EXTERNAL_TTL_SECONDS without being seen again
+- Coupons that ended more than SPATIAL_INDEX_EXPIRED_GRACE_SECONDS ago are never loaded and are
+  evicted on every rebuild, so the index (and the geofences built from it) only holds live coupons
+- Every change bumps `version` and is reported to listeners, so derived caches can be
+  maintained incrementally or invalidated
+"""
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from geo_utils import METERS_PER_DEGREE_LAT, bounding_box, calculate_distance, distance_to_segment
+from external_coupons import JST
+from models import Coupon, Store
+from repositories import discount_for_time_remaining
+
+logger = logging.getLogger(__name__)
+
+INDEX_CELL_DEGREES = float(os.getenv("SPATIAL_INDEX_CELL_DEGREES", "0.01"))
+INDEX_REFRESH_SECONDS = float(os.getenv("SPATIAL_INDEX_REFRESH_SECONDS", "60"))
+EXTERNAL_TTL_SECONDS = float(os.getenv("SPATIAL_INDEX_EXTERNAL_TTL_SECONDS", "1800"))
+EXPIRED_GRACE_SECONDS = float(os.getenv("SPATIAL_INDEX_EXPIRED_GRACE_SECONDS", "300"))
+CORRIDOR_MAX_CELLS = 50000  # Upper bound on the cells one corridor query may walk
+
+
+def _minutes_until(expires_at: datetime, now: datetime) -> float:
+    if expires_at.tzinfo is None:
+        now = now.replace(tzinfo=None)
+    return (expires_at - now).total_seconds() / 60
+
+
+class IndexedCoupon:
+    """One coupon in the index, with what is needed to render it on the map"""
+
+    __slots__ = (
+        "id", "store_id", "shop_name", "title", "description", "lat", "lng", "discount_rate_initial",
+        "discount_rate_schedule", "expires_at", "source", "external_url"
+    )
+
+    def __init__(self, id: str, store_id: Optional[str], shop_name: str, title: str, description: Optional[str],
+                 lat: float, lng: float, discount_rate_initial: int, discount_rate_schedule: Optional[List[Dict]],
+                 expires_at: datetime, source: str = "internal", external_url: Optional[str] = None):
+        self.id = id
+        self.store_id = store_id
+        self.shop_name = shop_name
+        self.title = title
+        self.description = description
+        self.lat = lat
+        self.lng = lng
+        self.discount_rate_initial = discount_rate_initial
+        self.discount_rate_schedule = discount_rate_schedule
+        self.expires_at = expires_at
+        self.source = source
+        self.external_url = external_url
+
+    def minutes_remaining(self, now: datetime) -> float:
+        return _minutes_until(self.expires_at, now)
+
+    def same_as(self, other: Optional["IndexedCoupon"]) -> bool:
+        """Whether other describes the coupon exactly like this one (an upsert of it changes nothing)"""
+        return other is not None and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    @property
+    def is_external(self) -> bool:
+        return self.source != "internal"
+
+    def current_discount(self, now: datetime) -> int:
+        """Discount right now, from the coupon's schedule (no database write)"""
+        if self.is_external:
+            return self.discount_rate_initial  # Providers publish a fixed discount
+        return discount_for_time_remaining(self.discount_rate_initial, self.discount_rate_schedule,
+                                           self.minutes_remaining(now))
+
+    def to_response(self, now: datetime) -> Dict[str, Any]:
+        """Serialize in the nearby endpoints' CouponResponse shape"""
+        return {
+            "id": self.id,
+            "shop_name": self.shop_name,
+            "store_name": self.shop_name,
+            "title": self.title,
+            "description": self.description,
+            "current_discount": self.current_discount(now),
+            "location": {"lat": self.lat, "lng": self.lng},
+            "expires_at": self.expires_at,
+            "time_remaining_minutes": max(0, int(self.minutes_remaining(now))),
+            "distance_meters": None,
+            "source": self.source,
+            "external_url": self.external_url
+        }
+
+
+Listener = Callable[[str, Optional[IndexedCoupon], Optional[IndexedCoupon]], None]
+
+
+class CouponSpatialIndex:
+    """Grid index of coupons keyed by id, with incremental updates"""
+
+    def __init__(self, cell_degrees: float = INDEX_CELL_DEGREES, refresh_seconds: float = INDEX_REFRESH_SECONDS):
+        self.cell_degrees = cell_degrees
+        self.refresh_seconds = refresh_seconds
+        self.version = 0
+        self._entries: Dict[str, IndexedCoupon] = {}
+        self._cells: Dict[Tuple[int, int], Dict[str, IndexedCoupon]] = {}
+        self._loaded_at: Optional[float] = None
+        self._external_seen: Dict[str, float] = {}
+        self._lock = threading.RLock()
+        self._listeners: List[Listener] = []
+
+    def cell_of(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def add_listener(self, listener: Listener) -> None:
+        """Call listener(event, old, new) on "upsert" / "remove" / "rebuild" (old and new are None on rebuild)"""
+        self._listeners.append(listener)
+
+    def _notify(self, event: str, old: Optional[IndexedCoupon], new: Optional[IndexedCoupon]) -> None:
+        for listener in self._listeners:
+            try:
+                listener(event, old, new)
+            except Exception as e:
+                logger.error(f"Spatial index listener failed on {event}: {e}")
+
+    @staticmethod
+    def _load(db: Session, *criteria) -> List[IndexedCoupon]:
+        # Recently ended coupons are kept for the grace period so in-flight map views stay consistent
+        ended_after = datetime.now(JST) - timedelta(seconds=EXPIRED_GRACE_SECONDS)
+        rows = db.query(
+            Coupon.id, Coupon.store_id, Coupon.title, Coupon.description, Coupon.discount_rate_initial,
+            Coupon.discount_rate_schedule, Coupon.end_time, Store.name, Store.latitude, Store.longitude
+        ).join(
+            Store, Coupon.store_id == Store.id
+        ).filter(
+            Coupon.active_status == "active",
+            Coupon.end_time > ended_after,
+            Store.is_active == True,
+            *criteria
+        ).all()
+        return [
+            IndexedCoupon(
+                id=str(row.id), store_id=str(row.store_id), shop_name=row.name, title=row.title,
+                description=row.description, lat=row.latitude, lng=row.longitude,
+                discount_rate_initial=row.discount_rate_initial, discount_rate_schedule=row.discount_rate_schedule,
+                expires_at=row.end_time
+            )
+            for row in rows
+        ]
+
+    def needs_refresh(self) -> bool:
+        loaded_at = self._loaded_at
+        return loaded_at is None or time.monotonic() - loaded_at >= self.refresh_seconds
+
+    def ensure_loaded(self, db: Session) -> None:
+        """Build the index on first use and rebuild it once it is older than refresh_seconds"""
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.refresh_seconds:
+            return
+        with self._lock:
+            if self._loaded_at == loaded_at:
+                self.rebuild(db)
+
+    def rebuild(self, db: Session) -> None:
+        """Reload every live coupon from the database (unexpired ingested external coupons are carried over)"""
+        entries = {entry.id: entry for entry in self._load(db)}
+        expired_before = -EXPIRED_GRACE_SECONDS / 60
+        now = datetime.now(JST)
+        with self._lock:
+            stale_before = time.monotonic() - EXTERNAL_TTL_SECONDS
+            self._external_seen = {
+                coupon_id: seen_at for coupon_id, seen_at in self._external_seen.items()
+                if seen_at >= stale_before and coupon_id in self._entries
+                and self._entries[coupon_id].minutes_remaining(now) > expired_before
+            }
+            for coupon_id in self._external_seen:
+                entries.setdefault(coupon_id, self._entries[coupon_id])
+        cells: Dict[Tuple[int, int], Dict[str, IndexedCoupon]] = {}
+        for entry in entries.values():
+            cells.setdefault(self.cell_of(entry.lat, entry.lng), {})[entry.id] = entry
+        with self._lock:
+            self._entries = entries
+            self._cells = cells
+            self._loaded_at = time.monotonic()
+            self.version += 1
+        logger.info(f"Spatial index rebuilt with {len(entries)} coupons in {len(cells)} cells")
+        self._notify("rebuild", None, None)
+
+    def upsert(self, entry: IndexedCoupon) -> None:
+        with self._lock:
+            old = self._remove_locked(entry.id)
+            self._entries[entry.id] = entry
+            self._cells.setdefault(self.cell_of(entry.lat, entry.lng), {})[entry.id] = entry
+            self.version += 1
+        self._notify("upsert", old, entry)
+
+    def remove(self, coupon_id: str) -> None:
+        with self._lock:
+            old = self._remove_locked(coupon_id)
+            if old is None:
+                return
+            self.version += 1
+        self._notify("remove", old, None)
+
+    def ingest_external(self, entries: Iterable[IndexedCoupon]) -> int:
+        """Add or refresh provider coupons; returns how many actually changed"""
+        changed = 0
+        now = time.monotonic()
+        for entry in entries:
+            with self._lock:
+                current = self._entries.get(entry.id)
+            if not entry.same_as(current):
+                self.upsert(entry)
+                changed += 1
+            # Unchanged entries keep the version (and derived caches) as is
+            with self._lock:
+                self._external_seen[entry.id] = now
+        return changed
+
+    def _remove_locked(self, coupon_id: str) -> Optional[IndexedCoupon]:
+        self._external_seen.pop(coupon_id, None)
+        old = self._entries.pop(coupon_id, None)
+        if old is not None:
+            cell_key = self.cell_of(old.lat, old.lng)
+            cell = self._cells.get(cell_key)
+            if cell is not None:
+                cell.pop(coupon_id, None)
+                if not cell:
+                    del self._cells[cell_key]
+        return old
+
+    def refresh_coupon(self, db: Session, coupon_id: str) -> None:
+        """Re-read one coupon after an admin write (removes it if it is no longer active)"""
+        if self._loaded_at is None:
+            return  # Not built yet; the first query loads everything
+        entries = self._load(db, Coupon.id == coupon_id)
+        if entries:
+            self.upsert(entries[0])
+        else:
+            self.remove(coupon_id)
+
+    def refresh_store(self, db: Session, store_id: str) -> None:
+        """Re-read all coupons of a store after an admin write to the store"""
+        if self._loaded_at is None:
+            return
+        current = {entry.id: entry for entry in self._load(db, Coupon.store_id == store_id)}
+        with self._lock:
+            stale = [entry.id for entry in self._entries.values() if entry.store_id == store_id and entry.id not in current]
+        for coupon_id in stale:
+            self.remove(coupon_id)
+        for entry in current.values():
+            self.upsert(entry)
+
+    def cells_in_box(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> Iterable[Tuple[int, int]]:
+        min_row, min_col = self.cell_of(min_lat, min_lng)
+        max_row, max_col = self.cell_of(max_lat, max_lng)
+        with self._lock:
+            # Walk whichever is smaller: the box's cells or the occupied cells
+            if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self._cells):
+                return [key for key in self._cells if min_row <= key[0] <= max_row and min_col <= key[1] <= max_col]
+            return [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+
+    def query_box(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+                  now: datetime) -> List[IndexedCoupon]:
+        """Unexpired coupons inside the box"""
+        results = []
+        with self._lock:
+            for key in self.cells_in_box(min_lat, min_lng, max_lat, max_lng):
+                for entry in self._cells.get(key, {}).values():
+                    if (min_lat <= entry.lat <= max_lat and min_lng <= entry.lng <= max_lng
+                            and entry.minutes_remaining(now) > 0):
+                        results.append(entry)
+        return results
+
+    def get(self, coupon_id: str) -> Optional[IndexedCoupon]:
+        with self._lock:
+            return self._entries.get(coupon_id)
+
+    def entries(self) -> List[IndexedCoupon]:
+        """Snapshot of every indexed coupon"""
+        with self._lock:
+            return list(self._entries.values())
+
+    def _segment_cells(self, start: Tuple[float, float], end: Tuple[float, float],
+                       radius_m: float) -> Iterable[Tuple[int, int]]:
+        """Cells within radius_m of the segment start-end, walked in cell-sized steps along it"""
+        cell_m = self.cell_degrees * METERS_PER_DEGREE_LAT * max(math.cos(math.radians(start[0])), 0.01)
+        steps = max(1, math.ceil(calculate_distance(start[0], start[1], end[0], end[1]) / cell_m))
+        # Every point within radius_m of the segment is within radius_m + cell_m / 2 of some sample
+        reach_m = radius_m + cell_m
+        seen = set()
+        for step in range(steps + 1):
+            t = step / steps
+            lat = start[0] + (end[0] - start[0]) * t
+            lng = start[1] + (end[1] - start[1]) * t
+            box = bounding_box(lat, lng, reach_m)
+            min_row, min_col = self.cell_of(box[0], box[1])
+            max_row, max_col = self.cell_of(box[2], box[3])
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    if (row, col) not in seen:
+                        seen.add((row, col))
+                        yield row, col
+
+    def query_corridor(self, points: List[Tuple[float, float]], radius_m: float, now: datetime,
+                       connected: bool = True,
+                       max_cells: int = CORRIDOR_MAX_CELLS) -> List[Tuple[IndexedCoupon, float, float]]:
+        """
+        Unexpired coupons within radius_m of the path through points (or of any of the points when
+        not connected), each once, as (entry, distance, meters along the path to the closest point),
+        in path order. Raises ValueError when the corridor would cover more than max_cells cells.
+        """
+        if connected and len(points) > 1:
+            segments = list(zip(points, points[1:]))
+        else:
+            segments = [(point, point) for point in points]
+        offsets = [0.0]
+        for i in range(1, len(segments)):
+            previous, current = segments[i - 1][0], segments[i][0]
+            offsets.append(offsets[-1] + calculate_distance(previous[0], previous[1], current[0], current[1]))
+
+        # Cells along each segment (not its whole bounding box, which grows with the square of a
+        # diagonal's length), so a coupon is only measured against the segments that can reach it
+        cell_segments: Dict[Tuple[int, int], List[int]] = {}
+        for i, (start, end) in enumerate(segments):
+            for key in self._segment_cells(start, end, radius_m):
+                cell_segments.setdefault(key, []).append(i)
+                if len(cell_segments) > max_cells:
+                    raise ValueError(f"Corridor covers more than {max_cells} index cells")
+
+        with self._lock:
+            candidates = [(entry, cell_segments[key]) for key in cell_segments
+                          for entry in self._cells.get(key, {}).values()]
+
+        matches = []
+        for entry, segment_ids in candidates:
+            if entry.minutes_remaining(now) <= 0:
+                continue
+            best = None
+            for i in segment_ids:
+                distance, along = distance_to_segment(entry.lat, entry.lng, *segments[i])
+                if distance <= radius_m and (best is None or distance < best[0]):
+                    best = (distance, offsets[i] + along)
+            if best is not None:
+                matches.append((entry, best[0], best[1]))
+        # Each coupon lives in exactly one cell, so the matches are already unique
+        matches.sort(key=lambda match: (match[2], match[1], match[0].id))
+        return matches
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "coupons": len(self._entries),
+                "external": len(self._external_seen),
+                "cells": len(self._cells),
+                "version": self.version,
+                "age_seconds": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at is not None else None
+            }
+
+
+# Shared by all requests in this process
+coupon_index = CouponSpatialIndex()
@@ -9,18 +9,20 @@ import os
 # Add the backend directory to the path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from coupon_providers import KumaponProvider
 from external_coupons import ExternalCouponService
 
 async def test_kumapon_api():
     """Test the Kumapon API integration"""
     service = ExternalCouponService()
+    kumapon = KumaponProvider()
     
     print("🧪 Testing Kumapon API Integration")
     print("=" * 50)
     
     # Test fetching areas
     print("1️⃣ Testing area groups API...")
-    areas = await service.fetch_kumapon_areas()
+    areas = await kumapon.fetch_areas(service)
     print(f"   Found {len(areas)} area groups")
     if areas:
         for i, area in enumerate(areas[:3]):  # Show first 3
@@ -32,7 +34,7 @@ async def test_kumapon_api():
     # Test fetching coupons near Tokyo Station
     print("\n2️⃣ Testing location-based coupon search (Tokyo Station)...")
     tokyo_lat, tokyo_lng = 35.6812, 139.7671
-    coupons = await service.fetch_kumapon_coupons_near_location(tokyo_lat, tokyo_lng, 5000)
+    coupons = await kumapon.coupons_near(service, tokyo_lat, tokyo_lng, 5000)
     print(f"   Found {len(coupons)} coupons near Tokyo Station")
     
     for i, coupon in enumerate(coupons[:5]):  # Show first 5
@@ -43,12 +45,12 @@ async def test_kumapon_api():
     
     # Test area mapping
     print("\n3️⃣ Testing area mapping...")
-    area_ids = service.get_area_mapping_for_location(tokyo_lat, tokyo_lng)
+    area_ids = await kumapon.get_area_mapping_for_location(service, tokyo_lat, tokyo_lng)
     print(f"   Tokyo area IDs: {area_ids}")
     
     # Test Osaka location
     osaka_lat, osaka_lng = 34.6937, 135.5023
-    osaka_area_ids = service.get_area_mapping_for_location(osaka_lat, osaka_lng)
+    osaka_area_ids = await kumapon.get_area_mapping_for_location(service, osaka_lat, osaka_lng)
     print(f"   Osaka area IDs: {osaka_area_ids}")
     
     print("\n✅ Test completed!")
@@ -0,0 +1,164 @@
+"""
+Trajectory-based prefetch of nearby coupons
+Estimates where a moving user will be next from their recent GeoPoint history and warms the
+external coupon caches there in the background (the Hot Pepper geo tile and the Rakuten Market
+catalog; providers without a cache are not called), so the next map refresh is a cache hit.
+
+- Recent points are kept in memory per user (the last TRAJECTORY_HISTORY_POINTS); the database
+  history is only read to seed a user this process hasn't seen yet
+- Velocity is the recency-weighted average over the last TRAJECTORY_WINDOW_SECONDS; users slower
+  than TRAJECTORY_MIN_SPEED_MPS are treated as standing still and nothing is prefetched
+- Positions are predicted PREFETCH_HORIZONS_SECONDS ahead; each predicted tile is warmed at most
+  once per PREFETCH_TILE_TTL_SECONDS across all users
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from geo_utils import calculate_distance, destination_point, tile_key
+from repositories import GeoPointRepository
+
+logger = logging.getLogger(__name__)
+
+TRAJECTORY_PREFETCH_ENABLED = os.getenv("TRAJECTORY_PREFETCH", "true").lower() == "true"
+TRAJECTORY_HISTORY_POINTS = 8
+TRAJECTORY_WINDOW_SECONDS = float(os.getenv("TRAJECTORY_WINDOW_SECONDS", "120"))
+TRAJECTORY_MIN_SPEED_MPS = 0.5
+TRAJECTORY_MAX_SPEED_MPS = 35.0  # Faster than this is a GPS jump, not movement
+PREFETCH_HORIZONS_SECONDS = tuple(
+    float(value) for value in os.getenv("PREFETCH_HORIZONS_SECONDS", "30,90").split(",") if value.strip()
+)
+PREFETCH_TILE_M = 250
+PREFETCH_TILE_TTL_SECONDS = float(os.getenv("PREFETCH_TILE_TTL_SECONDS", "120"))
+MAX_TRACKED_USERS = 10000
+
+TrackPoint = Tuple[float, float, datetime]
+
+
+class Motion:
+    __slots__ = ("speed_mps", "bearing_rad")
+
+    def __init__(self, speed_mps: float, bearing_rad: float):
+        self.speed_mps = speed_mps
+        self.bearing_rad = bearing_rad
+
+
+def _bearing(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    lat1_rad, lat2_rad = math.radians(lat1), math.radians(lat2)
+    delta_lng = math.radians(lng2 - lng1)
+    x = math.sin(delta_lng) * math.cos(lat2_rad)
+    y = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(delta_lng)
+    return math.atan2(x, y)
+
+
+def estimate_motion(points: List[TrackPoint]) -> Optional[Motion]:
+    """Speed and heading from points (oldest first), or None when the user isn't moving"""
+    if len(points) < 2:
+        return None
+    newest = points[-1][2]
+    recent = [point for point in points if (newest - point[2]).total_seconds() <= TRAJECTORY_WINDOW_SECONDS]
+    # Recency-weighted average of the per-step velocity vectors (meters per second, east / north)
+    east = north = total_weight = 0.0
+    for weight, (start, end) in enumerate(zip(recent, recent[1:]), start=1):
+        seconds = (end[2] - start[2]).total_seconds()
+        if seconds <= 0:
+            continue
+        speed = calculate_distance(start[0], start[1], end[0], end[1]) / seconds
+        if speed > TRAJECTORY_MAX_SPEED_MPS:
+            continue
+        bearing = _bearing(start[0], start[1], end[0], end[1])
+        east += weight * speed * math.sin(bearing)
+        north += weight * speed * math.cos(bearing)
+        total_weight += weight
+    if total_weight == 0:
+        return None
+    east /= total_weight
+    north /= total_weight
+    speed = math.hypot(east, north)
+    if speed < TRAJECTORY_MIN_SPEED_MPS:
+        return None
+    return Motion(speed, math.atan2(east, north))
+
+
+def predict_positions(points: List[TrackPoint], horizons: Tuple[float, ...] = PREFETCH_HORIZONS_SECONDS) -> List[Tuple[float, float]]:
+    """Where the user is expected to be after each horizon (seconds), from their latest point"""
+    motion = estimate_motion(points)
+    if motion is None:
+        return []
+    lat, lng, _ = points[-1]
+    return [destination_point(lat, lng, motion.speed_mps * horizon, motion.bearing_rad) for horizon in horizons]
+
+
+Warmer = Callable[[float, float, int], Awaitable[object]]
+
+
+class TrajectoryPrefetcher:
+    """Tracks recent user positions and warms caches ahead of them"""
+
+    def __init__(self, warm: Warmer, horizons: Tuple[float, ...] = PREFETCH_HORIZONS_SECONDS,
+                 enabled: bool = TRAJECTORY_PREFETCH_ENABLED):
+        self.warm = warm
+        self.horizons = horizons
+        self.enabled = enabled
+        self._tracks: "OrderedDict[str, Deque[TrackPoint]]" = OrderedDict()
+        self._warmed: "OrderedDict[Tuple[int, int, int], float]" = OrderedDict()
+        self._background_tasks = set()
+        self.metrics = {"predictions": 0, "prefetches": 0, "skipped_warm": 0, "failures": 0}
+
+    def _track(self, db: Session, user_id: str) -> Deque[TrackPoint]:
+        track = self._tracks.get(user_id)
+        if track is None:
+            history = GeoPointRepository(db).get_user_location_history(user_id, limit=TRAJECTORY_HISTORY_POINTS)
+            track = deque(((point.latitude, point.longitude, point.timestamp) for point in reversed(history)
+                           if point.timestamp is not None), maxlen=TRAJECTORY_HISTORY_POINTS)
+            self._tracks[user_id] = track
+            while len(self._tracks) > MAX_TRACKED_USERS:
+                self._tracks.popitem(last=False)
+        self._tracks.move_to_end(user_id)
+        return track
+
+    def observe(self, db: Session, user_id: str, lat: float, lng: float, timestamp: datetime,
+                radius: int) -> List[Tuple[float, float]]:
+        """Record a position (already stored as a GeoPoint) and prefetch ahead of it; returns the predictions"""
+        if not self.enabled:
+            return []
+        track = self._track(db, user_id)
+        if not track or track[-1][2] != timestamp:
+            track.append((lat, lng, timestamp))
+
+        predictions = predict_positions(list(track), self.horizons)
+        if predictions:
+            self.metrics["predictions"] += 1
+        now = time.monotonic()
+        for predicted_lat, predicted_lng in predictions:
+            key = tile_key(predicted_lat, predicted_lng, PREFETCH_TILE_M)
+            warmed_at = self._warmed.get(key)
+            if warmed_at is not None and now - warmed_at < PREFETCH_TILE_TTL_SECONDS:
+                self.metrics["skipped_warm"] += 1
+                continue
+            self._warmed[key] = now
+            self._warmed.move_to_end(key)
+            while len(self._warmed) > MAX_TRACKED_USERS:
+                self._warmed.popitem(last=False)
+            task = asyncio.get_running_loop().create_task(self._prefetch(predicted_lat, predicted_lng, radius))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+        return predictions
+
+    async def _prefetch(self, lat: float, lng: float, radius: int) -> None:
+        try:
+            await self.warm(lat, lng, radius)
+            self.metrics["prefetches"] += 1
+        except Exception as e:
+            self.metrics["failures"] += 1
+            logger.warning(f"Prefetch at {lat:.5f}, {lng:.5f} failed: {e}")
+
+    def stats(self) -> Dict[str, object]:
+        return {**self.metrics, "tracked_users": len(self._tracks), "in_flight": len(self._background_tasks)}
@@ -0,0 +1,188 @@
+"""
+Mapbox Vector Tiles of coupons
+Encodes the spatial index (internal coupons and ingested external ones) as MVT 2.1 tiles
+for /api/tiles/{z}/{x}/{y}.mvt, so the map only loads the tiles it shows.
+
+- Layer "coupons" (zoom >= TILE_POINT_MIN_ZOOM): one point per coupon with id, title, shop_name,
+  discount, source, expires_at (ISO 8601, JST) and minutes_remaining
+- Layer "clusters" (lower zooms): coupon_clusters.py grid clusters with count, max_discount
+  and soonest_expires_at
+- The protobuf encoding is done here (points only, no dependency on mapbox-vector-tile)
+- Encoded tiles are cached per (z, x, y), keyed on the index version and the current minute,
+  so admin writes and ingestion invalidate them and discounts/expiry never go stale
+"""
+import hashlib
+import os
+import struct
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from spatial_index import CouponSpatialIndex, coupon_index
+from coupon_clusters import TILE_SIZE, CouponClusterIndex, coupon_clusters, tile_bounds, world_pixel
+
+TILE_EXTENT = 4096
+TILE_BUFFER = 64  # In extent units; points just outside the edge are kept so icons aren't clipped
+TILE_POINT_MIN_ZOOM = int(os.getenv("TILE_POINT_MIN_ZOOM", "13"))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "2048"))
+
+Feature = Tuple[Tuple[int, int], Dict[str, Any]]
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number: int, wire_type: int) -> bytes:
+    return _varint((number << 3) | wire_type)
+
+
+def _bytes_field(number: int, payload: bytes) -> bytes:
+    return _field(number, 2) + _varint(len(payload)) + payload
+
+
+def _packed(number: int, values: List[int]) -> bytes:
+    return _bytes_field(number, b"".join(_varint(v) for v in values))
+
+
+def _encode_value(value: Any) -> bytes:
+    # Tile.Value: 1 string, 3 double, 5 uint, 6 sint, 7 bool
+    if isinstance(value, bool):
+        return _field(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return _field(5, 0) + _varint(value)
+        return _field(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _field(3, 1) + struct.pack("<d", value)
+    return _bytes_field(1, str(value).encode("utf-8"))
+
+
+def encode_layer(name: str, features: List[Feature], extent: int = TILE_EXTENT) -> bytes:
+    """One Tile.Layer of point features given in tile coordinates"""
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple[type, Any], int] = {}
+    body = bytearray()
+    for (x, y), properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        feature = _packed(2, tags) + _field(3, 0) + _varint(1)  # type = POINT
+        # MoveTo(1) from the origin, then the zigzagged offset
+        feature += _packed(4, [(1 & 0x7) | (1 << 3), _zigzag(x), _zigzag(y)])
+        body += _bytes_field(2, feature)
+    layer = _field(15, 0) + _varint(2) + _bytes_field(1, name.encode("utf-8")) + bytes(body)
+    layer += b"".join(_bytes_field(3, key.encode("utf-8")) for key in keys)
+    layer += b"".join(_bytes_field(4, _encode_value(value)) for _, value in values)
+    layer += _field(5, 0) + _varint(extent)
+    return layer
+
+
+def encode_tile(layers: List[Tuple[str, List[Feature]]]) -> bytes:
+    """A Tile message; empty layers are left out"""
+    return b"".join(_bytes_field(3, encode_layer(name, features)) for name, features in layers if features)
+
+
+class CouponTileRenderer:
+    """Builds and caches coupon tiles from the spatial index"""
+
+    def __init__(self, index: CouponSpatialIndex, clusters: CouponClusterIndex, max_entries: int = TILE_CACHE_SIZE):
+        self.index = index
+        self.clusters = clusters
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[Tuple[int, int, int], Tuple[Tuple[int, int], bytes, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _tile_point(lat: float, lng: float, zoom: int, x: int, y: int) -> Tuple[int, int]:
+        px, py = world_pixel(lat, lng, zoom)
+        scale = TILE_EXTENT / TILE_SIZE
+        return round((px - x * TILE_SIZE) * scale), round((py - y * TILE_SIZE) * scale)
+
+    @staticmethod
+    def _in_tile(point: Tuple[int, int]) -> bool:
+        return -TILE_BUFFER <= point[0] <= TILE_EXTENT + TILE_BUFFER and -TILE_BUFFER <= point[1] <= TILE_EXTENT + TILE_BUFFER
+
+    def _coupon_features(self, zoom: int, x: int, y: int, now: datetime) -> List[Feature]:
+        min_lat, min_lng, max_lat, max_lng = tile_bounds(zoom, x, y)
+        # Pad the box by the buffer (in degrees) so edge points land in both neighbouring tiles
+        pad_lng = (max_lng - min_lng) * TILE_BUFFER / TILE_EXTENT
+        pad_lat = (max_lat - min_lat) * TILE_BUFFER / TILE_EXTENT
+        features = []
+        for entry in self.index.query_box(min_lat - pad_lat, min_lng - pad_lng, max_lat + pad_lat, max_lng + pad_lng, now):
+            point = self._tile_point(entry.lat, entry.lng, zoom, x, y)
+            if not self._in_tile(point):
+                continue
+            features.append((point, {
+                "id": entry.id,
+                "title": entry.title,
+                "shop_name": entry.shop_name,
+                "discount": entry.current_discount(now),
+                "source": entry.source,
+                "expires_at": entry.expires_at.isoformat(),
+                "minutes_remaining": max(0, int(entry.minutes_remaining(now)))
+            }))
+        return features
+
+    def _cluster_features(self, zoom: int, x: int, y: int, now: datetime) -> List[Feature]:
+        features = []
+        for cluster in self.clusters.tile_clusters(zoom, x, y, now):
+            location = cluster["location"]
+            features.append((self._tile_point(location["lat"], location["lng"], zoom, x, y), {
+                "count": cluster["count"],
+                "max_discount": cluster["max_discount"],
+                "soonest_expires_at": cluster["soonest_expires_at"].isoformat(),
+                "coupon_id": cluster["coupon_id"]
+            }))
+        return features
+
+    def render(self, zoom: int, x: int, y: int, now: datetime) -> Tuple[bytes, str]:
+        """Encoded tile and its ETag"""
+        key = (zoom, x, y)
+        stamp = (self.index.version, int(now.timestamp() // 60))
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == stamp:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached[1], cached[2]
+            self.misses += 1
+
+        if zoom >= TILE_POINT_MIN_ZOOM or zoom > self.clusters.max_zoom:
+            tile = encode_tile([("coupons", self._coupon_features(zoom, x, y, now))])
+        else:
+            tile = encode_tile([("clusters", self._cluster_features(zoom, x, y, now))])
+        etag = f'"{hashlib.sha1(tile).hexdigest()}"'
+
+        with self._lock:
+            self._cache[key] = (stamp, tile, etag)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tile, etag
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"cached_tiles": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+# Shared by all requests in this process
+coupon_tiles = CouponTileRenderer(coupon_index, coupon_clusters)
@@ -1,4 +1,4 @@
-import { UserCoupon, Location, Coupon } from '../types';
+import { UserCoupon, UserCouponPage, Location, Coupon } from '../types';
 import axios from 'axios';
 
 // Environment-based API configuration
@@ -148,6 +148,25 @@ export const getUserCoupons = async (userId?: string): Promise<UserCoupon[]> =>
   return response.json();
 };
 
+// 取得済みクーポンを新しい順に1ページずつ取得（limit を省略すると全件）
+export const getUserCouponsPage = async (
+  options: { status?: 'used' | 'unused' | 'expired'; limit?: number; cursor?: string } = {}
+): Promise<UserCouponPage> => {
+  const params = new URLSearchParams();
+  if (options.status) params.set('status', options.status);
+  if (options.limit !== undefined) params.set('limit', String(options.limit));
+  if (options.cursor) params.set('cursor', options.cursor);
+  const query = params.toString();
+  const response = await authFetch(`${API_BASE_URL}/user/me/coupons${query ? `?${query}` : ''}`);
+  if (!response.ok) {
+    throw new Error('Failed to fetch user coupons');
+  }
+  return {
+    coupons: await response.json(),
+    nextCursor: response.headers.get('X-Next-Cursor'),
+  };
+};
+
 export const getCoupon = async (couponId: string, userLocation: Location, userId?: string): Promise<any> => {
   const response = await authFetch(`${API_BASE_URL}/coupons/get`, {
     method: 'POST',
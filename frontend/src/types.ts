@@ -37,4 +37,13 @@ export interface UserCoupon {
   is_used: boolean;
   used_at?: string;
   store_name?: string; // 管理画面API用の追加フィールド
+  status?: UserCouponStatus; // /user/me/coupons のみ
+  description?: string; // /user/me/coupons のみ
+}
+
+export type UserCouponStatus = 'obtained' | 'used' | 'expired';
+
+export interface UserCouponPage {
+  coupons: UserCoupon[];
+  nextCursor: string | null; // 次ページがなければ null
 }
\ No newline at end of file
@@ -77,7 +77,11 @@ CREATE TABLE IF NOT EXISTS user_coupons (
 );
 
 -- Create indexes for user coupon queries
-CREATE INDEX IF NOT EXISTS idx_user_coupons_user_id ON user_coupons(user_id);
+-- Wallet pages (/api/user/me/coupons): newest first, optionally filtered by status. They also cover
+-- lookups by user_id, which had their own index before
+CREATE INDEX IF NOT EXISTS idx_user_coupons_wallet ON user_coupons(user_id, obtained_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_user_coupons_wallet_status ON user_coupons(user_id, status, obtained_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_user_coupons_user_id;
 CREATE INDEX IF NOT EXISTS idx_user_coupons_coupon_id ON user_coupons(coupon_id);
 CREATE INDEX IF NOT EXISTS idx_user_coupons_status ON user_coupons(status);
 
@@ -98,18 +102,76 @@ CREATE INDEX IF NOT EXISTS idx_admins_email ON admins(email);
 CREATE INDEX IF NOT EXISTS idx_admins_role ON admins(role);
 
 -- Create GeoPoints table for location tracking
+-- Partitioned by day on timestamp; backend/geo_retention.py creates the daily geo_points_pYYYYMMDD
+-- partitions ahead of time, compacts old ones and drops them after the retention period
 CREATE TABLE IF NOT EXISTS geo_points (
-    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
     user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
     latitude DOUBLE PRECISION NOT NULL,
     longitude DOUBLE PRECISION NOT NULL,
-    timestamp TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    dwell_seconds INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+-- Rows outside every daily partition (e.g. before the first maintenance run); geo_retention.py moves
+-- them into their day's partition when it creates it and deletes leftovers past the retention period
+CREATE TABLE IF NOT EXISTS geo_points_default PARTITION OF geo_points DEFAULT;
+
+-- Existing databases: stationary polls now extend a point's dwell time instead of adding rows
+ALTER TABLE geo_points ADD COLUMN IF NOT EXISTS dwell_seconds INTEGER NOT NULL DEFAULT 0;
+
+-- Existing (unpartitioned) databases: keep the old table as one partition for the history so far
+-- ALTER TABLE geo_points RENAME TO geo_points_legacy;
+-- ALTER TABLE geo_points_legacy DROP CONSTRAINT geo_points_pkey;
+-- ALTER TABLE geo_points_legacy ALTER COLUMN timestamp SET NOT NULL;
+-- DROP INDEX IF EXISTS idx_geo_points_user_id, idx_geo_points_timestamp, idx_geo_points_location;
+-- (run the CREATE TABLE / CREATE INDEX statements here)
+-- ALTER TABLE geo_points ATTACH PARTITION geo_points_legacy FOR VALUES FROM (MINVALUE) TO ('<today>');
+-- (drop geo_points_legacy by hand once it is older than GEO_RETENTION_DAYS)
+
+-- Create indexes for geo queries (created on every partition; history is read per user, newest first)
+CREATE INDEX IF NOT EXISTS idx_geo_points_user_timestamp ON geo_points(user_id, timestamp DESC);
+
+-- Hourly GeoPoint and visitor counts per Web Mercator tile (zoom/x/y) for store heatmaps, see backend/foot_traffic.py
+CREATE TABLE IF NOT EXISTS foot_traffic_cells (
+    zoom INTEGER NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    hour TIMESTAMP WITH TIME ZONE NOT NULL,
+    points INTEGER NOT NULL DEFAULT 0,
+    visitors INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (zoom, cell_x, cell_y, hour)
+);
+
+-- Existing databases: heatmaps count distinct visitors per cell-hour instead of sampled points
+ALTER TABLE foot_traffic_cells ADD COLUMN IF NOT EXISTS visitors INTEGER NOT NULL DEFAULT 0;
+
+-- Push notifications waiting for delivery (backend/notification_outbox.py); delivered rows are deleted
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    kind VARCHAR(50) NOT NULL DEFAULT 'nearby',
+    provider VARCHAR(50) NOT NULL,
+    coupon_id UUID,
+    store_id UUID,
+    title VARCHAR(255) NOT NULL,
+    message TEXT NOT NULL,
+    status VARCHAR(50) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    
+    CONSTRAINT valid_notification_status CHECK (status IN ('pending', 'sending', 'failed'))
 );
 
--- Create indexes for geo queries
-CREATE INDEX IF NOT EXISTS idx_geo_points_user_id ON geo_points(user_id);
-CREATE INDEX IF NOT EXISTS idx_geo_points_timestamp ON geo_points(timestamp);
-CREATE INDEX IF NOT EXISTS idx_geo_points_location ON geo_points(latitude, longitude);
+-- Existing databases: rows being pushed are leased with status 'sending'
+ALTER TABLE notification_outbox DROP CONSTRAINT IF EXISTS valid_notification_status;
+ALTER TABLE notification_outbox ADD CONSTRAINT valid_notification_status
+    CHECK (status IN ('pending', 'sending', 'failed'));
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox(status, next_attempt_at);
 
 -- Create Reservations table (future feature)
 CREATE TABLE IF NOT EXISTS reservations (